@@ -11,6 +11,11 @@ import compiletools.git_utils
 import compiletools.configutils
 import compiletools.utils
 import compiletools.dirnamer
+import compiletools.compiler_macros
+import compiletools.pkgconfig
+import compiletools.caches
+import compiletools.profiling
+import compiletools.memory
 
 try:
     from rich_rst import RestructuredText
@@ -58,6 +63,9 @@ def add_base_arguments(cap, argv=None, variant=None):
     # the help.
     if variant is None:
         variant = compiletools.configutils.extract_variant(argv=argv)
+    # Start profiling now so that the argument parsing is included
+    compiletools.profiling.start(compiletools.profiling.mode_from_argv(argv), argv)
+    compiletools.memory.start("--memory-report" in (sys.argv[1:] if argv is None else argv))
 
     cap.add(
         "--variant",
@@ -86,6 +94,21 @@ def add_base_arguments(cap, argv=None, variant=None):
         default=False,
         help="Time the execution of each subprocess (similar to gcc/clang -time flag)",
     )
+    cap.add(
+        "--time-per-file",
+        action="store_true",
+        default=False,
+        help="With --time, also break down each operation by the file it worked on",
+    )
+    compiletools.profiling.add_arguments(cap)
+    compiletools.memory.add_arguments(cap)
+    compiletools.caches.add_arguments(cap)
+    cap.add(
+        "--time-trace",
+        metavar="FILE",
+        default=None,
+        help="Write ct's own timings (argument parsing, compiler probes, header scanning, etc) to FILE in the Chrome trace event format, for chrome://tracing or Perfetto. Any clang -ftime-trace output of the objects built is merged in.",
+    )
 
     if rich_rst_available and sys.version_info.major == 3 and sys.version_info.minor >= 9:
         cap.add("--man", "--doc", action=DocumentationAction)
@@ -340,19 +363,27 @@ def _add_include_paths_to_flags(args):
         print("\tCXXFLAGS=" + args.CXXFLAGS)
 
 
-def _add_flags_from_pkg_config(args):
-    for pkg in args.pkg_config:
-        # TODO: when we move to python 3.7, use text=True rather than universal_newlines=True and capture_output=True,
-        cflags = (
-            subprocess.run(
-                ["pkg-config", "--cflags", pkg],
-                stdout=subprocess.PIPE,
-                universal_newlines=True,
-            )
-            .stdout.rstrip()
-            .replace("-I", "-isystem ")
-        )  # This helps the CppHeaderDeps avoid searching packages
+def _prefetch_compiler_macros(args):
+    """The direct header dependencies (which the direct magic flags also use)
+    probe the compilers for their predefined macros.  Start the CXX and CC
+    probes in the background, concurrently with each other and with
+    whatever the tool does next.
+    """
+    if "direct" not in (getattr(args, "headerdeps", None), getattr(args, "magic", None)):
+        return
+    for compiler_name, flags_name, language in (("CXX", "CXXFLAGS", "c++"), ("CC", "CFLAGS", "c")):
+        compiler = getattr(args, compiler_name, None)
+        if not compiler:
+            continue
+        flags = compiletools.compiler_macros.macro_relevant_flags(
+            getattr(args, "CPPFLAGS", ""), getattr(args, flags_name, "")
+        )
+        compiletools.compiler_macros.prefetch_compiler_macros(compiler, args.verbose, flags, language)
+
 
+def _add_flags_from_pkg_config(args):
+    for pkg, pkgflags in compiletools.pkgconfig.resolve(args.pkg_config, args.verbose).items():
+        cflags = pkgflags.cflags
         if cflags:
             args.CPPFLAGS += f" {cflags}"
             args.CFLAGS += f" {cflags}"
@@ -360,14 +391,10 @@ def _add_flags_from_pkg_config(args):
             if args.verbose >= 6:
                 print(f"pkg-config --cflags {pkg} added FLAGS={cflags}")
 
-        # Only query pkg-config for libs if LDFLAGS is defined in the args namespace.
+        # Only add the libs if LDFLAGS is defined in the args namespace.
         # Some tools (like ct-magicflags) don't call add_link_arguments() so LDFLAGS won't exist.
         if hasattr(args, 'LDFLAGS'):
-            libs = subprocess.run(
-                ["pkg-config", "--libs", pkg],
-                stdout=subprocess.PIPE,
-                universal_newlines=True,
-            ).stdout.rstrip()
+            libs = pkgflags.libs
             if libs:
                 args.LDFLAGS += f" {libs}"
                 if args.verbose >= 6:
@@ -526,6 +553,9 @@ def _commonsubstitutions(args):
     _extend_includes_using_git_root(args)
     _add_include_paths_to_flags(args)
     _add_flags_from_pkg_config(args)
+    # Now that pkg-config has added its flags (e.g., -pthread changes the
+    # macros), start the compilers so they run while the rest is set up
+    _prefetch_compiler_macros(args)
     _set_project_version(args)
 
     try:
@@ -551,6 +581,14 @@ def resetcallbacks():
     _substitutioncallbacks = [_commonsubstitutions]
 
 
+def resetparsers():
+    """configargparse hands out singleton parsers.  Long lived processes
+    (ct-served, ct-cake --watch) that parse a fresh command line for each
+    build must start from a clean slate.
+    """
+    configargparse._parsers = {}
+
+
 def registercallback(callback):
     """Use this to register a function to be called back during the
     substitutions call (usually during parseargs).
@@ -638,6 +676,15 @@ def parseargs(cap, argv, verbose=None):
     if verbose is None:
         verbose = args.verbose
 
+    try:
+        compiletools.caches.configure(getattr(args, "cache_maxsize", None))
+    except ValueError as err:
+        cap.error(str(err))
+
+    # --profile from a config file or CT_PROFILE (the command line started it already)
+    compiletools.profiling.start(compiletools.profiling.mode(args), argv)
+    compiletools.memory.start(getattr(args, "memory_report", False))
+
     # TODO: if arg.variable_handling_method == "append" then fix up the environment
     # Note that configargparse uses the "override" method, so we need to partially undo that.
     # TODO: Write up a PR for configargparse to do override
@@ -0,0 +1,7 @@
+""" Benchmarks of the ct-* tools over generated C++ projects.
+
+    compiletools.benchmark.synthetic writes projects of a given size and
+    shape and compiletools.benchmark.runner (ct-benchmark) times the tools
+    over them, writes the results as JSON and compares them against a
+    baseline.
+"""
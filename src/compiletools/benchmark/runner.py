@@ -0,0 +1,190 @@
+""" Time the ct-* tools over generated projects (ct-benchmark).
+
+    Every case runs the tool in a fresh python process with CTCACHE=None
+    so that each run pays for the startup and for all of the analysis, as
+    a user's first build would.  The fastest of the repeats is the one that
+    is compared against a baseline.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import statistics
+import subprocess
+
+import compiletools
+import compiletools.apptools
+import compiletools.benchmark.synthetic
+
+_VARIANT = "bench"
+
+# name -> (module whose main() is run, arguments before the main sources, whether every main is given)
+CASES = {
+    "cake_filelist_direct": ("compiletools.cake", ["--file-list", "--headerdeps=direct"], True),
+    "cake_filelist_cpp": ("compiletools.cake", ["--file-list", "--headerdeps=cpp"], True),
+    "create_makefile": ("compiletools.makefile", [], True),
+    "headertree": ("compiletools.headertree", ["--style=flat"], False),
+}
+
+
+def _write_config(directory):
+    with open(os.path.join(directory, _VARIANT + ".conf"), "w", encoding="utf-8") as ff:
+        ff.write("ID=GNU\n")
+        ff.write("CC={}\n".format(os.environ.get("CC", "gcc")))
+        ff.write("CXX={}\n".format(os.environ.get("CXX", "g++")))
+        ff.write('CPPFLAGS="-std=c++20"\n')
+    with open(os.path.join(directory, "ct.conf"), "w", encoding="utf-8") as ff:
+        ff.write("variant = {}\n".format(_VARIANT))
+        ff.write("exemarkers = [main]\n")
+
+
+def _command(module, argv):
+    return [sys.executable, "-c", "import sys, {0}; sys.exit({0}.main(sys.argv[1:]))".format(module)] + argv
+
+
+def _environment():
+    """ The tools must import this compiletools even when it isn't installed """
+    env = dict(os.environ)
+    srcdir = os.path.dirname(os.path.dirname(os.path.abspath(compiletools.__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [srcdir, env.get("PYTHONPATH")]))
+    return env
+
+
+def time_case(directory, case, mains, repeat):
+    """ The wall clock seconds of each of repeat runs of case in directory """
+    module, extraargv, allmains = CASES[case]
+    argv = ["--CTCACHE=None"] + extraargv + (mains if allmains else mains[:1])
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(
+            _command(module, argv),
+            cwd=directory,
+            env=_environment(),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError("{} failed in {}:\n{}".format(case, directory, result.stderr))
+    return times
+
+
+def run(sizes, cases, repeat, workdir=None, overrides=None, file=None):
+    """ Generate a project for each size and time each case over it.
+        Returns the results in the form that is written as JSON.
+    """
+    results = []
+    topdir = workdir if workdir is not None else tempfile.mkdtemp(prefix="ct-benchmark-")
+    try:
+        for size in sizes:
+            params = compiletools.benchmark.synthetic.parameters(size, **(overrides or {}))
+            directory = os.path.join(topdir, size)
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+            mains = compiletools.benchmark.synthetic.generate(directory, params)
+            _write_config(directory)
+            for case in cases:
+                times = time_case(directory, case, mains, repeat)
+                results.append(
+                    {
+                        "size": size,
+                        "case": case,
+                        "parameters": params,
+                        "times": [round(seconds, 4) for seconds in times],
+                        "min": round(min(times), 4),
+                        "median": round(statistics.median(times), 4),
+                    }
+                )
+                if file is not None:
+                    print("{:<8} {:<22} {:>8.3f}s".format(size, case, min(times)), file=file, flush=True)
+    finally:
+        if workdir is None:
+            shutil.rmtree(topdir, ignore_errors=True)
+
+    return {
+        "version": compiletools.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": round(time.time(), 3),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """ Compare the fastest time of each (size, case) against the baseline.
+        Returns (size, case, before, after, regressed) for every pair that is
+        in both and whose parameters are the same.
+    """
+    before = {(result["size"], result["case"]): result for result in baseline.get("results", [])}
+    comparison = []
+    for result in results["results"]:
+        old = before.get((result["size"], result["case"]))
+        if old is None or old.get("parameters") != result["parameters"]:
+            continue
+        regressed = result["min"] > old["min"] * threshold
+        comparison.append((result["size"], result["case"], old["min"], result["min"], regressed))
+    return comparison
+
+
+def add_arguments(cap):
+    cap.add(
+        "--sizes",
+        nargs="+",
+        choices=sorted(compiletools.benchmark.synthetic.SIZES),
+        default=["small", "medium"],
+        help="Which sizes of project to generate",
+    )
+    cap.add("--cases", nargs="+", choices=sorted(CASES), default=sorted(CASES), help="Which tool runs to time")
+    cap.add("--repeat", type=int, default=3, help="How many times to run each case")
+    for name, value in compiletools.benchmark.synthetic.DEFAULTS.items():
+        option = "--" + name.replace("_", "-")
+        cap.add(option, type=type(value), default=None, help="Override the {} of the generated projects".format(name))
+    cap.add("--output", default=None, help="Write the results as JSON to this file")
+    cap.add("--baseline", default=None, help="Compare the results against this JSON file from an earlier run")
+    cap.add(
+        "--threshold",
+        type=float,
+        default=1.1,
+        help="Report a regression if a case is this many times slower than the baseline",
+    )
+    cap.add("--workdir", default=None, help="Generate the projects here (and keep them) rather than in a temporary directory")
+
+
+def main(argv=None):
+    cap = compiletools.apptools.create_parser(
+        "Time the ct-* tools over generated C++ projects and compare against a baseline",
+        argv=argv,
+        include_config=False,
+    )
+    add_arguments(cap)
+    args = cap.parse_args(args=argv)
+
+    overrides = {name: getattr(args, name) for name in compiletools.benchmark.synthetic.DEFAULTS}
+    results = run(args.sizes, args.cases, args.repeat, workdir=args.workdir, overrides=overrides, file=sys.stdout)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as ff:
+            json.dump(results, ff, indent=1)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline, encoding="utf-8") as ff:
+        baseline = json.load(ff)
+    comparison = compare(results, baseline, args.threshold)
+    if not comparison:
+        print("Nothing in common with the baseline {}".format(args.baseline))
+        return 0
+    print("\nCompared with {}:".format(args.baseline))
+    for size, case, before, after, regressed in comparison:
+        print(
+            "{:<8} {:<22} {:>8.3f}s -> {:>8.3f}s  {:+6.1f}%{}".format(
+                size, case, before, after, 100.0 * (after - before) / before if before else 0.0, "  REGRESSION" if regressed else ""
+            )
+        )
+    return 1 if any(regressed for *_, regressed in comparison) else 0
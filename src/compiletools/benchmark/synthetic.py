@@ -0,0 +1,137 @@
+""" Generate synthetic C++ projects for benchmarking.
+
+    The headers are arranged in levels.  Each header includes fanout
+    headers from the next level down so depth is the length of the longest
+    include chain.  Each source includes fanout headers from the top level.
+    The first mains sources have a main() and every other source is pulled
+    in by a chain of //#SOURCE= magic comments (source_chain long) that
+    starts in a top level header.  A fraction (conditional_density) of the
+    includes are inside #if blocks, half of which are never taken, and a
+    fraction (magic_density) of the files carry //#CXXFLAGS= and
+    //#LDFLAGS= magic flags.
+
+    The same parameters (including the seed) always give the same project.
+"""
+import os
+import random
+
+# The shape of the generated project.  sources and headers are overridden by the sizes.
+DEFAULTS = {
+    "sources": 20,
+    "headers": 50,
+    "mains": 2,
+    "fanout": 4,
+    "depth": 4,
+    "conditional_density": 0.2,
+    "magic_density": 0.1,
+    "source_chain": 3,
+    "seed": 1,
+}
+
+SIZES = {
+    "small": {"sources": 20, "headers": 50},
+    "medium": {"sources": 200, "headers": 500},
+    "large": {"sources": 1000, "headers": 5000},
+}
+
+
+def parameters(size=None, **overrides):
+    """ DEFAULTS updated by the named size and then by overrides (ignoring Nones) """
+    result = dict(DEFAULTS)
+    if size is not None:
+        result.update(SIZES[size])
+    result.update({key: value for key, value in overrides.items() if value is not None})
+    result["mains"] = max(1, min(result["mains"], result["sources"]))
+    result["depth"] = max(1, min(result["depth"], result["headers"]))
+    return result
+
+
+def _header_name(index):
+    return "h{}.hpp".format(index)
+
+
+def _source_name(index):
+    return "s{}.cpp".format(index)
+
+
+class _Writer:
+    def __init__(self, params):
+        self.params = params
+        self.random = random.Random(params["seed"])
+        self.conditionals = 0
+
+    def _magic(self, index):
+        lines = []
+        if self.random.random() < self.params["magic_density"]:
+            lines.append("//#CXXFLAGS=-DBENCH_FLAG_{}".format(index))
+            if index % 2:
+                lines.append("//#LDFLAGS=-lm")
+        return lines
+
+    def _include(self, path):
+        line = '#include "{}"'.format(path)
+        if self.random.random() >= self.params["conditional_density"]:
+            return [line]
+        self.conditionals += 1
+        if self.conditionals % 2:
+            return ["#if __cplusplus >= 201103L", line, "#endif"]
+        return ["#ifdef BENCH_NEVER_DEFINED", line, "#endif"]
+
+    def _includes(self, candidates, prefix=""):
+        count = min(self.params["fanout"], len(candidates))
+        lines = []
+        for index in sorted(self.random.sample(candidates, count)):
+            lines.extend(self._include(prefix + _header_name(index)))
+        return lines
+
+    def levels(self):
+        """ The header indices at each level, top level first """
+        headers, depth = self.params["headers"], self.params["depth"]
+        return [list(range(headers * level // depth, headers * (level + 1) // depth)) for level in range(depth)]
+
+
+def generate(directory, params):
+    """ Write the project described by params (see parameters()) into
+        directory.  Returns the relative paths of the sources that have a main().
+    """
+    writer = _Writer(params)
+    levels = writer.levels()
+    srcdir = os.path.join(directory, "src")
+    includedir = os.path.join(directory, "include")
+    os.makedirs(srcdir, exist_ok=True)
+    os.makedirs(includedir, exist_ok=True)
+
+    # The sources without a main() in chains of //#SOURCE=, each started by a top level header
+    libraries = list(range(params["mains"], params["sources"]))
+    chainlength = max(1, params["source_chain"])
+    chains = [libraries[start : start + chainlength] for start in range(0, len(libraries), chainlength)]
+    chainstarts = {}
+    for chainindex, chain in enumerate(chains):
+        chainstarts.setdefault(levels[0][chainindex % len(levels[0])], []).append(chain[0])
+    nextinchain = {chain[ii]: chain[ii + 1] for chain in chains for ii in range(len(chain) - 1)}
+
+    for level, indices in enumerate(levels):
+        below = levels[level + 1] if level + 1 < len(levels) else []
+        for index in indices:
+            lines = ["#pragma once"]
+            lines.extend(writer._magic(index))
+            lines.extend("//#SOURCE=../src/" + _source_name(source) for source in chainstarts.get(index, []))
+            lines.extend(writer._includes(below) if below else ["#include <cstddef>"])
+            lines.append("inline int h{0}() {{ return {0}; }}".format(index))
+            with open(os.path.join(includedir, _header_name(index)), "w", encoding="utf-8") as ff:
+                ff.write("\n".join(lines) + "\n")
+
+    mains = []
+    for index in range(params["sources"]):
+        lines = writer._magic(index)
+        if index in nextinchain:
+            lines.append("//#SOURCE=" + _source_name(nextinchain[index]))
+        lines.extend(writer._includes(levels[0], prefix="../include/"))
+        if index < params["mains"]:
+            lines.append("int main() { return 0; }")
+            mains.append(os.path.join("src", _source_name(index)))
+        else:
+            lines.append("int s{0}() {{ return {0}; }}".format(index))
+        with open(os.path.join(srcdir, _source_name(index)), "w", encoding="utf-8") as ff:
+            ff.write("\n".join(lines) + "\n")
+    return mains
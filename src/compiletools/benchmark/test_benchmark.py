@@ -0,0 +1,54 @@
+import os
+import filecmp
+
+import compiletools.benchmark.runner
+import compiletools.benchmark.synthetic
+import compiletools.testhelper as uth
+
+
+def _tiny(**overrides):
+    return compiletools.benchmark.synthetic.parameters(sources=6, headers=12, mains=2, depth=3, fanout=2, **overrides)
+
+
+def test_generate_is_reproducible():
+    with uth.TempDirContextNoChange() as first, uth.TempDirContextNoChange() as second:
+        params = _tiny(conditional_density=0.5, magic_density=0.5)
+        mains = compiletools.benchmark.synthetic.generate(first, params)
+        assert mains == compiletools.benchmark.synthetic.generate(second, params)
+        assert mains == [os.path.join("src", "s0.cpp"), os.path.join("src", "s1.cpp")]
+
+        for subdir in ("src", "include"):
+            names = sorted(os.listdir(os.path.join(first, subdir)))
+            assert len(names) == {"src": 6, "include": 12}[subdir]
+            _, mismatch, errors = filecmp.cmpfiles(os.path.join(first, subdir), os.path.join(second, subdir), names, shallow=False)
+            assert mismatch == errors == []
+
+        contents = ""
+        for subdir in ("src", "include"):
+            for name in os.listdir(os.path.join(first, subdir)):
+                with open(os.path.join(first, subdir, name)) as ff:
+                    contents += ff.read()
+        assert "//#SOURCE=" in contents
+        assert "//#CXXFLAGS=" in contents
+        assert "#ifdef BENCH_NEVER_DEFINED" in contents
+
+
+def test_run_and_compare():
+    with uth.TempDirContextNoChange() as workdir:
+        overrides = dict(sources=6, headers=12, mains=2, depth=3, fanout=2)
+        results = compiletools.benchmark.runner.run(
+            ["small"], ["cake_filelist_direct"], repeat=1, workdir=workdir, overrides=overrides
+        )
+        (result,) = results["results"]
+        assert result["case"] == "cake_filelist_direct"
+        assert result["parameters"]["sources"] == 6
+        assert result["min"] > 0
+
+        faster = {"results": [dict(result, min=result["min"] / 2)]}
+        ((size, case, before, after, regressed),) = compiletools.benchmark.runner.compare(results, faster, 1.1)
+        assert (size, case, regressed) == ("small", "cake_filelist_direct", True)
+        assert not compiletools.benchmark.runner.compare(results, results, 1.1)[0][4]
+
+        # Different projects can't be compared
+        other = {"results": [dict(result, parameters=dict(result["parameters"], seed=2))]}
+        assert compiletools.benchmark.runner.compare(results, other, 1.1) == []
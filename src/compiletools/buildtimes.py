@@ -0,0 +1,164 @@
+"""The build timing database.
+
+The backends record how long each target took to build (the ninja backend
+from .ninja_log, the make backend from the log that its recipes write when
+--time is given, the native backend directly).  With --time, ct-cake also
+records how long each of its own phases took.  When a cache directory is
+configured (see compiletools.dirnamer.user_cache_dir) all of this is kept in
+buildtimes.json so that the next build can start the slowest chains of work
+first and so that ct-timing-report can show where the time goes.
+"""
+
+import os
+import json
+import time
+from typing import Dict, List, Optional
+
+import compiletools.dirnamer
+
+_CACHE_FILENAME = "buildtimes.json"
+
+# How many durations to remember for each target
+_HISTORY = 20
+
+# How many runs of ct-cake --time to remember
+_RUNS = 100
+
+# How many of the most recent durations are averaged for the expected duration
+_RECENT = 3
+
+
+def _average_of_recent(samples):
+    recent = samples[-_RECENT:]
+    return sum(seconds for _, seconds in recent) / len(recent)
+
+
+def cachefile(argv=None):
+    """buildtimes.json in the cache directory, or None if caching is disabled"""
+    cachedir = compiletools.dirnamer.user_cache_dir(appname="ct", argv=argv)
+    if cachedir == "None":
+        return None
+    return os.path.join(cachedir, _CACHE_FILENAME)
+
+
+def _load(filename):
+    if filename:
+        try:
+            with open(filename, encoding="utf-8") as ff:
+                data = json.load(ff)
+            return data.get("targets", {}), data.get("runs", [])
+        except (OSError, ValueError, AttributeError):
+            pass
+    return {}, []
+
+
+class BuildTimes:
+    """The recent (time, seconds) samples of each target, oldest first, and
+    the phase timings of recent runs.  Targets are keyed on their absolute
+    path so that projects that use the same relative bin directory don't
+    collide.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename if filename is not None else cachefile()
+        self.targets: Dict[str, List[list]]
+        self.runs: List[dict]
+        self.targets, self.runs = _load(self.filename)
+        # Every sample recorded by this build has the same time
+        self.time = round(time.time(), 3)
+        # What this process has recorded, to be merged into the file on save
+        self._newsamples: Dict[str, List[list]] = {}
+        self._newruns: List[dict] = []
+        self._default: Optional[float] = None
+
+    def __bool__(self):
+        return bool(self.targets)
+
+    def samples(self, target) -> List[list]:
+        return self.targets.get(os.path.abspath(target), [])
+
+    def expected(self, target) -> Optional[float]:
+        """The expected duration of target, or None if it has never been built"""
+        samples = self.samples(target)
+        if not samples:
+            return None
+        return _average_of_recent(samples)
+
+    def default(self) -> float:
+        """The duration to assume for a target that has never been built"""
+        if self._default is None:
+            expected = [_average_of_recent(samples) for samples in self.targets.values() if samples]
+            self._default = sum(expected) / len(expected) if expected else 1.0
+        return self._default
+
+    def record(self, target, seconds):
+        sample = [self.time, round(seconds, 3)]
+        target = os.path.abspath(target)
+        for samples in (self.targets.setdefault(target, []), self._newsamples.setdefault(target, [])):
+            samples.append(sample)
+            del samples[:-_HISTORY]
+        self._default = None
+
+    def record_run(self, phases, **details):
+        """Record ct's own phase timings (operation name -> seconds)"""
+        run = dict(details, time=self.time, phases={name: round(seconds, 6) for name, seconds in phases.items()})
+        self.runs.append(run)
+        del self.runs[:-_RUNS]
+        self._newruns.append(run)
+
+    def record_log(self, logfile, offset=0):
+        """Record the jobs in a log in .ninja_log format from byte offset
+        onwards (i.e., the jobs run since the log was that size).  Returns
+        the number of jobs recorded.
+        """
+        try:
+            with open(logfile, encoding="utf-8") as ff:
+                if offset > os.fstat(ff.fileno()).st_size:
+                    # ninja recompacted the log
+                    offset = 0
+                ff.seek(offset)
+                lines = ff.read().splitlines()
+        except OSError:
+            return 0
+
+        # An output can appear more than once.  The last entry wins.
+        jobs = {}
+        for line in lines:
+            if line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            if len(fields) != 5:
+                continue
+            try:
+                start, end = int(fields[0]), int(fields[1])
+            except ValueError:
+                continue
+            jobs[fields[3]] = (end - start) / 1000.0
+        for target, seconds in jobs.items():
+            self.record(target, seconds)
+        return len(jobs)
+
+    def save(self):
+        """Merge what this process recorded into the file.  Other builds
+        may have saved since it was loaded.
+        """
+        if not self.filename or not (self._newsamples or self._newruns):
+            return
+        targets, runs = _load(self.filename)
+        for target, newsamples in self._newsamples.items():
+            samples = targets.setdefault(target, [])
+            samples.extend(newsamples)
+            del samples[:-_HISTORY]
+        runs.extend(self._newruns)
+        del runs[:-_RUNS]
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmpfile = f"{self.filename}.{os.getpid()}"
+            with open(tmpfile, "w", encoding="utf-8") as ff:
+                json.dump({"targets": targets, "runs": runs}, ff)
+            os.replace(tmpfile, self.filename)
+        except OSError:
+            return
+        self.targets, self.runs = targets, runs
+        self._newsamples = {}
+        self._newruns = []
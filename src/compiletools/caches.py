@@ -0,0 +1,281 @@
+""" The registry of the in-memory caches.
+
+    Every memoized function, method or cache dictionary in compiletools
+    registers here under a short name (e.g., "wrappedos.realpath" or
+    "headerdeps.DirectHeaderDeps._find_include_in") so that
+
+    * clear_all() clears every cache and evict(paths) drops just the
+      entries about the given files, which long lived processes such as
+      ct-served and watch mode use between builds
+    * stats() gives the hits, misses and size of each cache
+    * the maxsize of each lru cache and LRUDict can be set with
+      --cache-maxsize, e.g., in ct.conf
+      "cache-maxsize = [wrappedos.*=100000, namer.*=None]".
+      The caches are unbounded by default.
+"""
+import fnmatch
+import functools
+import importlib
+import threading
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class LRUDict(OrderedDict):
+    """ A dict for use as a cache.  It is unbounded until it is given a
+        maxsize, after which it forgets the least recently used entries.
+    """
+
+    def __init__(self, maxsize=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if self.maxsize is not None:
+            try:
+                self.move_to_end(key)
+            except KeyError:
+                # Evicted by another thread in the meantime
+                pass
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if self.maxsize is not None:
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        if maxsize is not None:
+            self._evict()
+
+
+class _Storage:
+    """ A registered dict or set that is used as a cache """
+
+    def __init__(self, storage, clear, path):
+        self.storage = storage
+        self._clear = clear if clear is not None else storage.clear
+        self._path = path
+
+    def cache_clear(self):
+        self._clear()
+
+    def cache_info(self):
+        return CacheInfo(None, None, getattr(self.storage, "maxsize", None), len(self.storage))
+
+    def resizable(self):
+        return isinstance(self.storage, LRUDict)
+
+    def resize(self, maxsize):
+        self.storage.resize(maxsize)
+
+    def evict(self, paths):
+        if self._path is None:
+            return
+        for key in [key for key in list(self.storage) if self._path(key) in paths]:
+            self.storage.pop(key, None)
+
+
+class _Memoized:
+    """ The lru cache of a function memoized by cached().  The function
+        that cached() returns always calls through here so that the lru
+        cache can be replaced by one of a different maxsize without having
+        to find every reference to the function.
+    """
+
+    def __init__(self, func, maxsize):
+        self.func = func
+        self.lru = functools.lru_cache(maxsize=maxsize)(func)
+
+    def cache_clear(self):
+        self.lru.cache_clear()
+
+    def cache_info(self):
+        return self.lru.cache_info()
+
+    def resizable(self):
+        return True
+
+    def resize(self, maxsize):
+        """ Replace the lru cache, which empties it """
+        self.lru = functools.lru_cache(maxsize=maxsize)(self.func)
+
+
+class _Entry:
+    __slots__ = ("cache", "method")
+
+    def __init__(self, cache, method):
+        self.cache = cache
+        self.method = method
+
+
+# name -> _Entry
+_registry = OrderedDict()
+
+
+def cache_name(func):
+    """ The name that a cache on func is registered under by default """
+    module = func.__module__
+    if module.startswith("compiletools."):
+        module = module[len("compiletools.") :]
+    return "{}.{}".format(module, func.__qualname__)
+
+
+def cached(maxsize=None, name=None, method=None):
+    """ Decorator that memoizes a function or method with functools.lru_cache
+        and registers the cache.  Use instead of functools.lru_cache.
+        method is whether the keys include the self of a method and
+        defaults to whether func is defined in a class.  Pass False for a
+        staticmethod.
+    """
+
+    def decorator(func):
+        memoized = _Memoized(func, maxsize)
+
+        @functools.wraps(func)
+        def memoizer(*args, **kwargs):
+            return memoized.lru(*args, **kwargs)
+
+        memoizer.cache_info = memoized.cache_info
+        memoizer.cache_clear = memoized.cache_clear
+        ismethod = "." in func.__qualname__ if method is None else method
+        _registry[name or cache_name(func)] = _Entry(memoized, method=ismethod)
+        return memoizer
+
+    return decorator
+
+
+def register(name, storage, clear=None, method=False, path=None):
+    """ Register a dict or set that is used as a cache.  clear defaults to
+        storage.clear.  Pass a function that does more if clearing the
+        storage isn't enough to forget everything.  method is whether the
+        keys include the self of a method.  path, if given, returns the
+        realpath of the file that a key is about, which lets evict() drop
+        the entries of changed files.  Only an LRUDict can be given a
+        maxsize by --cache-maxsize.
+    """
+    _registry[name] = _Entry(_Storage(storage, clear, path), method=method)
+
+
+def registered():
+    """ (name, cache) of every registered cache.  A cache is either an
+        lru_cache or has the dict or set that it uses as its storage attribute.
+    """
+    return [(name, getattr(entry.cache, "lru", entry.cache)) for name, entry in _registry.items()]
+
+
+def stats():
+    """ name -> CacheInfo (hits, misses, maxsize, currsize).  The hits and
+        misses of the registered dicts and sets are None.
+    """
+    return OrderedDict((name, CacheInfo(*entry.cache.cache_info())) for name, entry in _registry.items())
+
+
+def clear_all(methods_only=False):
+    """ Clear every registered cache.  methods_only clears just the caches
+        of methods, which are keyed on (and so keep alive) the objects of
+        earlier builds.
+    """
+    for entry in _registry.values():
+        if entry.method or not methods_only:
+            entry.cache.cache_clear()
+
+
+def evict(paths):
+    """ Drop the entries about any of the given realpaths from the caches
+        that were registered with a path function.  The other caches are
+        left alone.
+    """
+    paths = set(paths)
+    if not paths:
+        return
+    for entry in _registry.values():
+        if isinstance(entry.cache, _Storage):
+            entry.cache.evict(paths)
+
+
+# The modules that register caches.  A tool need not have imported all of
+# them but a pattern in ct.conf may name any of their caches.
+_OWNERS = (
+    "compiler_macros",
+    "diskcache",
+    "file_analyzer",
+    "git_utils",
+    "headerdeps",
+    "inotify",
+    "magicflags",
+    "namer",
+    "pkgconfig",
+    "simple_preprocessor",
+    "utils",
+    "wrappedos",
+)
+
+
+def _parse_maxsize(spec, value):
+    if value.strip() in ("None", "none", ""):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("--cache-maxsize expects NAME=SIZE but was given {}".format(spec))
+
+
+def configure(specs):
+    """ Apply "pattern=maxsize" specs, e.g., "wrappedos.*=100000".  Later
+        specs override earlier ones and maxsize None means unbounded.
+        Resizing an lru cache empties it and shrinking an LRUDict drops its
+        least recently used entries.  A malformed spec, a pattern that
+        matches no cache and giving a maxsize to a cache that cannot be
+        bounded (a plain dict or set) are all ValueErrors.
+    """
+    if specs:
+        for module in _OWNERS:
+            importlib.import_module("compiletools." + module)
+
+    wanted = {}
+    for spec in specs or ():
+        pattern, separator, value = spec.partition("=")
+        if not separator:
+            raise ValueError("--cache-maxsize expects NAME=SIZE but was given {}".format(spec))
+        maxsize = _parse_maxsize(spec, value)
+        names = fnmatch.filter(_registry, pattern.strip())
+        if not names:
+            raise ValueError("--cache-maxsize {} matches no cache.  --memory-report lists the names".format(pattern.strip()))
+        for name in names:
+            wanted[name] = maxsize
+
+    unbounded = sorted(
+        name for name, maxsize in wanted.items() if maxsize is not None and not _registry[name].cache.resizable()
+    )
+    if unbounded:
+        raise ValueError("--cache-maxsize cannot bound {}".format(", ".join(unbounded)))
+
+    for name, maxsize in wanted.items():
+        entry = _registry[name]
+        if entry.cache.cache_info().maxsize != maxsize and entry.cache.resizable():
+            entry.cache.resize(maxsize)
+
+
+def add_arguments(cap):
+    cap.add(
+        "--cache-maxsize",
+        action="append",
+        metavar="NAME=SIZE",
+        help="Limit the in-memory cache NAME (a glob, e.g., wrappedos.*) to SIZE entries (None for unbounded).  May be repeated.  --memory-report lists the names.",
+    )
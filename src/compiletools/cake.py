@@ -3,19 +3,30 @@ import sys
 import configargparse
 import subprocess
 import os
+import time
 from io import open
 import shutil
 import compiletools.utils
+import compiletools.buildtimes
 import compiletools.apptools
+import compiletools.caches
+import compiletools.compiler_macros
+import compiletools.memory
 import compiletools.headerdeps
 import compiletools.magicflags
 import compiletools.hunter
 import compiletools.makefile
+import compiletools.ninjafile
+import compiletools.executor
 import compiletools.filelist
 import compiletools.findtargets
+import compiletools.git_utils
+import compiletools.inotify
 import compiletools.jobs
 import compiletools.wrappedos
 import compiletools.timing
+import compiletools.served
+import compiletools.watch
 
 
 class Cake(object):
@@ -25,6 +36,8 @@ class Cake(object):
         self.headerdeps = None
         self.magicparser = None
         self.hunter = None
+        # The objects that the build rules compile (for --time-trace)
+        self.objects = set()
 
     @staticmethod
     def _hide_makefilename(args):
@@ -100,6 +113,25 @@ class Cake(object):
 
         cap.add("--clean", action="store_true", help="Agressively cleanup.")
 
+        cap.add(
+            "--backend",
+            choices=["make", "ninja", "native"],
+            default="make",
+            help="How to run the build. make writes a Makefile and runs make. ninja writes a build.ninja and runs ninja. native runs the same rules directly, in process, scheduling the critical path first.",
+        )
+
+        cap.add(
+            "--server",
+            action="store_true",
+            help="Send the build to ct-served, which keeps its caches warm between builds. Only honoured on the command line.",
+        )
+
+        cap.add(
+            "--watch",
+            action="store_true",
+            help="Build, then rebuild the affected targets whenever a file they depend on changes. Only honoured on the command line.",
+        )
+
         cap.add(
             "-o",
             "--output",
@@ -162,6 +194,23 @@ class Cake(object):
             makefile_creator = compiletools.makefile.MakefileCreator(self.args, self.hunter)
             makefilename = makefile_creator.create()
             os.makedirs(self.namer.executable_dir(), exist_ok=True)
+        self.objects = makefile_creator.objects
+        # With --time the recipes log how long they took
+        timinglog = compiletools.makefile.timing_log(self.namer)
+        if self.args.time:
+            try:
+                os.unlink(timinglog)
+            except OSError:
+                pass
+        try:
+            self._runmake()
+        finally:
+            if self.args.time and makefile_creator.buildtimes.record_log(timinglog):
+                makefile_creator.buildtimes.save()
+
+        self._postbuild()
+
+    def _runmake(self):
         with compiletools.timing.time_operation("makefile_execution"):
             cmd = ["make"]
             if self.args.verbose <= 1:
@@ -203,6 +252,68 @@ class Cake(object):
                 with compiletools.timing.time_operation("make_runtests"):
                     subprocess.check_call(cmd, universal_newlines=True)
 
+    def _callninja(self):
+        with compiletools.timing.time_operation("ninjafile_creation"):
+            ninja_creator = compiletools.ninjafile.NinjaCreator(self.args, self.hunter)
+            ninja_creator.create()
+            os.makedirs(self.namer.executable_dir(), exist_ok=True)
+        self.objects = ninja_creator.objects
+        with compiletools.timing.time_operation("ninja_execution"):
+            cmd = ["ninja", "-f", ninja_creator.filename(), "-j", str(self.args.parallel)]
+            # Only the jobs appended to the log by this build are new
+            ninjalog = os.path.join(os.path.dirname(ninja_creator.filename()), ".ninja_log")
+            try:
+                ninjalogsize = os.path.getsize(ninjalog)
+            except OSError:
+                ninjalogsize = 0
+            if self.args.verbose >= 2:
+                cmd.append("-v")
+            if self.args.verbose >= 4:
+                cmd.extend(["-d", "explain"])
+            goals = ["realclean"] if self.args.clean else ["build"]
+            if self.args.tests and not self.args.clean:
+                goals.append("runtests")
+            try:
+                for goal in goals:
+                    if self.args.verbose >= 1:
+                        print(" ".join(cmd + [goal]))
+                    with compiletools.timing.time_operation("ninja_" + goal):
+                        subprocess.check_call(cmd + [goal], universal_newlines=True)
+            finally:
+                if not self.args.clean and ninja_creator.buildtimes.record_log(ninjalog, ninjalogsize):
+                    ninja_creator.buildtimes.save()
+
+        self._postbuild()
+
+    def _callnative(self):
+        """ Run the rules that would have gone into the Makefile directly """
+        with compiletools.timing.time_operation("rule_creation"):
+            makefile_creator = compiletools.makefile.MakefileCreator(self.args, self.hunter)
+            rules = makefile_creator.create_rules()
+        self.objects = makefile_creator.objects
+        executor = compiletools.executor.NativeExecutor(self.args, rules, makefile_creator.buildtimes)
+        try:
+            with compiletools.timing.time_operation("native_execution"):
+                if self.args.clean:
+                    executor.build("realclean")
+                else:
+                    executor.build("build")
+                    if self.args.tests:
+                        with compiletools.timing.time_operation("native_runtests"):
+                            executor.build("runtests")
+        finally:
+            if self.args.time:
+                executor.report()
+            for target, elapsed in executor.durations.items():
+                if not rules[target].phony:
+                    makefile_creator.buildtimes.record(target, elapsed)
+            if executor.durations:
+                makefile_creator.buildtimes.save()
+
+        self._postbuild()
+
+    def _postbuild(self):
+        """ Tidy up after the build products have been made (or cleaned) """
         if self.args.clean:
             # Remove the extra executables we copied
             if self.args.output:
@@ -270,24 +381,93 @@ class Cake(object):
         if self.args.filelist:
             with compiletools.timing.time_operation("filelist_generation"):
                 self._callfilelist()
+        elif self.args.backend == "native":
+            self._callnative()
+        elif self.args.backend == "ninja":
+            self._callninja()
         else:
             self._callmakefile()
 
     def clear_cache(self):
         """ Only useful in test scenarios where you need to reset to a pristine state """
-        compiletools.wrappedos.clear_cache()
-        compiletools.utils.clear_cache()
-        compiletools.git_utils.clear_cache()
+        compiletools.caches.clear_all()
         self.namer.clear_cache()
         self.hunter.clear_cache()
         compiletools.magicflags.MagicFlagsBase.clear_cache()
 
 
+def clear_instance_caches():
+    """ lru_caches on methods are keyed on self.  Long lived processes that
+        run many builds (ct-served, ct-cake --watch) call this after each
+        build so that the objects of old builds can be freed.
+    """
+    compiletools.caches.clear_all(methods_only=True)
+
+
+def forget_changed_files(changes):
+    """ Long lived processes that run many builds (ct-served, ct-cake --watch)
+        call this before a build with the (path, mask) changes that inotify
+        reported since the last one, or None if anything may have changed.
+
+        The analysis of the files themselves (file contents, preprocessing
+        passes, magic flags) is keyed on their mtimes so only the entries
+        of the changed files are dropped.  The stat caches are cheap to
+        refill and are cleared, as are the include lookups if files were
+        added or removed.
+    """
+    if changes is not None and not changes:
+        return
+    compiletools.wrappedos.clear_cache()
+    compiletools.utils.clear_cache()
+    if changes is None:
+        compiletools.headerdeps.DirectHeaderDeps.clear_include_cache()
+        compiletools.git_utils.clear_cache()
+        return
+
+    compiletools.caches.evict(path for path, _ in changes)
+    if any(mask & compiletools.inotify.STRUCTURE_MASK for _, mask in changes):
+        compiletools.headerdeps.DirectHeaderDeps.clear_include_cache()
+    if any(os.path.basename(path) == ".git" for path, _ in changes):
+        compiletools.git_utils.clear_cache()
+
+
 def signal_handler(signal, frame):
     sys.exit(0)
 
 
-def main(argv=None):
+def _write_time_trace(args, cake, started, wallstarted):
+    """ Write the --time-trace file.  started and wallstarted are the
+        time.perf_counter() and time.time() when the build began.
+    """
+    timer = compiletools.timing.get_timer()
+    for start, end, description, thread_id, thread_name in compiletools.compiler_macros.probe_spans(started):
+        timer.record_span("compiler_probe", start, end, description, thread_id, thread_name)
+
+    # clang -ftime-trace writes foo.json next to foo.o
+    compiler_traces = []
+    for obj in sorted(cake.objects if cake is not None else ()):
+        tracefile = os.path.splitext(obj)[0] + ".json"
+        try:
+            if os.path.getmtime(tracefile) >= wallstarted:
+                compiler_traces.append(tracefile)
+        except OSError:
+            pass
+    try:
+        timer.write_trace(args.time_trace, compiler_traces)
+    except OSError as err:
+        print("Failed to write the time trace: {}".format(err), file=sys.stderr)
+        return
+    if args.verbose >= 1:
+        print("Wrote the time trace to {}".format(args.time_trace))
+
+
+def build(argv=None, keep_cache=False):
+    """ Parse argv and build.  Returns (returncode, cake), where cake is
+        None if there was nothing to do.  ct-served passes keep_cache=True
+        so that the caches stay warm for the next build.
+    """
+    started = time.perf_counter()
+    wallstarted = time.time()
     cap = compiletools.apptools.create_parser(
         "A convenience tool to aid migration from cake to the ct-* tools", argv=argv
     )
@@ -298,38 +478,71 @@ def main(argv=None):
 
     # Initialize timing if enabled
     timing_enabled = hasattr(args, 'time') and args.time
-    compiletools.timing.initialize_timer(timing_enabled)
+    compiletools.timing.initialize_timer(
+        timing_enabled or bool(args.time_trace), per_file=args.time_per_file, trace=bool(args.time_trace)
+    )
+    # The arguments were parsed before the timer existed
+    compiletools.timing.get_timer().record_span("argument_parsing", started, time.perf_counter())
 
     if not any([args.filename, args.static, args.dynamic, args.tests, args.auto]):
         print(
             "Nothing for cake to do.  Did you mean cake --auto? Use cake --help for help."
         )
-        return 0
+        return 0, None
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGPIPE, signal_handler)
 
+    cake = None
     try:
         cake = Cake(args)
-        with compiletools.timing.time_operation("total_build_time"):
-            cake.process()
+        try:
+            with compiletools.timing.time_operation("total_build_time"):
+                cake.process()
+        finally:
+            if args.time_trace:
+                _write_time_trace(args, cake, started, wallstarted)
+        compiletools.memory.checkpoint()
         # For testing purposes, clear out the memcaches for the times when main is called more than once.
-        cake.clear_cache()
+        if not keep_cache:
+            cake.clear_cache()
     except IOError as ioe:
         if args.verbose < 2:
             print(" ".join(["Error processing", ioe.filename, ". Does it exist?"]))
-            return 1
+            return 1, cake
         else:
             raise
     except Exception as err:
         if args.verbose < 2:
             print(err)
-            return 1
+            return 1, cake
         else:
             raise
     
     # Report timing information if enabled
     if timing_enabled:
         compiletools.timing.report_timing(args.verbose)
+        buildtimes = compiletools.buildtimes.BuildTimes()
+        buildtimes.record_run(compiletools.timing.get_timer().timings, cwd=os.getcwd(), backend=args.backend)
+        buildtimes.save()
+
+    return 0, cake
+
+
+def main(argv=None):
+    serverargv = sys.argv[1:] if argv is None else argv
+    if "--watch" in serverargv:
+        return compiletools.watch.main([arg for arg in serverargv if arg != "--watch"])
+
+    if "--server" in serverargv:
+        returncode = compiletools.served.request([arg for arg in serverargv if arg != "--server"])
+        if returncode is not None:
+            return returncode
+        print(
+            "ct-cake --server could not connect to ct-served at {}.  Building without it.".format(
+                compiletools.served.default_socket_path()
+            ),
+            file=sys.stderr,
+        )
 
-    return 0
+    return build(argv)[0]
@@ -2,33 +2,258 @@
 
 This module queries compilers for their predefined macros rather than
 hardcoding them, allowing automatic adaptation to new compiler versions.
+
+Querying forks the compiler so, when a cache directory is configured (see
+compiletools.dirnamer.user_cache_dir), the answer is also stored on disk.
+The cache file is keyed on the identity of the resolved compiler binary
+(path, size, mtime and GNU build-id), so replacing or upgrading the
+compiler is picked up without any explicit invalidation.
+
+prefetch_compiler_macros() starts a probe in a background thread so that,
+for example, the compiler runs while the rest of the arguments are being
+processed.  get_compiler_macros() then waits for that probe rather than
+starting another.
 """
 
+import os
+import re
+import json
+import shutil
+import struct
+import time
+import hashlib
+import threading
 import subprocess
-from functools import lru_cache
-from typing import Dict
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
+
+import compiletools.caches
+import compiletools.dirnamer
+
+# Flags that change what the compiler predefines, e.g., -std=c++20 sets
+# __cplusplus, -mavx2 sets __AVX2__, -O2 sets __OPTIMIZE__ and -fopenmp sets _OPENMP
+_MACRO_RELEVANT_FLAG = re.compile(r"-std=\S+|-m\S+|-f\S+|-O\S*|-ansi|-pthread")
+
+# (compiler_path, flags, language) -> Future of the probes started by prefetch_compiler_macros
+_prefetched: Dict[tuple, Future] = {}
+_prefetched_lock = threading.Lock()
+
+# compiler_path -> _compiler_identity when it was last probed (see revalidate)
+_identities: Dict[str, Optional[list]] = {}
+
+# (start, end, description, thread id, thread name) of the recent compiler
+# runs.  Most probes run before ct-cake has set up its timer, so it collects
+# these afterwards (see probe_spans).
+_probes = []
+_probes_lock = threading.Lock()
+
+_PT_NOTE = 4
+_NT_GNU_BUILD_ID = 3
+
+
+def macro_relevant_flags(*flagsets) -> Tuple[str, ...]:
+    """Return the flags, in order, that affect the predefined macros.
+    Each argument may be a string of flags or a list of flags.
+    """
+    relevant = []
+    for flags in flagsets:
+        if not flags:
+            continue
+        if isinstance(flags, str):
+            flags = flags.split()
+        else:
+            flags = [flag for item in flags for flag in item.split()]
+        relevant.extend(flag for flag in flags if _MACRO_RELEVANT_FLAG.fullmatch(flag))
+    return tuple(relevant)
+
+
+def _build_id(realpath: str) -> str:
+    """Return the hex GNU build-id of an ELF executable, or "" if there is none"""
+    try:
+        with open(realpath, "rb") as ff:
+            ident = ff.read(16)
+            if len(ident) < 16 or ident[:4] != b"\x7fELF":
+                return ""
+            is64 = ident[4] == 2
+            endian = "<" if ident[5] == 1 else ">"
+            if is64:
+                header = ff.read(48)
+                phoff, = struct.unpack_from(endian + "Q", header, 16)
+                phentsize, phnum = struct.unpack_from(endian + "HH", header, 38)
+            else:
+                header = ff.read(36)
+                phoff, = struct.unpack_from(endian + "I", header, 12)
+                phentsize, phnum = struct.unpack_from(endian + "HH", header, 26)
+
+            for index in range(phnum):
+                ff.seek(phoff + index * phentsize)
+                phdr = ff.read(phentsize)
+                if struct.unpack_from(endian + "I", phdr, 0)[0] != _PT_NOTE:
+                    continue
+                if is64:
+                    offset, = struct.unpack_from(endian + "Q", phdr, 8)
+                    size, = struct.unpack_from(endian + "Q", phdr, 32)
+                else:
+                    offset, = struct.unpack_from(endian + "I", phdr, 4)
+                    size, = struct.unpack_from(endian + "I", phdr, 16)
+                ff.seek(offset)
+                notes = ff.read(size)
+                pos = 0
+                while pos + 12 <= len(notes):
+                    namesz, descsz, notetype = struct.unpack_from(endian + "III", notes, pos)
+                    pos += 12
+                    name = notes[pos:pos + namesz]
+                    pos += (namesz + 3) & ~3
+                    desc = notes[pos:pos + descsz]
+                    pos += (descsz + 3) & ~3
+                    if notetype == _NT_GNU_BUILD_ID and name.rstrip(b"\0") == b"GNU":
+                        return desc.hex()
+    except (OSError, struct.error):
+        pass
+    return ""
+
+
+def _compiler_identity(compiler_path: str) -> Optional[list]:
+    """What the cached macros of compiler_path depend on, or None if the
+    compiler cannot be found (in which case nothing is cached)
+    """
+    resolved = shutil.which(compiler_path)
+    if not resolved:
+        return None
+    realpath = os.path.realpath(resolved)
+    try:
+        stat = os.stat(realpath)
+    except OSError:
+        return None
+    return [compiler_path, realpath, stat.st_size, stat.st_mtime_ns, _build_id(realpath)]
+
+
+def _cachefile(identity: Optional[list], flags: Tuple[str, ...] = (), language: str = "c++") -> Optional[str]:
+    """The cache file for a compiler with the given _compiler_identity"""
+    cachedir = compiletools.dirnamer.user_cache_dir(appname="ct")
+    if cachedir == "None" or identity is None:
+        return None
+    identity = identity + [list(flags), language]
+    digest = hashlib.sha1(json.dumps(identity).encode("utf-8")).hexdigest()
+    return os.path.join(cachedir, "compiler_macros", digest + ".json")
+
+
+def _read_cachefile(cachefile: str) -> Optional[Dict[str, str]]:
+    try:
+        with open(cachefile, encoding="utf-8") as ff:
+            return json.load(ff)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cachefile(cachefile: str, macros: Dict[str, str]):
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        tmpfile = f"{cachefile}.{os.getpid()}"
+        with open(tmpfile, "w", encoding="utf-8") as ff:
+            json.dump(macros, ff)
+        os.replace(tmpfile, cachefile)
+    except OSError:
+        pass
 
 
-@lru_cache(maxsize=32)
-def get_compiler_macros(compiler_path: str, verbose: int = 0) -> Dict[str, str]:
+@compiletools.caches.cached(maxsize=32)
+def get_compiler_macros(
+    compiler_path: str, verbose: int = 0, flags: Tuple[str, ...] = (), language: str = "c++"
+) -> Dict[str, str]:
     """Query a compiler for its predefined macros.
     
     Args:
         compiler_path: Path to the compiler executable (e.g., 'gcc', 'clang')
         verbose: Verbosity level for debug output
+        flags: Tuple of flags to probe with, see macro_relevant_flags()
+        language: The -x language to probe as, "c++" or "c"
         
     Returns:
         Dictionary of macro names to their values
     """
+    key = (compiler_path, flags, language)
+    future = _prefetched.get(key)
+    if future is not None:
+        macros = future.result()
+        # The lru cache has the answer from now on
+        with _prefetched_lock:
+            if _prefetched.get(key) is future:
+                del _prefetched[key]
+        return macros
+    return _probe_compiler_macros(compiler_path, verbose, flags, language)
+
+
+def prefetch_compiler_macros(
+    compiler_path: str, verbose: int = 0, flags: Tuple[str, ...] = (), language: str = "c++"
+):
+    """Start get_compiler_macros(compiler_path, verbose, flags, language) in
+    the background.  The thread is a daemon so a tool that never asks for
+    the answer does not wait for it on exit.
+    """
+    if not compiler_path:
+        return
+    key = (compiler_path, flags, language)
+    with _prefetched_lock:
+        if key in _prefetched:
+            return
+        future = Future()
+        _prefetched[key] = future
+
+    def probe():
+        try:
+            future.set_result(_probe_compiler_macros(compiler_path, verbose, flags, language))
+        except BaseException as err:
+            future.set_exception(err)
+
+    if verbose >= 4:
+        print(f"Prefetching {language} macros from {compiler_path} {' '.join(flags)}")
+    threading.Thread(target=probe, name=f"prefetch {compiler_path}", daemon=True).start()
+
+
+def _probe_compiler_macros(
+    compiler_path: str, verbose: int = 0, flags: Tuple[str, ...] = (), language: str = "c++"
+) -> Dict[str, str]:
+    """The uncached body of get_compiler_macros"""
     if not compiler_path:
         if verbose >= 2:
             print("No compiler specified, returning empty macro dict")
         return {}
-    
+
+    identity = _compiler_identity(compiler_path)
+    with _prefetched_lock:
+        _identities[compiler_path] = identity
+    cachefile = _cachefile(identity, flags, language)
+    if cachefile:
+        macros = _read_cachefile(cachefile)
+        if macros is not None:
+            if verbose >= 3:
+                print(f"Read {len(macros)} macros for {compiler_path} from {cachefile}")
+            return macros
+
+    macros = _query_compiler_macros(compiler_path, verbose, flags, language)
+    if macros is None:
+        if flags:
+            # Better the plain compiler macros than none at all
+            if verbose >= 3:
+                print(f"Retrying {compiler_path} without {' '.join(flags)}")
+            return get_compiler_macros(compiler_path, verbose, (), language)
+        return {}
+    if cachefile:
+        _write_cachefile(cachefile, macros)
+    return macros
+
+
+def _query_compiler_macros(
+    compiler_path: str, verbose: int = 0, flags: Tuple[str, ...] = (), language: str = "c++"
+) -> Optional[Dict[str, str]]:
+    """Run the compiler to dump its predefined macros.  None on failure."""
+    start = time.perf_counter()
     try:
-        # Use -dM to dump macros, -E to preprocess only, - to read from stdin
+        # Use -dM to dump macros, -E to preprocess only, - to read from stdin.
+        # stdin is preprocessed as C, even by g++, unless -x says otherwise.
         result = subprocess.run(
-            [compiler_path, '-dM', '-E', '-'],
+            [compiler_path, '-x', language, *flags, '-dM', '-E', '-'],
             stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.DEVNULL,
@@ -39,7 +264,7 @@ def get_compiler_macros(compiler_path: str, verbose: int = 0) -> Dict[str, str]:
         if result.returncode != 0:
             if verbose >= 4:
                 print(f"Compiler {compiler_path} returned non-zero exit code: {result.returncode}")
-            return {}
+            return None
         
         macros = {}
         for line in result.stdout.splitlines():
@@ -66,9 +291,58 @@ def get_compiler_macros(compiler_path: str, verbose: int = 0) -> Dict[str, str]:
     except (subprocess.TimeoutExpired, FileNotFoundError, OSError) as e:
         if verbose >= 3:
             print(f"Failed to query macros from {compiler_path}: {e}")
-        return {}
+        return None
+    finally:
+        span = (
+            start,
+            time.perf_counter(),
+            " ".join([compiler_path, "-x", language, *flags]),
+            threading.get_native_id(),
+            threading.current_thread().name,
+        )
+        with _probes_lock:
+            _probes.append(span)
+
+
+def probe_spans(since=0.0):
+    """The compiler runs that started at or after since (a time.perf_counter()
+    value) as (start, end, description, thread id, thread name).  The runs
+    that started before since are forgotten.
+    """
+    with _probes_lock:
+        _probes[:] = [probe for probe in _probes if probe[0] >= since]
+        return list(_probes)
+
+
+def revalidate(verbose: int = 0) -> bool:
+    """Forget every probe if any compiler that was probed has been replaced,
+    upgraded or removed since.  Long lived processes (ct-served, --watch)
+    call this before each build.  Returns whether anything was forgotten.
+    """
+    with _prefetched_lock:
+        identities = list(_identities.items())
+    changed = [path for path, identity in identities if _compiler_identity(path) != identity]
+    if not changed:
+        return False
+    if verbose >= 1:
+        print(f"{' '.join(changed)} changed. Probing the compiler macros again")
+    clear_cache()
+    return True
 
 
 def clear_cache():
-    """Clear the LRU cache for get_compiler_macros."""
-    get_compiler_macros.cache_clear()
\ No newline at end of file
+    """Clear the LRU cache for get_compiler_macros and forget prefetched probes."""
+    with _prefetched_lock:
+        pending = list(_prefetched.values())
+        _prefetched.clear()
+    # Let outstanding probes finish so that they cannot race with whatever runs next
+    for future in pending:
+        future.exception()
+    get_compiler_macros.cache_clear()
+    with _prefetched_lock:
+        _identities.clear()
+    with _probes_lock:
+        _probes.clear()
+
+
+compiletools.caches.register("compiler_macros._prefetched", _prefetched, clear=clear_cache)
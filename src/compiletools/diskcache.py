@@ -3,6 +3,7 @@ from io import open
 import functools
 
 import pickle
+import compiletools.caches
 import compiletools.dirnamer
 from compiletools.memoize import memoize_false
 import compiletools.wrappedos
@@ -50,7 +51,8 @@ class diskcache:
 
         # Keep a copy of the cachefile in memory to reduce disk IO
         # Call it "cache" to match the memoizer "cache" (for ease of clearing)
-        self.cache = {}
+        self.cache = compiletools.caches.LRUDict()
+        compiletools.caches.register("diskcache." + cache_identifier, self.cache)
 
     def _cachefile(self, filename):
         """ What cachefile corresponds to the given filename """
@@ -207,8 +209,8 @@ class diskcache:
         try:
             if compiletools.dirnamer.user_cache_dir() == "None":
 
+                @compiletools.caches.cached()
                 @functools.wraps(func)
-                @functools.lru_cache(maxsize=None)
                 def memcacher(*args):
                     diskcache._instances[func] = self
                     return func(*args)
@@ -0,0 +1,243 @@
+""" Run the rules created by MakefileCreator directly, without make.
+
+    The rules are a DAG that is already in memory, so there is no Makefile
+    to write and parse and every file is stat'd once.  A target is remade
+    under the same conditions as make uses: it is phony, it doesn't exist,
+    or a prerequisite is phony or newer than it.  Order only prerequisites
+    are made first but never cause a remake.
+
+    Up to args.parallel recipes run at once.  When there is a choice, the
+    job with the longest chain of work remaining after it (the critical
+    path) is started first.  The length of the chain uses the durations
+    from previous builds when they are known.
+"""
+import os
+import sys
+import time
+import heapq
+import subprocess
+import concurrent.futures
+
+import compiletools.timing
+
+
+class Job(object):
+
+    """ A rule together with its place in the DAG """
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.target = rule.target
+        self.prerequisites = rule.prerequisites.split() if rule.prerequisites else []
+        self.order_only_prerequisites = (
+            rule.order_only_prerequisites.split() if rule.order_only_prerequisites else []
+        )
+        # Jobs that can't start until this one is finished
+        self.dependents = []
+        # Number of prerequisite jobs that haven't finished yet
+        self.waiting = 0
+        # Length of the longest chain of work from the start of this job to the goal
+        self.priority = 0.0
+        # Whether a failure of the recipe is ignored, i.e., it starts with "-"
+        self.ignore_errors = False
+
+
+def _shell_command(recipe):
+    """ Turn a make recipe line into (command, silent, ignore_errors) """
+    silent = False
+    ignore_errors = False
+    recipe = recipe.lstrip()
+    while recipe and recipe[0] in "@+-":
+        silent = silent or recipe[0] == "@"
+        ignore_errors = ignore_errors or recipe[0] == "-"
+        recipe = recipe[1:]
+    return recipe.replace("$$", "$"), silent, ignore_errors
+
+
+class NativeExecutor(object):
+
+    """ Make the given goal from rules (a dict of target -> Rule, as created
+        by MakefileCreator.create_rules) using a pool of worker threads that
+        each wait on one recipe's process.
+    """
+
+    def __init__(self, args, rules, buildtimes=None):
+        self.args = args
+        self.rules = rules
+        # compiletools.buildtimes.BuildTimes of previous builds
+        self.buildtimes = buildtimes
+        self._mtimes = {}
+        # target -> seconds that its recipe took
+        self.durations = {}
+
+    def _mtime(self, filename):
+        try:
+            return self._mtimes[filename]
+        except KeyError:
+            pass
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+        except OSError:
+            mtime = None
+        self._mtimes[filename] = mtime
+        return mtime
+
+    def _isphony(self, target):
+        rule = self.rules.get(target)
+        return rule is not None and rule.phony
+
+    def _create_jobs(self, goal):
+        """ Every job needed to make goal, ordered so that prerequisites come first """
+        jobs = {}
+        ordered = []
+        visiting = set()
+
+        def visit(target, needed_by):
+            if target in jobs:
+                return
+            rule = self.rules.get(target)
+            if rule is None:
+                if self._mtime(target) is None:
+                    raise RuntimeError(
+                        "No rule to make target '{}', needed by '{}'".format(target, needed_by)
+                    )
+                return
+            if target in visiting:
+                print("Circular dependency on {} dropped".format(target), file=sys.stderr)
+                return
+            visiting.add(target)
+            job = Job(rule)
+            for prerequisite in job.prerequisites + job.order_only_prerequisites:
+                visit(prerequisite, target)
+            visiting.discard(target)
+            jobs[target] = job
+            ordered.append(job)
+
+        visit(goal, goal)
+        for job in ordered:
+            for prerequisite in job.prerequisites + job.order_only_prerequisites:
+                if prerequisite in jobs:
+                    jobs[prerequisite].dependents.append(job)
+                    job.waiting += 1
+        return ordered
+
+    def _expected_duration(self, job):
+        """ How long job is likely to take.  Only relative sizes matter """
+        if not job.rule.recipe:
+            return 0.0
+        if self.buildtimes is None:
+            return 1.0
+        expected = self.buildtimes.expected(job.target)
+        if expected is None:
+            return self.buildtimes.default()
+        return expected
+
+    def _prioritise(self, ordered):
+        for job in reversed(ordered):
+            remaining = max((dependent.priority for dependent in job.dependents), default=0.0)
+            job.priority = self._expected_duration(job) + remaining
+
+    def _outofdate(self, job):
+        if job.rule.phony:
+            return True
+        targetmtime = self._mtime(job.target)
+        if targetmtime is None:
+            return True
+        for prerequisite in job.prerequisites:
+            if self._isphony(prerequisite):
+                return True
+            mtime = self._mtime(prerequisite)
+            if mtime is not None and mtime > targetmtime:
+                return True
+        return False
+
+    def _run(self, job, command):
+        start = time.perf_counter()
+        with compiletools.timing.time_operation("native_job", job.target):
+            returncode = subprocess.call(command, shell=True)
+        return returncode, time.perf_counter() - start
+
+    def build(self, goal):
+        """ Make goal.  Raises subprocess.CalledProcessError if a recipe fails """
+        ordered = self._create_jobs(goal)
+        self._prioritise(ordered)
+
+        # .NOTPARALLEL: runtests means the tests must run one at a time
+        serial = set()
+        notparallel = self.rules.get(".NOTPARALLEL")
+        if notparallel is not None:
+            for target in notparallel.prerequisites.split():
+                if target in self.rules:
+                    serial.update(self.rules[target].prerequisites.split())
+
+        ready = []
+        sequence = 0
+        for job in ordered:
+            if job.waiting == 0:
+                heapq.heappush(ready, (-job.priority, sequence, job))
+                sequence += 1
+
+        running = {}
+        failure = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(self.args.parallel))) as pool:
+            while ready or running:
+                deferred = []
+                while ready and failure is None and len(running) < max(1, int(self.args.parallel)):
+                    _, _, job = heapq.heappop(ready)
+                    if job.target in serial and any(other.target in serial for other in running.values()):
+                        deferred.append(job)
+                        continue
+
+                    command = None
+                    if job.rule.recipe and self._outofdate(job):
+                        command, silent, ignore_errors = _shell_command(job.rule.recipe)
+                        if not silent and self.args.verbose >= 2:
+                            print(command, flush=True)
+                    if command:
+                        job.ignore_errors = ignore_errors
+                        future = pool.submit(self._run, job, command)
+                        running[future] = job
+                    else:
+                        sequence = self._finished(job, ready, sequence)
+                for job in deferred:
+                    heapq.heappush(ready, (-job.priority, sequence, job))
+                    sequence += 1
+
+                if not running:
+                    if failure is not None:
+                        break
+                    continue
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    returncode, elapsed = future.result()
+                    self.durations[job.target] = elapsed
+                    if returncode != 0 and not job.ignore_errors:
+                        if failure is None:
+                            failure = subprocess.CalledProcessError(returncode, job.rule.recipe)
+                        continue
+                    self._mtimes.pop(job.target, None)
+                    sequence = self._finished(job, ready, sequence)
+
+        if failure is not None:
+            raise failure
+
+    def _finished(self, job, ready, sequence):
+        for dependent in job.dependents:
+            dependent.waiting -= 1
+            if dependent.waiting == 0:
+                heapq.heappush(ready, (-dependent.priority, sequence, dependent))
+                sequence += 1
+        return sequence
+
+    def report(self, file=None):
+        """ Print how long each recipe took, slowest first """
+        if file is None:
+            file = sys.stderr
+        if not self.durations:
+            return
+        timer = compiletools.timing.get_timer()
+        print("\nJob timings (slowest first):", file=file)
+        for target, elapsed in sorted(self.durations.items(), key=lambda item: item[1], reverse=True):
+            print("  {}: {}".format(target, timer.format_time(elapsed)), file=file)
@@ -8,10 +8,10 @@ import os
 import re
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from functools import lru_cache
 from typing import Dict, List, Optional, Union
 from io import open
 
+import compiletools.caches
 import compiletools.wrappedos
 
 
@@ -26,6 +26,13 @@ class FileAnalysisResult:
     was_truncated: bool                     # Whether file was larger than max_read_size
 
 
+# (realpath, max_read_size, analyzer class name) -> (mtime, FileAnalysisResult).
+# Keyed on the file rather than the analyzer so that the many short lived
+# analyzers (and successive builds in ct-served or --watch) share it.
+_analyses = compiletools.caches.LRUDict()
+compiletools.caches.register("file_analyzer._analyses", _analyses, path=lambda key: key[0])
+
+
 class FileAnalyzer(ABC):
     """Base class for file analysis implementations.
     
@@ -44,13 +51,33 @@ class FileAnalyzer(ABC):
         self.max_read_size = max_read_size
         self.verbose = verbose
         
-    @abstractmethod
     def analyze(self) -> FileAnalysisResult:
         """Analyze file and return structured results.
+
+        The result is cached per file until its mtime changes.
         
         Returns:
             FileAnalysisResult with all pattern positions and content
         """
+        try:
+            mtime = compiletools.wrappedos.getmtime(self.filepath)
+        except OSError:
+            # File doesn't exist, return empty result directly
+            return FileAnalysisResult(
+                text="", include_positions=[], magic_positions=[],
+                directive_positions={}, bytes_analyzed=0, was_truncated=False
+            )
+        cachekey = (self.filepath, self.max_read_size, type(self).__name__)
+        cached = _analyses.get(cachekey)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        result = self._analyze()
+        _analyses[cachekey] = (mtime, result)
+        return result
+
+    @abstractmethod
+    def _analyze(self) -> FileAnalysisResult:
+        """Read and analyze the file, bypassing the cache"""
         pass
         
     def _should_read_entire_file(self, file_size: Optional[int] = None) -> bool:
@@ -65,21 +92,8 @@ class FileAnalyzer(ABC):
 class LegacyFileAnalyzer(FileAnalyzer):
     """Reference implementation using traditional regex/string operations."""
     
-    def analyze(self) -> FileAnalysisResult:
-        """Analyze file using regex patterns for compatibility."""
-        try:
-            mtime = compiletools.wrappedos.getmtime(self.filepath)
-        except OSError:
-            # File doesn't exist, return empty result directly
-            return FileAnalysisResult(
-                text="", include_positions=[], magic_positions=[],
-                directive_positions={}, bytes_analyzed=0, was_truncated=False
-            )
-        return self._cached_analyze(mtime)
-    
-    @lru_cache(maxsize=None)
-    def _cached_analyze(self, mtime: float) -> FileAnalysisResult:
-        """Cached analysis implementation."""
+    def _analyze(self) -> FileAnalysisResult:
+        """Uncached analysis implementation."""
         if not os.path.exists(self.filepath):
             return FileAnalysisResult(
                 text="", include_positions=[], magic_positions=[],
@@ -196,21 +210,8 @@ class StringZillaFileAnalyzer(FileAnalyzer):
             self._stringzilla_available = False
             raise ImportError("StringZilla not available, use LegacyFileAnalyzer")
     
-    def analyze(self) -> FileAnalysisResult:
-        """Analyze file using StringZilla SIMD optimization."""
-        try:
-            mtime = compiletools.wrappedos.getmtime(self.filepath)
-        except OSError:
-            # File doesn't exist, return empty result directly
-            return FileAnalysisResult(
-                text="", include_positions=[], magic_positions=[],
-                directive_positions={}, bytes_analyzed=0, was_truncated=False
-            )
-        return self._cached_analyze(mtime)
-    
-    @lru_cache(maxsize=None)
-    def _cached_analyze(self, mtime: float) -> FileAnalysisResult:
-        """Cached analysis implementation."""
+    def _analyze(self) -> FileAnalysisResult:
+        """Uncached analysis implementation."""
         if not self._stringzilla_available:
             raise RuntimeError("StringZilla not available")
             
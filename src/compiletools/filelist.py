@@ -6,6 +6,7 @@ import compiletools.utils
 import compiletools.git_utils
 import compiletools.wrappedos
 import compiletools.apptools
+import compiletools.memory
 from compiletools.hunter import Hunter
 
 
@@ -182,6 +183,7 @@ def main(argv=None):
     filelist = Filelist(args, hunter)
     filelist.process()
 
+    compiletools.memory.checkpoint()
     # For testing purposes, clear out the memcaches for the times when main is called more than once.
     compiletools.wrappedos.clear_cache()
     compiletools.utils.clear_cache()
@@ -1,8 +1,9 @@
 import os
+import stat
 import subprocess
 import configargparse
 
-import functools
+import compiletools.caches
 import compiletools.utils
 import compiletools.apptools
 
@@ -18,19 +19,81 @@ def find_git_root(filename=None):
     return _find_git_root(directory)
 
 
-@functools.lru_cache(maxsize=None)
+# Environment variables that change where git looks for the repository.
+# If any are set then leave the answer to git itself.
+_GIT_DISCOVERY_VARIABLES = ("GIT_DIR", "GIT_WORK_TREE", "GIT_CEILING_DIRECTORIES")
+
+
+@compiletools.caches.cached()
+def _dotgit_kind(directory):
+    """ Return "valid" if directory contains a usable .git directory or
+        .git file (as used by worktrees and submodules), "invalid" if it
+        contains some other .git and None if there is no .git at all
+    """
+    dotgit = os.path.join(directory, ".git")
+    try:
+        st = os.stat(dotgit)
+    except OSError:
+        return None
+
+    if stat.S_ISDIR(st.st_mode):
+        return "valid" if os.path.exists(os.path.join(dotgit, "HEAD")) else "invalid"
+
+    # A .git file contains "gitdir: <path>" relative to the file
+    try:
+        with open(dotgit, encoding="utf-8", errors="ignore") as ff:
+            line = ff.readline().strip()
+    except OSError:
+        return "invalid"
+    if line.startswith("gitdir:"):
+        gitdir = os.path.join(directory, line[len("gitdir:"):].strip())
+        if os.path.isdir(gitdir):
+            return "valid"
+    return "invalid"
+
+
+@compiletools.caches.cached()
+def _discover_git_root(directory):
+    """ Walk up from directory looking for .git.  Returns (root, certain)
+        where certain is False if an unusual .git was found and git itself
+        should be asked.  The answer for every parent is cached so sibling
+        directories share the walk.
+    """
+    kind = _dotgit_kind(directory)
+    if kind == "valid":
+        return directory, True
+    if kind == "invalid":
+        return directory, False
+    parent = os.path.dirname(directory)
+    if parent == directory:
+        return None, True
+    return _discover_git_root(parent)
+
+
+@compiletools.caches.cached()
 def _find_git_root(directory):
     """ Internal function to find the git root but cache it against the given directory """
-    original_cwd = os.getcwd()
-    os.chdir(directory)
-
+    if not any(variable in os.environ for variable in _GIT_DISCOVERY_VARIABLES):
+        gitroot, certain = _discover_git_root(directory)
+        if certain:
+            # Define the git root of a project that isn't under version control to be be cwd
+            return gitroot if gitroot is not None else os.getcwd()
+    return _find_git_root_using_git(directory)
+
+
+def _find_git_root_using_git(directory):
+    """ Ask git for the root of the repository containing directory.
+        git runs with cwd=directory so the process working directory is
+        never changed and this is safe to call from multiple threads.
+    """
     # Define the git root of a project that isn't under version control to be be cwd
-    gitroot = original_cwd
+    gitroot = os.getcwd()
     try:
         # Redirect stderr to stdout (which is captured) rather than
         # have it spew over the console
         gitroot = subprocess.check_output(
             ["git", "rev-parse", "--show-toplevel"],
+            cwd=directory,
             stderr=subprocess.STDOUT,
             universal_newlines=True,
         ).strip("\n")
@@ -46,18 +109,18 @@ def _find_git_root(directory):
                 gitroot = trialgitroot
                 break
             trialgitroot = os.path.dirname(trialgitroot)
-    finally:
-        os.chdir(original_cwd)
     return gitroot
 
 
-@functools.lru_cache(maxsize=None)
+@compiletools.caches.cached()
 def strip_git_root(filename):
     size = len(find_git_root(filename)) + 1
     return filename[size:]
 
 
 def clear_cache():
+    _dotgit_kind.cache_clear()
+    _discover_git_root.cache_clear()
     _find_git_root.cache_clear()
     strip_git_root.cache_clear()
 
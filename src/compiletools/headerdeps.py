@@ -1,18 +1,19 @@
 import os
 import re
 from io import open
-import functools
 
 # At deep verbose levels pprint is used
 from pprint import pprint
 
+import compiletools.caches
 import compiletools.wrappedos
 import compiletools.apptools
 import compiletools.tree as tree
 import compiletools.preprocessor
 import compiletools.compiler_macros
-from compiletools.simple_preprocessor import SimplePreprocessor
-from compiletools.file_analyzer import create_file_analyzer
+import compiletools.macro_state
+import compiletools.simple_preprocessor
+from compiletools.macro_state import MacroSnapshot
 import compiletools.timing
 
 
@@ -45,6 +46,55 @@ def add_arguments(cap):
     )
 
 
+def create_initial_macros(args):
+    """Return the MacroSnapshot that a conditional compilation walk starts
+    from, i.e., the -D macros on the command line plus the compiler,
+    platform and architecture macros.
+    """
+    # Gather the initial macros as name-value pairs.  They become the root
+    # MacroSnapshot that each file's defines are layered on top of.
+    initial_macros = {}
+    
+    # Extract -D macro definitions from CPPFLAGS, CFLAGS, and CXXFLAGS
+    define_pat = re.compile(r"-D([\S]+)")
+    flag_sources = [
+        ('CPPFLAGS', getattr(args, 'CPPFLAGS', '')),
+        ('CFLAGS', getattr(args, 'CFLAGS', '')), 
+        ('CXXFLAGS', getattr(args, 'CXXFLAGS', ''))
+    ]
+    
+    for flag_name, flag_value in flag_sources:
+        if flag_value:  # Only process if flag_value is not empty
+            # Handle both string and list types for flag_value
+            if isinstance(flag_value, list):
+                flag_string = ' '.join(flag_value)
+            else:
+                flag_string = flag_value
+                
+            flag_macros = define_pat.findall(flag_string)
+            for macro in flag_macros:
+                # Handle -DMACRO=value by splitting on first = to get name and value
+                if '=' in macro:
+                    macro_name, macro_value = macro.split('=', 1)
+                else:
+                    macro_name = macro
+                    macro_value = "1"  # Default value for macros without explicit values
+                initial_macros[macro_name] = macro_value
+                if args.verbose >= 3:
+                    print(f"Added macro from {flag_name}: {macro_name} = {macro_value}")
+    
+    # Get compiler, platform, and architecture macros dynamically
+    # Probe with the flags that change them, e.g., -std=c++20 or -mavx2
+    compiler = getattr(args, 'CXX', 'g++')
+    probe_flags = compiletools.compiler_macros.macro_relevant_flags(
+        getattr(args, 'CPPFLAGS', ''), getattr(args, 'CXXFLAGS', '')
+    )
+    macros = compiletools.compiler_macros.get_compiler_macros(compiler, args.verbose, probe_flags)
+    initial_macros.update(macros)
+
+    return MacroSnapshot(initial_macros)
+
+
 class HeaderDepsBase(object):
     """Implement the common functionality of the different header
     searching classes.  This really should be an abstract base class.
@@ -60,7 +110,7 @@ class HeaderDepsBase(object):
     def process(self, filename):
         """Return the set of dependencies for a given filename"""
         realpath = compiletools.wrappedos.realpath(filename)
-        with compiletools.timing.time_operation(f"header_dependency_analysis_{os.path.basename(filename)}"):
+        with compiletools.timing.time_operation("header_dependency_analysis", realpath):
             try:
                 result = self._process_impl(realpath)
             except IOError:
@@ -96,50 +146,27 @@ class DirectHeaderDeps(HeaderDepsBase):
         # Handle both -I src and -Isrc formats
         pat = re.compile(r"-(?:I)(?:\s+|)([^\s]+)")
         self.includes = pat.findall(self.args.CPPFLAGS)
+        self._includes = tuple(self.includes)
 
         if self.args.verbose >= 3:
             print("Includes=" + str(self.includes))
             
-        # Track defined macros during processing - use dict to store name-value pairs
-        self.defined_macros = {}
-        
-        # Extract -D macro definitions from CPPFLAGS, CFLAGS, and CXXFLAGS
-        define_pat = re.compile(r"-D([\S]+)")
-        flag_sources = [
-            ('CPPFLAGS', getattr(self.args, 'CPPFLAGS', '')),
-            ('CFLAGS', getattr(self.args, 'CFLAGS', '')), 
-            ('CXXFLAGS', getattr(self.args, 'CXXFLAGS', ''))
-        ]
-        
-        for flag_name, flag_value in flag_sources:
-            if flag_value:  # Only process if flag_value is not empty
-                # Handle both string and list types for flag_value
-                if isinstance(flag_value, list):
-                    flag_string = ' '.join(flag_value)
-                else:
-                    flag_string = flag_value
-                    
-                flag_macros = define_pat.findall(flag_string)
-                for macro in flag_macros:
-                    # Handle -DMACRO=value by splitting on first = to get name and value
-                    if '=' in macro:
-                        macro_name, macro_value = macro.split('=', 1)
-                    else:
-                        macro_name = macro
-                        macro_value = "1"  # Default value for macros without explicit values
-                    self.defined_macros[macro_name] = macro_value
-                    if self.args.verbose >= 3:
-                        print(f"Added macro from {flag_name}: {macro_name} = {macro_value}")
-        
-        # Get compiler, platform, and architecture macros dynamically
-        compiler = getattr(self.args, 'CXX', 'g++')
-        macros = compiletools.compiler_macros.get_compiler_macros(compiler, self.args.verbose)
-        self.defined_macros.update(macros)
-
-    @functools.lru_cache(maxsize=None)
-    def _search_project_includes(self, include):
+        # Every top level traversal starts from the same root snapshot so
+        # that the per-file passes can be shared (see preprocess_file)
+        self.initial_macros = create_initial_macros(self.args)
+
+        # Track defined macros during processing as an immutable snapshot
+        self.defined_macros = self.initial_macros
+
+    # The include lookups are keyed on the include paths rather than on self
+    # so that they outlive this object.  ct-served and --watch keep them
+    # between builds and clear them (clear_include_cache) only when files
+    # are added or removed.
+    @staticmethod
+    @compiletools.caches.cached(method=False)
+    def _search_project_includes(includes, include):
         """Internal use.  Find the given include file in the project include paths"""
-        for inc_dir in self.includes:
+        for inc_dir in includes:
             trialpath = os.path.join(inc_dir, include)
             if compiletools.wrappedos.isfile(trialpath):
                 return compiletools.wrappedos.realpath(trialpath)
@@ -150,8 +177,9 @@ class DirectHeaderDeps(HeaderDepsBase):
         #    raise FileNotFoundError("DirectHeaderDeps could not determine the location of ",include)
         return None
 
-    @functools.lru_cache(maxsize=None)
-    def _find_include(self, include, cwd):
+    @staticmethod
+    @compiletools.caches.cached(method=False)
+    def _find_include_in(includes, include, cwd):
         """Internal use.  Find the given include file.
         Start at the current working directory then try the project includes
         """
@@ -161,44 +189,43 @@ class DirectHeaderDeps(HeaderDepsBase):
         if compiletools.wrappedos.isfile(trialpath):
             return compiletools.wrappedos.realpath(trialpath)
         else:
-            return self._search_project_includes(include)
-
-    def _process_conditional_compilation(self, text):
-        """Process conditional compilation directives and return only active sections"""
-        preprocessor = SimplePreprocessor(self.defined_macros, self.args.verbose)
-        processed_text = preprocessor.process(text)
-        
-        # Update our defined_macros dict with any changes from the preprocessor
-        self.defined_macros.clear()
-        self.defined_macros.update(preprocessor.macros)
-        
-        return processed_text
+            return DirectHeaderDeps._search_project_includes(includes, include)
+
+    def _find_include(self, include, cwd):
+        """Internal use.  Find the given include file."""
+        return DirectHeaderDeps._find_include_in(self._includes, include, cwd)
+
+    def _preprocess(self, realpath):
+        """Internal use. Run the conditional compilation pass over the given file.
+        The pass starts from self.defined_macros and leaves it holding the
+        macros in effect at the end of the file.
+        """
+        with compiletools.timing.time_operation("conditional_compilation", realpath):
+            preprocessed = compiletools.simple_preprocessor.preprocess_file(
+                realpath,
+                self.defined_macros,
+                getattr(self.args, 'max_file_read_size', 0),
+                self.args.verbose,
+            )
+        self.defined_macros = preprocessed.macros
+        return preprocessed
+
+    @staticmethod
+    def _find_includes(processed_text):
+        # The pattern is intended to match all include statements but
+        # not the ones with either C or C++ commented out.
+        pat = re.compile(
+            r'/\*.*?\*/|//.*?$|^[\s]*#include[\s]*["<][\s]*([\S]*)[\s]*[">]',
+            re.MULTILINE | re.DOTALL,
+        )
+        return [group for group in pat.findall(processed_text) if group]
 
     def _create_include_list(self, realpath):
         """Internal use. Create the list of includes for the given file"""
-        with compiletools.timing.time_operation(f"include_analysis_{os.path.basename(realpath)}"):
-            max_read_size = getattr(self.args, 'max_file_read_size', 0)
-            
-            # Use FileAnalyzer for efficient file reading and pattern detection  
-            # Note: create_file_analyzer() handles StringZilla/Legacy fallback internally
-            from compiletools.file_analyzer import create_file_analyzer
-            with compiletools.timing.time_operation(f"file_read_{os.path.basename(realpath)}"):
-                analyzer = create_file_analyzer(realpath, max_read_size, self.args.verbose)
-                analysis_result = analyzer.analyze()
-                text = analysis_result.text
-
-            # Process conditional compilation - this updates self.defined_macros as it encounters #define
-            with compiletools.timing.time_operation(f"conditional_compilation_{os.path.basename(realpath)}"):
-                processed_text = self._process_conditional_compilation(text)
-
-            # The pattern is intended to match all include statements but
-            # not the ones with either C or C++ commented out.
-            with compiletools.timing.time_operation(f"pattern_matching_{os.path.basename(realpath)}"):
-                pat = re.compile(
-                    r'/\*.*?\*/|//.*?$|^[\s]*#include[\s]*["<][\s]*([\S]*)[\s]*[">]',
-                    re.MULTILINE | re.DOTALL,
-                )
-                return [group for group in pat.findall(processed_text) if group]
+        with compiletools.timing.time_operation("include_analysis", realpath):
+            processed_text = self._preprocess(realpath).text
+            with compiletools.timing.time_operation("pattern_matching", realpath):
+                return self._find_includes(processed_text)
 
     def _generate_tree_impl(self, realpath, node=None):
         """Return a tree that describes the header includes
@@ -244,13 +271,17 @@ class DirectHeaderDeps(HeaderDepsBase):
     def generatetree(self, filename):
         """Returns the tree of include files"""
         self.ancestor_paths = []
+        self.defined_macros = self.initial_macros
         realpath = compiletools.wrappedos.realpath(filename)
         return self._generate_tree_impl(realpath)
 
     def _process_impl_recursive(self, realpath, results):
-        results.add(realpath)
+        # Claim the slot before descending so that include cycles terminate
+        results[realpath] = None
+        preprocessed = self._preprocess(realpath)
+        results[realpath] = preprocessed
         cwd = compiletools.wrappedos.dirname(realpath)
-        for include in self._create_include_list(realpath):
+        for include in self._find_includes(preprocessed.text):
             trialpath = self._find_include(include, cwd)
             if trialpath and trialpath not in results:
                 if self.args.verbose >= 9:
@@ -260,26 +291,46 @@ class DirectHeaderDeps(HeaderDepsBase):
                     )
                 self._process_impl_recursive(trialpath, results)
 
+    def preprocessed_files(self, filename, macros=None):
+        """Return the conditional compilation pass of every file that filename
+        pulls in, in the order the files were visited (filename first).
+        Each pass starts from the macros left by the previous one, beginning
+        with macros (or the command line and compiler macros if None).
+        """
+        realpath = compiletools.wrappedos.realpath(filename)
+        self.defined_macros = self.initial_macros if macros is None else macros
+        results = {}
+        self._process_impl_recursive(realpath, results)
+        return list(results.values())
+
     # TODO: Stop writing to the same cache as CPPHeaderDeps.
     # Because the magic flags rely on the .deps cache, this hack was put in
     # place.
-    # NOTE: Cache removed due to macro state dependency - cache was keyed only on file path
-    # but results depend on self.defined_macros which can change between calls
+    # NOTE: There is no per path cache here because the result depends on the
+    # macro state.  The per-file passes are cached on (file, macro state) by
+    # compiletools.simple_preprocessor.preprocess_file instead.
     def _process_impl(self, realpath):
         if self.args.verbose >= 9:
             print("DirectHeaderDeps::_process_impl: " + realpath)
 
-        results = set()
+        results = {}
+        self.defined_macros = self.initial_macros
         self._process_impl_recursive(realpath, results)
-        results.discard(realpath)
-        return results
+        results.pop(realpath, None)
+        return set(results)
 
 
+    @staticmethod
+    def clear_include_cache():
+        """Forget where the includes were found, e.g., after files were added or removed"""
+        DirectHeaderDeps._search_project_includes.cache_clear()
+        DirectHeaderDeps._find_include_in.cache_clear()
+
     @staticmethod
     def clear_cache():
         # print("DirectHeaderDeps::clear_cache")
-        DirectHeaderDeps._search_project_includes.cache_clear()
-        DirectHeaderDeps._find_include.cache_clear()
+        DirectHeaderDeps.clear_include_cache()
+        compiletools.simple_preprocessor.clear_cache()
 
 
 class CppHeaderDeps(HeaderDepsBase):
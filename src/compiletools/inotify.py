@@ -0,0 +1,134 @@
+""" A minimal ctypes wrapper around the Linux inotify API.
+    Used by ct-served (and ct-cake --watch) to learn which files have
+    changed without having to stat every file in the project.
+"""
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import compiletools.caches
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+
+# Events that mean a file was added, removed or renamed rather than just written to
+STRUCTURE_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | STRUCTURE_MASK
+
+_EVENT = struct.Struct("iIII")
+
+
+@compiletools.caches.cached()
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def available():
+    """ Is inotify usable on this machine? """
+    try:
+        return hasattr(_libc(), "inotify_init1")
+    except OSError:
+        return False
+
+
+class Inotify(object):
+
+    """ Watch directories for changes to the files in them.
+        read() returns (path, mask) pairs.  A path of None means the kernel
+        queue overflowed and any file may have changed.
+    """
+
+    def __init__(self):
+        self._fd = _libc().inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._directories = {}  # watch descriptor -> directory
+
+    def fileno(self):
+        return self._fd
+
+    def watch(self, directory):
+        """ Watch directory (not recursively).  Returns False if the
+            directory cannot be watched, e.g., because it does not exist.
+        """
+        if directory in self._directories.values():
+            return True
+        wd = _libc().inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            return False
+        self._directories[wd] = directory
+        return True
+
+    def watching(self):
+        return set(self._directories.values())
+
+    def read(self, timeout=None):
+        """ Wait up to timeout seconds (forever if None) for events and
+            return all the (path, mask) pairs that are queued.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        changes = []
+        while True:
+            try:
+                buffer = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            except OSError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = _EVENT.unpack_from(buffer, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(buffer[offset:offset + length].rstrip(b"\0"))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    changes.append((None, mask))
+                    continue
+                directory = self._directories.get(wd)
+                if mask & IN_IGNORED:
+                    self._directories.pop(wd, None)
+                    continue
+                if directory is None:
+                    continue
+                changes.append((os.path.join(directory, name) if name else directory, mask))
+        return changes
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+            self._directories.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,234 @@
+"""Layered, copy-on-write macro environments for the direct preprocessors.
+
+The compiler builtins returned by compiletools.compiler_macros number in the
+hundreds, while a typical header only defines its include guard and perhaps a
+handful of configuration macros.  Rather than copying the entire macro table
+for every file, a MacroSnapshot is an immutable layer (a delta) on top of a
+parent snapshot.  A MacroEnvironment is the mutable, per-file view that
+SimplePreprocessor writes into; calling snapshot() on it freezes just the
+changes into a new layer.
+
+Every snapshot carries a hashable ``key``.  Snapshots that were built from the
+same parent with the same delta have equal keys, so the key can be used in
+cache keys such as (realpath, snapshot.key).  Keys are values rather than
+entries in a global table, so they live exactly as long as whatever holds them.
+"""
+
+from collections.abc import Mapping, MutableMapping
+from typing import Optional
+
+
+class _Undefined:
+    """Marker stored in a delta to record an #undef of an inherited macro"""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<undefined>"
+
+
+UNDEFINED = _Undefined()
+
+
+class SnapshotKey:
+    """The identity of a snapshot: its parent's key and its frozen delta.
+
+    The hash is computed once from (parent hash, delta) so hashing is O(1)
+    and the full comparison only happens when two hashes are equal.
+    """
+
+    __slots__ = ("_parent", "_delta", "_hash", "__weakref__")
+
+    def __init__(self, parent: Optional["SnapshotKey"], delta):
+        self._parent = parent
+        self._delta = frozenset(delta.items())
+        self._hash = hash((parent, self._delta))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, SnapshotKey) or self._hash != other._hash:
+            return False
+        return self._delta == other._delta and self._parent == other._parent
+
+    def __repr__(self):
+        return f"SnapshotKey({self._hash:#x})"
+
+
+class MacroSnapshot(Mapping):
+    """An immutable mapping of macro name to value.
+
+    Lookups walk from the newest layer towards the root.  To bound that walk,
+    once a chain grows past MAX_DEPTH the layers above the root are merged into
+    a single delta.  The root (usually the compiler builtins plus command line
+    -D flags) is never copied.
+    """
+
+    MAX_DEPTH = 16
+
+    __slots__ = ("_parent", "_delta", "_depth", "key")
+
+    def __init__(self, macros=None, parent: Optional["MacroSnapshot"] = None):
+        delta = dict(macros) if macros else {}
+        if parent is None:
+            # A root cannot undefine anything
+            delta = {name: value for name, value in delta.items() if value is not UNDEFINED}
+            depth = 0
+        else:
+            depth = parent._depth + 1
+            if depth > self.MAX_DEPTH:
+                parent, delta = parent._collapse(delta)
+                depth = 1
+        self._parent = parent
+        self._delta = delta
+        self._depth = depth
+        self.key = SnapshotKey(parent.key if parent is not None else None, delta)
+
+    def _collapse(self, newest):
+        """Return (root, merged delta) for this chain with newest applied last"""
+        layers = [newest]
+        node = self
+        while node._parent is not None:
+            layers.append(node._delta)
+            node = node._parent
+        merged = {}
+        for layer in reversed(layers):
+            merged.update(layer)
+        return node, merged
+
+    def derive(self, delta) -> "MacroSnapshot":
+        """Return a new snapshot that applies delta on top of this one.
+        Values of UNDEFINED in delta remove the macro.
+        """
+        if not delta:
+            return self
+        return MacroSnapshot(delta, parent=self)
+
+    def _lookup(self, name):
+        node = self
+        while node is not None:
+            value = node._delta.get(name, node)
+            if value is not node:
+                return value
+            node = node._parent
+        return UNDEFINED
+
+    def __getitem__(self, name):
+        value = self._lookup(name)
+        if value is UNDEFINED:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self._lookup(name) is not UNDEFINED
+
+    def get(self, name, default=None):
+        value = self._lookup(name)
+        return default if value is UNDEFINED else value
+
+    def _flatten(self):
+        root, merged = self._collapse({})
+        flat = dict(root._delta)  # Never hand out the root's own dict
+        for name, value in merged.items():
+            if value is UNDEFINED:
+                flat.pop(name, None)
+            else:
+                flat[name] = value
+        return flat
+
+    def __iter__(self):
+        return iter(self._flatten())
+
+    def __len__(self):
+        return len(self._flatten())
+
+    def __repr__(self):
+        return f"MacroSnapshot(key={self.key}, depth={self._depth}, delta={self._delta!r})"
+
+
+class MacroEnvironment(MutableMapping):
+    """A mutable copy-on-write view over a MacroSnapshot.
+
+    Writes and #undefs are recorded in a private delta so creating an
+    environment is O(1) and freezing it with snapshot() is O(changes).
+    """
+
+    __slots__ = ("_base", "_delta")
+
+    def __init__(self, base: Optional[MacroSnapshot] = None):
+        self._base = base if base is not None else MacroSnapshot()
+        self._delta = {}
+
+    def __getitem__(self, name):
+        value = self._delta.get(name, self._delta)
+        if value is self._delta:
+            return self._base[name]
+        if value is UNDEFINED:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        value = self._delta.get(name, self._delta)
+        if value is self._delta:
+            return name in self._base
+        return value is not UNDEFINED
+
+    def get(self, name, default=None):
+        value = self._delta.get(name, self._delta)
+        if value is self._delta:
+            return self._base.get(name, default)
+        return default if value is UNDEFINED else value
+
+    def __setitem__(self, name, value):
+        self._delta[name] = value
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._delta[name] = UNDEFINED
+
+    def _flatten(self):
+        flat = self._base._flatten()
+        for name, value in self._delta.items():
+            if value is UNDEFINED:
+                flat.pop(name, None)
+            else:
+                flat[name] = value
+        return flat
+
+    def __iter__(self):
+        return iter(self._flatten())
+
+    def __len__(self):
+        return len(self._flatten())
+
+    @property
+    def changed(self):
+        """Names that have been defined or undefined since the last snapshot"""
+        return set(self._delta)
+
+    def snapshot(self) -> MacroSnapshot:
+        """Freeze the current state.  Subsequent writes start a new delta."""
+        if self._delta:
+            self._base = self._base.derive(self._delta)
+            self._delta = {}
+        return self._base
+
+    def __repr__(self):
+        return f"MacroEnvironment(base={self._base!r}, delta={self._delta!r})"
+
+
+def as_snapshot(macros) -> MacroSnapshot:
+    """Coerce a dict, a set of names, an environment or a snapshot into a snapshot"""
+    if isinstance(macros, MacroSnapshot):
+        return macros
+    if isinstance(macros, MacroEnvironment):
+        return macros.snapshot()
+    if isinstance(macros, Mapping):
+        return MacroSnapshot(macros)
+    # Legacy compatibility: a set of names without explicit values
+    return MacroSnapshot({name: "1" for name in macros})
+
@@ -1,19 +1,20 @@
 import sys
 import os
-import subprocess
 import re
 import configargparse
 from collections import defaultdict
 from io import open
 import compiletools.utils
+import compiletools.caches
 import compiletools.git_utils
 import compiletools.headerdeps
+import compiletools.simple_preprocessor
 import compiletools.wrappedos
 import compiletools.configutils
 import compiletools.apptools
-import compiletools.compiler_macros
-from compiletools.file_analyzer import create_file_analyzer
+import compiletools.pkgconfig
 import compiletools.timing
+from compiletools.macro_state import UNDEFINED
 
 
 def create(args, headerdeps):
@@ -80,17 +81,13 @@ class MagicFlagsBase:
         raise NotImplemented
 
     def __call__(self, filename):
-        with compiletools.timing.time_operation(f"magic_flags_analysis_{os.path.basename(filename)}"):
+        with compiletools.timing.time_operation("magic_flags_analysis", filename):
             return self.parse(filename)
 
-    def _handle_source(self, flag, text):
-        # Find the include before the //#SOURCE=
-        result = re.search(
-            r'# \d.* "(/\S*?)".*?//#SOURCE\s*=\s*' + flag, text, re.DOTALL
-        )
-        # Now adjust the flag to include the full path
+    def _resolve_source(self, flag, sourcefile):
+        """Return the full path of a //#SOURCE= flag found in sourcefile"""
         newflag = compiletools.wrappedos.realpath(
-            os.path.join(compiletools.wrappedos.dirname(result.group(1)), flag.strip())
+            os.path.join(compiletools.wrappedos.dirname(sourcefile), flag.strip())
         )
         if self._args.verbose >= 9:
             print(
@@ -106,16 +103,38 @@ class MagicFlagsBase:
 
         if not compiletools.wrappedos.isfile(newflag):
             raise IOError(
-                filename
-                + " specified "
-                + magic
-                + "='"
+                sourcefile
+                + " specified SOURCE='"
                 + newflag
                 + "' but it does not exist"
             )
 
         return newflag
 
+    def _handle_source(self, flag, text):
+        # Find the include before the //#SOURCE=
+        result = re.search(
+            r'# \d.* "(/\S*?)".*?//#SOURCE\s*=\s*' + flag, text, re.DOTALL
+        )
+        # Now adjust the flag to include the full path
+        return self._resolve_source(flag, result.group(1))
+
+    def _magic_flags(self, filename, headers=None):
+        """Yield (file, magic, flag) for every magic flag that filename sees.
+        headers is what the headerdeps found for filename.
+        This default implementation searches the text returned by readfile.
+        """
+        with compiletools.timing.time_operation("magic_flags_readfile", filename):
+            text = self.readfile(filename)
+        for match in self.magicpattern.finditer(text):
+            magic, flag = match.groups()
+
+            # If the magic was SOURCE then fix up the path in the flag
+            if magic == "SOURCE":
+                flag = self._handle_source(flag, text)
+
+            yield filename, magic, flag
+
     def _handle_include(self, flag):
         flagsforfilename = {}
         flagsforfilename.setdefault("CPPFLAGS", []).append("-I " + flag)
@@ -127,33 +146,17 @@ class MagicFlagsBase:
 
     def _handle_pkg_config(self, flag):
         flagsforfilename = defaultdict(list)
-        for pkg in flag.split():
-            # TODO: when we move to python 3.7, use text=True rather than universal_newlines=True and capture_output=True,
-            with compiletools.timing.time_operation(f"pkg_config_cflags_{pkg}"):
-                cflags = (
-                    subprocess.run(
-                        ["pkg-config", "--cflags", pkg],
-                        stdout=subprocess.PIPE,
-                        universal_newlines=True,
-                    )
-                    .stdout.rstrip()
-                    .replace("-I", "-isystem ")
-                )  # This helps the CppHeaderDeps avoid searching packages
-            
-            with compiletools.timing.time_operation(f"pkg_config_libs_{pkg}"):
-                libs = subprocess.run(
-                    ["pkg-config", "--libs", pkg],
-                    stdout=subprocess.PIPE,
-                    universal_newlines=True,
-                ).stdout.rstrip()
-            flagsforfilename["CPPFLAGS"].append(cflags)
-            flagsforfilename["CFLAGS"].append(cflags)
-            flagsforfilename["CXXFLAGS"].append(cflags)
-            flagsforfilename["LDFLAGS"].append(libs)
+        with compiletools.timing.time_operation("pkg_config", flag):
+            resolved = compiletools.pkgconfig.resolve(flag.split(), self._args.verbose)
+        for pkg, pkgflags in resolved.items():
+            flagsforfilename["CPPFLAGS"].append(pkgflags.cflags)
+            flagsforfilename["CFLAGS"].append(pkgflags.cflags)
+            flagsforfilename["CXXFLAGS"].append(pkgflags.cflags)
+            flagsforfilename["LDFLAGS"].append(pkgflags.libs)
             if self._args.verbose >= 9:
                 print(f"Magic PKG-CONFIG = {pkg}:")
-                print(f"\tadded {cflags} to CPPFLAGS, CFLAGS, and CXXFLAGS")
-                print(f"\tadded {libs} to LDFLAGS")
+                print(f"\tadded {pkgflags.cflags} to CPPFLAGS, CFLAGS, and CXXFLAGS")
+                print(f"\tadded {pkgflags.libs} to LDFLAGS")
         return flagsforfilename
 
     def _parse(self, filename):
@@ -165,25 +168,16 @@ class MagicFlagsBase:
         # When used in the "usual" fashion this is true.
         # However, it is possible to call directly so we must
         # ensure that the headerdeps exist manually.
-        with compiletools.timing.time_operation(f"magic_flags_headerdeps_{os.path.basename(filename)}"):
-            self._headerdeps.process(filename)
+        with compiletools.timing.time_operation("magic_flags_headerdeps", filename):
+            headers = self._headerdeps.process(filename)
 
-        with compiletools.timing.time_operation(f"magic_flags_readfile_{os.path.basename(filename)}"):
-            text = self.readfile(filename)
-        
-        with compiletools.timing.time_operation(f"magic_flags_parsing_{os.path.basename(filename)}"):
+        with compiletools.timing.time_operation("magic_flags_parsing", filename):
             flagsforfilename = defaultdict(list)
 
-            for match in self.magicpattern.finditer(text):
-                magic, flag = match.groups()
-
-                # If the magic was SOURCE then fix up the path in the flag
-                if magic == "SOURCE":
-                    flag = self._handle_source(flag, text)
-
+            for sourcefile, magic, flag in self._magic_flags(filename, headers):
                 # If the magic was INCLUDE then modify that into the equivalent CPPFLAGS, CFLAGS, and CXXFLAGS
                 if magic == "INCLUDE":
-                    with compiletools.timing.time_operation(f"magic_flags_include_handling_{flag}"):
+                    with compiletools.timing.time_operation("magic_flags_include_handling", flag):
                         extrafff = self._handle_include(flag)
                         for key, values in extrafff.items():
                             for value in values:
@@ -191,7 +185,7 @@ class MagicFlagsBase:
 
                 # If the magic was PKG-CONFIG then call pkg-config
                 if magic == "PKG-CONFIG":
-                    with compiletools.timing.time_operation(f"magic_flags_pkgconfig_{flag}"):
+                    with compiletools.timing.time_operation("magic_flags_pkgconfig", flag):
                         extrafff = self._handle_pkg_config(flag)
                         for key, values in extrafff.items():
                             for value in values:
@@ -201,7 +195,7 @@ class MagicFlagsBase:
                 if self._args.verbose >= 5:
                     print(
                         "Using magic flag {0}={1} extracted from {2}".format(
-                            magic, flag, filename
+                            magic, flag, sourcefile
                         )
                     )
             
@@ -216,249 +210,184 @@ class MagicFlagsBase:
         compiletools.utils.clear_cache()
         compiletools.git_utils.clear_cache()
         compiletools.wrappedos.clear_cache()
+        compiletools.pkgconfig.clear_cache()
         DirectMagicFlags.clear_cache()
         CppMagicFlags.clear_cache()
 
 
+# PreprocessedFile.cachekey, i.e., (realpath, mtime, entry macros key,
+# max_read_size) -> tuple of (magic, flag) found in that file
+_file_magic_flags = compiletools.caches.LRUDict()
+compiletools.caches.register("magicflags._file_magic_flags", _file_magic_flags, path=lambda key: key[0])
+
+
 class DirectMagicFlags(MagicFlagsBase):
     def __init__(self, args, headerdeps):
         MagicFlagsBase.__init__(self, args, headerdeps)
-        # Track defined macros during processing
-        self.defined_macros = set()
-        # Track macro values for expression evaluation
-        self.macro_values = {}
-
-    def _add_macros_from_command_line_flags(self):
-        """Extract -D macros from command-line CPPFLAGS and CXXFLAGS and add them to defined_macros"""
-        import shlex
-        
-        # Check both CPPFLAGS and CXXFLAGS for macro definitions
-        flag_sources = []
-        if hasattr(self._args, 'CPPFLAGS') and self._args.CPPFLAGS:
-            flag_sources.append(('CPPFLAGS', self._args.CPPFLAGS))
-        if hasattr(self._args, 'CXXFLAGS') and self._args.CXXFLAGS:
-            flag_sources.append(('CXXFLAGS', self._args.CXXFLAGS))
-            
-        for source_name, flag_value in flag_sources:
-            # Handle both string and list types for flag_value
-            if isinstance(flag_value, list):
-                flag_string = ' '.join(flag_value)
-            else:
-                flag_string = flag_value
-                
-            flags = shlex.split(flag_string)
-            for flag in flags:
-                if flag.startswith('-D'):
-                    # Extract macro name and value (handle both -DMACRO and -DMACRO=value)
-                    macro_def = flag[2:]  # Remove the -D
-                    if '=' in macro_def:
-                        macro_name, macro_value = macro_def.split('=', 1)
-                    else:
-                        macro_name = macro_def
-                        macro_value = "1"
-                    
-                    if macro_name:
-                        self.defined_macros.add(macro_name)
-                        self.macro_values[macro_name] = macro_value
-                        if self._args.verbose >= 9:
-                            print(f"DirectMagicFlags: added command-line macro {macro_name} = {macro_value} from {source_name}")
-
-    def _create_macro_dict(self):
-        """Convert defined_macros and macro_values to a dict for SimplePreprocessor"""
-        # Return a copy of our macro_values dict
-        return self.macro_values.copy()
-
-    def _recursive_expand_macros(self, expr, macros, max_iterations=10):
-        """Recursively expand macros until no more changes occur"""
-        import re
-        
-        def replace_macro(match):
-            macro_name = match.group(0)
-            if macro_name in macros:
-                value = macros[macro_name]
-                # Try to convert to int if possible
-                try:
-                    return str(int(value))
-                except ValueError:
-                    return value
-            else:
-                # Undefined macro defaults to 0
-                return "0"
-        
-        previous_expr = None
-        iteration = 0
-        
-        while expr != previous_expr and iteration < max_iterations:
-            previous_expr = expr
-            # Replace macro names (identifiers) with their values
-            expr = re.sub(r'(?<![0-9])\b[A-Za-z_][A-Za-z0-9_]*\b(?![0-9])', replace_macro, expr)
-            iteration += 1
-            
-        return expr
-
-    def _process_conditional_compilation(self, text):
-        """Process conditional compilation directives and return only active sections"""
-        lines = text.split('\n')
-        result_lines = []
-        
-        # Stack to track conditional compilation state
-        # Each entry is (is_active, seen_else)
-        condition_stack = [(True, False)]  # Start with active context
-        
-        # Create SimplePreprocessor for expression evaluation
-        from compiletools.simple_preprocessor import SimplePreprocessor
-        macro_dict = self._create_macro_dict()
-        preprocessor = SimplePreprocessor(macro_dict, verbose=self._args.verbose)
-        
-        for line in lines:
-            stripped = line.strip()
-            
-            # Track #define statements
-            if stripped.startswith('#define ') and condition_stack[-1][0]:
-                parts = stripped.split(' ', 2)
-                if len(parts) >= 2:
-                    macro_name = parts[1]
-                    macro_value = parts[2] if len(parts) > 2 else "1"
-                    self.defined_macros.add(macro_name)
-                    self.macro_values[macro_name] = macro_value
-                    # Also update the preprocessor's macro dict
-                    preprocessor.macros[macro_name] = macro_value
-                    if self._args.verbose >= 9:
-                        print(f"DirectMagicFlags: defined macro {macro_name} = {macro_value}")
-            
-            # Handle conditional compilation directives
-            elif stripped.startswith('#ifdef '):
-                macro = stripped[7:].strip()
-                is_defined = macro in self.defined_macros
-                condition_stack.append((is_defined and condition_stack[-1][0], False))
-                if self._args.verbose >= 9:
-                    print(f"DirectMagicFlags: #ifdef {macro} -> {is_defined}")
-                    
-            elif stripped.startswith('#ifndef '):
-                macro = stripped[8:].strip()
-                is_defined = macro in self.defined_macros
-                condition_stack.append((not is_defined and condition_stack[-1][0], False))
+        # The conditional compilation passes are shared with DirectHeaderDeps.
+        # If the headers are being found some other way (e.g., --headerdeps=cpp)
+        # then the passes are run over the headers that it found instead.
+        if isinstance(headerdeps, compiletools.headerdeps.DirectHeaderDeps):
+            self._initial_macros = None
+        else:
+            self._initial_macros = compiletools.headerdeps.create_initial_macros(args)
+
+    @staticmethod
+    def _definers(passes):
+        """Return {macro: (last, second to last)} of the passes that change
+        the macro.  Keeping two lets a pass find the last file other than
+        itself that changed it.
+        """
+        definers = {}
+        for preprocessed in passes:
+            for name in preprocessed.defined:
+                last = definers.get(name, (None, None))[0]
+                if last is not None and last.realpath == preprocessed.realpath:
+                    definers[name] = (preprocessed, definers[name][1])
+                else:
+                    definers[name] = (preprocessed, last)
+        return definers
+
+    @staticmethod
+    def _reevaluation_macros(definers, preprocessed):
+        """Return the macros that preprocessed should be re-run with so that it
+        sees the defines made by the other files, or None if none of them
+        affect its conditionals.  definers is what _definers returned.
+        """
+        overrides = {}
+        for name in preprocessed.referenced:
+            # The last other file to change the macro decides its value
+            last, previous = definers.get(name, (None, None))
+            other = previous if last is not None and last.realpath == preprocessed.realpath else last
+            if other is None:
+                continue
+            value = other.macros.get(name, UNDEFINED)
+            if value != preprocessed.entry_macros.get(name, UNDEFINED):
+                overrides[name] = value
+        if not overrides:
+            return None
+        macros = preprocessed.entry_macros.derive(overrides)
+        if macros.key == preprocessed.entry_macros.key:
+            return None
+        return macros
+
+    def _first_passes(self, filename, headers=None):
+        """Return the conditional compilation pass of filename and each of
+        its headers, each pass starting from the macros left by the previous.
+        headers is what self._headerdeps.process(filename) returned, if known.
+        """
+        if self._initial_macros is None:
+            return self._headerdeps.preprocessed_files(filename)
+
+        # The headers came from elsewhere so reuse them rather than walking
+        # the include graph a second time.  They are in the order they were
+        # first included, which is the order that DirectHeaderDeps visits them.
+        if headers is None:
+            headers = self._headerdeps.process(filename)
+        max_read_size = getattr(self._args, 'max_file_read_size', 0)
+        macros = self._initial_macros
+        passes = []
+        for realpath in [compiletools.wrappedos.realpath(filename)] + list(headers):
+            preprocessed = compiletools.simple_preprocessor.preprocess_file(
+                realpath, macros, max_read_size, self._args.verbose
+            )
+            macros = preprocessed.macros
+            passes.append(preprocessed)
+        return passes
+
+    def _preprocessed_files(self, filename, headers=None):
+        """Return the converged conditional compilation passes for filename
+        and all the headers it includes
+        """
+        # The first pass visits the files in include order and is shared with
+        # the header dependencies.  A macro defined in a file that comes
+        # later in that order (typically a header defining a macro that its
+        # includer tests after the #include) can change an earlier file's
+        # conditionals so re-run just the files whose conditionals referenced
+        # such a macro, until nothing changes.  A file's own defines (e.g.,
+        # its include guard) never cause it to be re-run.
+        passes = self._first_passes(filename, headers)
+        max_read_size = getattr(self._args, 'max_file_read_size', 0)
+        max_iterations = 5  # Prevent infinite loops
+
+        for _ in range(max_iterations):
+            stale = []
+            definers = self._definers(passes)
+            for index, preprocessed in enumerate(passes):
+                macros = self._reevaluation_macros(definers, preprocessed)
+                if macros is not None:
+                    stale.append((index, macros))
+            if not stale:
+                break
+            for index, macros in stale:
                 if self._args.verbose >= 9:
-                    print(f"DirectMagicFlags: #ifndef {macro} -> {not is_defined}")
-            
-            elif stripped.startswith('#if '):
-                expr = stripped[4:].strip()
-                # Strip C++ style comments from the expression
-                if '//' in expr:
-                    expr = expr[:expr.find('//')].strip()
-                    
-                try:
-                    # Use our recursive macro expansion
-                    expanded_expr = self._recursive_expand_macros(expr, self.macro_values)
-                    if self._args.verbose >= 9:
-                        print(f"DirectMagicFlags: expanding #if '{expr}' -> '{expanded_expr}'")
-                    
-                    # Now evaluate with SimplePreprocessor's safe evaluator
-                    result = preprocessor._safe_eval(expanded_expr)
-                    is_true = bool(result)
-                    is_active = is_true and condition_stack[-1][0]
-                    condition_stack.append((is_active, False))
-                    if self._args.verbose >= 9:
-                        print(f"DirectMagicFlags: #if {expr} -> {result} ({is_active})")
-                except Exception as e:
-                    # If evaluation fails, assume false
-                    if self._args.verbose >= 8:
-                        print(f"DirectMagicFlags: #if evaluation failed for '{expr}': {e}")
-                    condition_stack.append((False, False))
-                    
-            elif stripped.startswith('#else'):
-                if len(condition_stack) > 1:
-                    current_active, seen_else = condition_stack.pop()
-                    if not seen_else:
-                        parent_active = condition_stack[-1][0] if condition_stack else True
-                        new_active = not current_active and parent_active
-                        condition_stack.append((new_active, True))
-                        if self._args.verbose >= 9:
-                            print(f"DirectMagicFlags: #else -> {new_active}")
-                    else:
-                        condition_stack.append((False, True))
-                        
-            elif stripped.startswith('#endif'):
-                if len(condition_stack) > 1:
-                    condition_stack.pop()
-                    if self._args.verbose >= 9:
-                        print("DirectMagicFlags: #endif")
-            else:
-                # Only include this line if we're in an active context
-                if condition_stack[-1][0]:
-                    result_lines.append(line)
-        
-        return '\n'.join(result_lines)
+                    print("DirectMagicFlags::readfile is re-evaluating " + passes[index].realpath)
+                passes[index] = compiletools.simple_preprocessor.preprocess_file(
+                    passes[index].realpath, macros, max_read_size, self._args.verbose
+                )
+
+        return passes
 
     def readfile(self, filename):
         """Read the first chunk of the file and all the headers it includes"""
-        # Reset defined macros for each new parse
-        self.defined_macros = set()
-        self.macro_values = {}
-        
-        # Add macros from command-line CPPFLAGS and CXXFLAGS (e.g., from --append-CPPFLAGS/--append-CXXFLAGS)
-        self._add_macros_from_command_line_flags()
-        
-        # Get compiler, platform, and architecture macros dynamically
-        compiler = getattr(self._args, 'CXX', 'g++')
-        macros = compiletools.compiler_macros.get_compiler_macros(compiler, self._args.verbose)
-        for macro_name, macro_value in macros.items():
-            self.defined_macros.add(macro_name)
-            self.macro_values[macro_name] = macro_value
-        
-        headers = self._headerdeps.process(filename)
-        
-        # Process files iteratively until no new macros are discovered
-        # This handles cases where macros defined in one file affect conditional
-        # compilation in other files
-        previous_macros = set()
-        max_iterations = 5  # Prevent infinite loops
-        iteration = 0
-        
-        while previous_macros != self.defined_macros and iteration < max_iterations:
-            previous_macros = self.defined_macros.copy()
-            iteration += 1
-            
-            if self._args.verbose >= 9:
-                print(f"DirectMagicFlags::readfile iteration {iteration}, known macros: {self.defined_macros}")
-            
-            text = ""
-            # Process files in dependency order
-            # Combine headers with filename, handling both list and set types
-            all_files = list(headers) + [filename] if filename not in headers else list(headers)
-            for fname in all_files:
-                if self._args.verbose >= 9:
-                    print("DirectMagicFlags::readfile is processing " + fname)
-                
-                # To match the output of the C Pre Processor we insert
-                # the filename before the text
-                file_header = '# 1 "' + compiletools.wrappedos.realpath(fname) + '"\n'
-                
-                # Read file content using FileAnalyzer respecting max_file_read_size configuration
-                max_read_size = getattr(self._args, 'max_file_read_size', 0)
-                
-                # Use FileAnalyzer for efficient file reading
-                # Note: create_file_analyzer() handles StringZilla/Legacy fallback internally
-                analyzer = create_file_analyzer(fname, max_read_size, self._args.verbose)
-                analysis_result = analyzer.analyze()
-                file_content = analysis_result.text
-                
-                # Process conditional compilation for this file
-                processed_content = self._process_conditional_compilation(file_content)
-                
-                text += file_header + processed_content
-
-        return text
+        # To match the output of the C Pre Processor we insert
+        # the filename before the text
+        return "".join(
+            '# 1 "' + preprocessed.realpath + '"\n' + preprocessed.text
+            for preprocessed in self._preprocessed_files(filename)
+        )
+
+    def _file_magic_flags(self, preprocessed):
+        """Return the (magic, flag) pairs in a single preprocessed file.
+        The result depends only on the file's contents and the macro context
+        it was preprocessed in, so it is cached on the identity of the pass
+        rather than on the text (which would keep every text alive) and a
+        header included by many sources is searched once per macro context
+        rather than once per source.
+        """
+        if not preprocessed.has_magic:
+            return ()
+        cachekey = preprocessed.cachekey
+        try:
+            return _file_magic_flags[cachekey]
+        except KeyError:
+            pass
+
+        flags = []
+        for match in self.magicpattern.finditer(preprocessed.text):
+            magic, flag = match.groups()
+            if magic == "SOURCE":
+                flag = self._resolve_source(flag, preprocessed.realpath)
+            flags.append((magic, flag))
+        flags = tuple(flags)
+        _file_magic_flags[cachekey] = flags
+        return flags
+
+    def _magic_flags(self, filename, headers=None):
+        """Yield (file, magic, flag) one file at a time.  The flags for
+        filename are the ordered union of the flags of every file it pulls in.
+        SOURCE flags are resolved against the file they came from.
+        """
+        with compiletools.timing.time_operation("magic_flags_readfile", filename):
+            passes = self._preprocessed_files(filename, headers)
+        for preprocessed in passes:
+            for magic, flag in self._file_magic_flags(preprocessed):
+                yield preprocessed.realpath, magic, flag
 
     def parse(self, filename):
         return self._parse(filename)
 
     @staticmethod
     def clear_cache():
-        pass
+        _file_magic_flags.clear()
 
 
 class CppMagicFlags(MagicFlagsBase):
+    # There is no per file magic flag cache here.  cpp preprocesses the
+    # whole translation unit in one run so there are no per file passes or
+    # macro contexts to key a cache on, and searching cpp's output costs
+    # little next to running cpp.
+
     def __init__(self, args, headerdeps):
         MagicFlagsBase.__init__(self, args, headerdeps)
         self.preprocessor = compiletools.preprocessor.PreProcessor(args)
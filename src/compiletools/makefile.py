@@ -1,11 +1,14 @@
 # vim: set filetype=python:
 import os
 import sys
+import shlex
 from io import open
 
 import configargparse
 
 import compiletools.utils
+import compiletools.caches
+import compiletools.buildtimes
 import compiletools.wrappedos
 import compiletools.apptools
 import compiletools.headerdeps
@@ -14,6 +17,36 @@ import compiletools.hunter
 import compiletools.namer
 import compiletools.configutils
 import compiletools.timing
+import compiletools.memory
+
+
+def timing_log(namer):
+    """The log (in .ninja_log format) that the recipes append their timings
+    to when --time is given.  See compiletools.buildtimes.
+    """
+    return os.path.join(namer.executable_dir(), ".ct_make_log")
+
+
+def _quote(value):
+    """Quote value as a single shell word in a make recipe"""
+    return shlex.quote(value).replace("$", "$$")
+
+
+def _timed_recipe(args, namer, command, target, message):
+    """With --time, wrap command so that it logs how long it took to the
+    timing_log and, with -vv, prints it.  The command's exit status is kept.
+    """
+    if not getattr(args, "time", False):
+        return command
+    recipe = "@START=$$(date +%s%N); " + command + "; STATUS=$$?; END=$$(date +%s%N)"
+    # The other backends time the recipes themselves
+    if getattr(args, "backend", "make") == "make":
+        recipe += "; test $$STATUS -ne 0 || printf '%s\\t%s\\t0\\t%s\\t-\\n' $$((START/1000000)) $$((END/1000000)) {} >> {}".format(
+            _quote(target), _quote(timing_log(namer))
+        )
+    if args.verbose >= 2:
+        recipe += "; echo {}\"$$(( ($$END-$$START)/1000000 ))ms)\"".format(_quote("... " + message + " ("))
+    return recipe + "; exit $$STATUS"
 
 
 class Rule:
@@ -111,14 +144,7 @@ class LinkRuleCreator(object):
                 all_magic_ldflags.extend(magic_flags.get("LINKFLAGS", []))  # For backward compatibility with cake
             all_magic_ldflags = compiletools.utils.ordered_unique(all_magic_ldflags)
         recipe = ""
-        
-        # Add timing for link operations if enabled
-        link_timing_prefix = ""
-        link_timing_suffix = ""
-        if hasattr(self.args, 'time') and self.args.time and self.args.verbose >= 2:
-            link_timing_prefix = "@START=$$(date +%s%N); "
-            link_timing_suffix = f"; END=$$(date +%s%N); echo \"... linking {outputname} ($$(( ($$END-$$START)/1000000 ))ms)\""
-        
+
         if self.args.verbose >= 1 and not (hasattr(self.args, 'time') and self.args.time):
             recipe += " ".join(["+@echo ...", outputname, ";"])
         
@@ -128,7 +154,7 @@ class LinkRuleCreator(object):
             link_flags.insert(1, "-time")
         
         link_cmd = " ".join(link_flags)
-        recipe += link_timing_prefix + link_cmd + link_timing_suffix
+        recipe += _timed_recipe(self.args, self.namer, link_cmd, outputname, "linking " + outputname)
         return Rule(target=outputname, prerequisites=allprerequisites, recipe=recipe)
 
 
@@ -206,6 +232,9 @@ class MakefileCreator:
     command line options.
     """
 
+    # The first line of the generated file.  Followed by the args.
+    header = "# Makefile generated by "
+
     def __init__(self, args, hunter):
         self.args = args
 
@@ -221,6 +250,9 @@ class MakefileCreator:
         self.namer = compiletools.namer.Namer(args)
         self.hunter = hunter
 
+        # How long each target took in previous builds
+        self.buildtimes = compiletools.buildtimes.BuildTimes()
+
     @staticmethod
     def add_arguments(cap):
         compiletools.apptools.add_target_arguments_ex(cap)
@@ -236,7 +268,8 @@ class MakefileCreator:
         )
         cap.add(
             "--build-only-changed",
-            help="Only build the binaries depending on the source or header absolute filenames in this space-delimited list.",
+            action="append",
+            help="Only build the binaries depending on this source or header absolute filename.  May be repeated.  For compatibility, a value that is not an existing file is taken to be a whitespace delimited list of filenames.",
         )
         compiletools.utils.add_flag_argument(
             parser=cap,
@@ -246,6 +279,21 @@ class MakefileCreator:
             help="Force the unit tests to run serially rather than in parallel. Defaults to false because it is slower.",
         )
 
+    @staticmethod
+    def _build_only_changed_files(values):
+        """The set of filenames given by the --build-only-changed values"""
+        changed_files = set()
+        for changed in values:
+            if os.path.exists(changed):
+                changed_files.add(changed)
+            else:
+                changed_files.update(changed.split())
+        return changed_files
+
+    def filename(self):
+        """The name of the file that create() writes"""
+        return self.args.makefilename
+
     def _uptodate(self):
         """Is the Makefile up to date?
         If the argv has changed
@@ -255,20 +303,20 @@ class MakefileCreator:
         """
         # Check if the Makefile exists and grab its modification time if it does exist.
         try:
-            makefilemtime = compiletools.wrappedos.getmtime(self.args.makefilename)
+            makefilemtime = compiletools.wrappedos.getmtime(self.filename())
         except OSError:
             # If the Makefile doesn't exist then we aren't up to date
             if self.args.verbose > 7:
                 print("Regenerating Makefile.")
                 print(
-                    "Could not determine mtime for {}. Assuming that it doesn't exist.".format(self.args.makefilename)
+                    "Could not determine mtime for {}. Assuming that it doesn't exist.".format(self.filename())
                 )
             return False
 
         # See how the Makefile was previously generated
-        expected = "".join(["# Makefile generated by ", str(self.args)])
+        expected = "".join([self.header, str(self.args)])
 
-        with open(self.args.makefilename, mode="r", encoding="utf-8") as mfile:
+        with open(self.filename(), mode="r", encoding="utf-8") as mfile:
             previous = mfile.readline().strip()
             if previous != expected:
                 if self.args.verbose > 7:
@@ -440,6 +488,15 @@ class MakefileCreator:
         if self._uptodate():
             return
 
+        self.create_rules()
+        with compiletools.timing.time_operation("makefile_write", self.filename()):
+            self.write(self.filename())
+        return self.filename()
+
+    def create_rules(self):
+        """Fill in self.rules (and return them) without writing a Makefile.
+        Used directly by the backends that don't run make.
+        """
         # Find the realpaths of the given filenames (to avoid this being
         # duplicated many times)
         os.makedirs(self.namer.executable_dir(), exist_ok=True)
@@ -521,7 +578,7 @@ class MakefileCreator:
             self.rules[rule.target] = rule
 
         if self.args.build_only_changed:
-            changed_files = set(self.args.build_only_changed.split(" "))
+            changed_files = self._build_only_changed_files(self.args.build_only_changed)
             targets = set()
             done = False
             while not done:
@@ -550,8 +607,42 @@ class MakefileCreator:
                     new_rules[rule.target] = rule
             self.rules = new_rules
 
-        self.write(self.args.makefilename)
-        return self.args.makefilename
+        self._order_by_build_times()
+        return self.rules
+
+    def _order_by_build_times(self):
+        """make and ninja start the prerequisites of a target in the order
+        that they are listed.  So list the prerequisites with the longest
+        chain of work below them first.  Only possible once some of the
+        targets have been built by a backend that records build times.
+        """
+        if not self.buildtimes:
+            return
+
+        chains = {}
+
+        def chain(target):
+            if target in chains:
+                return chains[target]
+            rule = self.rules.get(target)
+            if rule is None:
+                return 0.0
+            chains[target] = 0.0
+            duration = 0.0
+            if rule.recipe and not rule.phony:
+                duration = self.buildtimes.expected(target)
+                if duration is None:
+                    duration = self.buildtimes.default()
+            below = [chain(prerequisite) for prerequisite in rule.prerequisites.split()]
+            chains[target] = duration + max(below, default=0.0)
+            return chains[target]
+
+        for rule in self.rules.values():
+            # The source file must stay first in a compile rule
+            if rule.target in self.objects or not rule.prerequisites:
+                continue
+            prerequisites = rule.prerequisites.split()
+            rule.prerequisites = " ".join(sorted(prerequisites, key=chain, reverse=True))
 
     def _create_object_directory(self):
         return Rule(
@@ -577,15 +668,7 @@ class MakefileCreator:
 
         magicflags = self.hunter.magicflags(filename)
         recipe = ""
-        
-        # Add timing wrapper if enabled
-        timing_prefix = ""
-        timing_suffix = ""
-        if hasattr(self.args, 'time') and self.args.time and self.args.verbose >= 2:
-            # Simple timing with elapsed time display
-            timing_prefix = "@START=$$(date +%s%N); "
-            timing_suffix = f"; END=$$(date +%s%N); echo \"... {filename} ($$(( ($$END-$$START)/1000000 ))ms)\""
-        
+
         if self.args.verbose >= 1 and not (hasattr(self.args, 'time') and self.args.time):
             recipe = " ".join(["@echo ...", filename, ";"])
         
@@ -596,15 +679,17 @@ class MakefileCreator:
             compile_flags = [self.args.CC, self.args.CFLAGS] + list(magic_cpp_flags) + list(magic_c_flags)
             if hasattr(self.args, 'time') and self.args.time and self.args.verbose >= 2:
                 compile_flags.append("-time")
+            compile_flags.extend(self._dependency_flags(obj_name))
             compile_cmd = " ".join(compile_flags + ["-c", "-o", obj_name, filename])
         else:
             magic_cxx_flags = magicflags.get("CXXFLAGS", [])
             compile_flags = [self.args.CXX, self.args.CXXFLAGS] + list(magic_cpp_flags) + list(magic_cxx_flags)
             if hasattr(self.args, 'time') and self.args.time and self.args.verbose >= 2:
                 compile_flags.append("-time")
+            compile_flags.extend(self._dependency_flags(obj_name))
             compile_cmd = " ".join(compile_flags + ["-c", "-o", obj_name, filename])
         
-        recipe += timing_prefix + compile_cmd + timing_suffix
+        recipe += _timed_recipe(self.args, self.namer, compile_cmd, obj_name, filename)
 
         if self.args.verbose >= 3:
             print("Creating rule for ", obj_name)
@@ -617,6 +702,12 @@ class MakefileCreator:
             recipe=recipe,
         )
 
+    def _dependency_flags(self, obj_name):
+        """Extra compiler flags that the build tool needs to track the headers.
+        The Makefile lists the headers in each rule so it needs none.
+        """
+        return []
+
     def _create_link_rules_for_sources(self, sources, exe_static_dynamic, libraryname=None):
         """For all the given source files return the set of rules required
         for the Makefile that will _link_ the source files into executables.
@@ -667,7 +758,7 @@ class MakefileCreator:
     def write(self, makefile_name="Makefile"):
         """Take a list of rules and write the rules to a Makefile"""
         with open(makefile_name, mode="w", encoding="utf-8") as mfile:
-            mfile.write("# Makefile generated by ")
+            mfile.write(self.header)
             mfile.write(str(self.args))
             mfile.write("\n")
             for rule in self.rules.values():
@@ -675,9 +766,7 @@ class MakefileCreator:
 
     def clear_cache(self):
         """Only useful in test scenarios where you need to reset to a pristine state"""
-        compiletools.wrappedos.clear_cache()
-        compiletools.utils.clear_cache()
-        compiletools.git_utils.clear_cache()
+        compiletools.caches.clear_all()
         self.namer.clear_cache()
         self.hunter.clear_cache()
         compiletools.magicflags.MagicFlagsBase.clear_cache()
@@ -697,5 +786,6 @@ def main(argv=None):
     makefile_creator.create()
 
     # And clean up for the test cases where main is called more than once
+    compiletools.memory.checkpoint()
     makefile_creator.clear_cache()
     return 0
@@ -1,8 +1,11 @@
 import functools
 
+import compiletools.caches
+
 def memoize_false(func):
     """ For a function that can only return true or false, memoize the false results """
     cache = func.cache = set()
+    compiletools.caches.register(compiletools.caches.cache_name(func), cache, method="." in func.__qualname__)
 
     @functools.wraps(func)
     def memoizer(*args, **kwargs):
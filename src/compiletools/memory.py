@@ -0,0 +1,215 @@
+""" Memory accounting (--memory-report).
+
+    --memory-report prints, when the tool exits, how many entries each of
+    the compiletools caches holds and roughly how much memory they use,
+    the peak RSS and the modules that allocated the most memory (from
+    tracemalloc).  Like --profile it is picked out of the command line
+    before the arguments are parsed so that tracemalloc sees every
+    allocation.  tracemalloc makes the run noticeably slower.
+
+    The tools clear their caches before they exit so they call checkpoint()
+    first.  The report shows the largest size that each cache reached.
+"""
+import os
+import gc
+import sys
+import atexit
+import tracemalloc
+
+import compiletools.caches
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# How many caches and allocating modules to print
+_TOP = 20
+
+_enabled = False
+_registered = False
+
+# Cache name -> (entries, approximate bytes) at its largest
+_peaks = {}
+
+# top_allocators() at the checkpoint with the most traced memory
+_allocators = []
+_allocated = 0
+
+
+def add_arguments(cap):
+    cap.add(
+        "--memory-report",
+        action="store_true",
+        default=False,
+        help="On exit, print the entries and approximate size of each cache, the peak RSS and the modules that allocated the most memory.  Slows the run down.",
+    )
+
+
+def start(enabled=True):
+    """ Start tracing allocations.  The report is printed when the process exits. """
+    global _enabled, _registered
+    if not enabled or _enabled:
+        return
+    _enabled = True
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if not _registered:
+        atexit.register(finish)
+        _registered = True
+
+
+def running():
+    """ Has --memory-report started tracing? """
+    return _enabled
+
+
+def stop():
+    """ Stop tracing and forget what has been measured """
+    global _enabled, _allocators, _allocated
+    _enabled = False
+    _peaks.clear()
+    _allocators = []
+    _allocated = 0
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def caches():
+    """ (name, cache) of every cache in compiletools.caches """
+    return sorted(compiletools.caches.registered(), key=lambda item: item[0])
+
+
+def _deep_size(obj, seen):
+    """ The size of obj and of the builtin containers and strings within it """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(key, seen) + _deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_size(item, seen) for item in obj)
+    return size
+
+
+def cache_usage(cache):
+    """ (entries, approximate bytes) of a registered cache.  The entries of
+        a bounded lru_cache can't be reached, only their keys, so their size
+        is underestimated.
+    """
+    entries = cache.cache_info().currsize
+    storage = getattr(cache, "storage", None)
+    if storage is None:
+        ownattributes = getattr(cache, "__dict__", None)
+        storage = next(
+            (referent for referent in gc.get_referents(cache) if isinstance(referent, dict) and referent is not ownattributes),
+            {},
+        )
+    return entries, _deep_size(storage, set())
+
+
+def checkpoint():
+    """ Remember how big each cache is and, if more memory is allocated than
+        at any earlier checkpoint, what allocated it.  Call this before
+        clearing caches.
+    """
+    global _allocators, _allocated
+    if not _enabled:
+        return
+    for name, cache in caches():
+        entries, size = cache_usage(cache)
+        peakentries, peaksize = _peaks.get(name, (0, 0))
+        _peaks[name] = (max(entries, peakentries), max(size, peaksize))
+    if tracemalloc.is_tracing():
+        current, _ = tracemalloc.get_traced_memory()
+        if current > _allocated:
+            _allocated = current
+            _allocators = top_allocators()
+
+
+def peak_rss():
+    """ The peak resident set size of this process in bytes, or None if unknown """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def format_size(size):
+    if size < 1024:
+        return "{}B".format(size)
+    for unit in ("KiB", "MiB", "GiB"):
+        size /= 1024.0
+        if size < 1024 or unit == "GiB":
+            return "{:.1f}{}".format(size, unit)
+
+
+def _module_name(filename):
+    """ compiletools/headerdeps.py rather than the full path """
+    parts = filename.replace(os.sep, "/").split("/")
+    return "/".join(parts[-2:])
+
+
+def top_allocators(count=_TOP):
+    """ (module, bytes, blocks) of the modules whose allocations are still
+        alive, largest first
+    """
+    if not tracemalloc.is_tracing():
+        return []
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<unknown>"),
+        )
+    )
+    modules = {}
+    for statistic in snapshot.statistics("filename"):
+        name = _module_name(statistic.traceback[0].filename)
+        size, blocks = modules.get(name, (0, 0))
+        modules[name] = (size + statistic.size, blocks + statistic.count)
+    ordered = sorted(modules.items(), key=lambda item: item[1][0], reverse=True)
+    return [(name, size, blocks) for name, (size, blocks) in ordered[:count]]
+
+
+def report(file=None):
+    if file is None:
+        file = sys.stderr
+    checkpoint()
+
+    print("Memory report", file=file)
+    rss = peak_rss()
+    if rss is not None:
+        print("  Peak RSS: {}".format(format_size(rss)), file=file)
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        print("  Traced by tracemalloc: {} now, {} at peak".format(format_size(current), format_size(peak)), file=file)
+
+    used = sorted(((name, usage) for name, usage in _peaks.items() if usage[0]), key=lambda item: item[1][1], reverse=True)
+    print("\n  Caches at their largest ({} of {} used):".format(len(used), len(_peaks)), file=file)
+    print("  {:>10} {:>10}  {}".format("entries", "~size", "cache"), file=file)
+    for name, (entries, size) in used[:_TOP]:
+        print("  {:>10} {:>10}  {}".format(entries, format_size(size), name), file=file)
+    if len(used) > _TOP:
+        print("  ... {} more".format(len(used) - _TOP), file=file)
+    print(
+        "  {:>10} {:>10}  total".format(sum(usage[0] for _, usage in used), format_size(sum(usage[1] for _, usage in used))),
+        file=file,
+    )
+
+    if _allocators:
+        print("\n  Top allocators by module (when the most memory was allocated):", file=file)
+        for name, size, blocks in _allocators:
+            print("  {:>10} {:>10} blocks  {}".format(format_size(size), blocks, name), file=file)
+
+
+def finish(file=None):
+    """ Print the report and stop, if --memory-report started tracing.
+        Called when the process exits, or by ct-served at the end of the
+        build that asked for the report.
+    """
+    if _enabled:
+        report(file)
+        stop()
@@ -0,0 +1,137 @@
+# vim: set filetype=python:
+""" Write the rules created by MakefileCreator as a build.ninja.
+
+    Ninja parses its input and stats the outputs much faster than make,
+    which matters most for no-op builds of large projects.  The headers are
+    not listed in the build file.  Instead each compile writes a depfile
+    (deps = gcc) that ninja folds into its deps log.
+"""
+import os
+import re
+from io import open
+
+import compiletools.makefile
+
+# Ninja prints a status line for each job so the progress echo of the
+# Makefile recipes would be printed twice
+_PROGRESS_ECHO = re.compile(r"^echo \.\.\. \S+ ;\s*")
+
+
+def _escape_path(path):
+    """ Escape a path for use in a build statement """
+    return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+
+def _ninja_command(recipe):
+    """ Turn a make recipe into a ninja command.  make and ninja both
+        write a literal $ as $$ so only the make line prefixes need removing.
+    """
+    command = recipe.lstrip()
+    while command and command[0] in "@+-":
+        command = command[1:]
+    return _PROGRESS_ECHO.sub("", command)
+
+
+class NinjaCreator(compiletools.makefile.MakefileCreator):
+    """Create a build.ninja (next to where the Makefile would go) from the
+    same rules that MakefileCreator writes into a Makefile.
+    """
+
+    header = "# build.ninja generated by "
+
+    def __init__(self, args, hunter):
+        compiletools.makefile.MakefileCreator.__init__(self, args, hunter)
+        # target -> the ninja rule that builds it, for the targets that
+        # aren't compiles (self.objects) or plain phony rules
+        self.kinds = {}
+
+    def filename(self):
+        return os.path.join(os.path.dirname(self.args.makefilename), "build.ninja")
+
+    def _dependency_flags(self, obj_name):
+        return ["-MMD", "-MF", obj_name + ".d"]
+
+    def _create_cp_rule(self, output):
+        rule = compiletools.makefile.MakefileCreator._create_cp_rule(self, output)
+        if rule is not None:
+            self.kinds[rule.target] = "copy"
+        return rule
+
+    def _create_test_rules(self, alltestsources):
+        rules = compiletools.makefile.MakefileCreator._create_test_rules(self, alltestsources)
+        for rule in rules:
+            if not rule.phony:
+                self.kinds[rule.target] = "test"
+        return rules
+
+    def _create_link_rules_for_sources(self, sources, exe_static_dynamic, libraryname=None):
+        rules = compiletools.makefile.MakefileCreator._create_link_rules_for_sources(
+            self, sources, exe_static_dynamic, libraryname
+        )
+        for rule in rules:
+            self.kinds[rule.target] = "link"
+        return rules
+
+    def _link_pool_depth(self):
+        """Linking is memory hungry and mostly serial so run fewer links than compiles"""
+        return max(1, int(self.args.parallel) // 4)
+
+    def _write_ninja_rules(self, nfile):
+        nfile.write("ninja_required_version = 1.5\n")
+        nfile.write("builddir = {}\n\n".format(os.path.dirname(self.filename()) or "."))
+
+        nfile.write("pool link_pool\n  depth = {}\n\n".format(self._link_pool_depth()))
+        if self.args.serialisetests:
+            nfile.write("pool test_pool\n  depth = 1\n\n")
+
+        nfile.write("rule compile\n  command = $cmd\n  description = ... $in\n  depfile = $out.d\n  deps = gcc\n\n")
+        nfile.write("rule link\n  command = $cmd\n  description = ... $out\n  pool = link_pool\n\n")
+        # cp ... || true may leave the copy untouched
+        nfile.write("rule copy\n  command = $cmd\n  restat = 1\n\n")
+        nfile.write("rule test\n  command = $cmd\n  description = ... $in\n")
+        if self.args.serialisetests:
+            nfile.write("  pool = test_pool\n")
+        nfile.write("\n")
+        nfile.write("rule run\n  command = $cmd\n\n")
+
+    def _write_build_statement(self, nfile, rule, skipped):
+        if rule.phony and not rule.recipe:
+            nfile.write(
+                " ".join(["build", _escape_path(rule.target) + ": phony"] + [_escape_path(pp) for pp in rule.prerequisites.split()])
+                + "\n\n"
+            )
+            return
+
+        prerequisites = rule.prerequisites.split() if rule.prerequisites else []
+        if rule.target in self.objects:
+            kind = "compile"
+            # The headers come from the depfile
+            prerequisites = prerequisites[:1]
+        else:
+            kind = self.kinds.get(rule.target, "run")
+
+        line = ["build", _escape_path(rule.target) + ":", kind] + [_escape_path(pp) for pp in prerequisites]
+        orderonly = [
+            pp for pp in (rule.order_only_prerequisites or "").split() if pp not in skipped
+        ]
+        if orderonly:
+            line.append("||")
+            line.extend(_escape_path(pp) for pp in orderonly)
+        nfile.write(" ".join(line) + "\n")
+        nfile.write("  cmd = " + _ninja_command(rule.recipe or "true") + "\n\n")
+
+    def write(self, ninja_name="build.ninja"):
+        """Take the rules and write them to a build.ninja"""
+        # Ninja creates the directories for the outputs itself and
+        # never runs the tests in parallel if they share a pool of depth 1.
+        skipped = {self.args.objdir, ".NOTPARALLEL"}
+        with open(ninja_name, mode="w", encoding="utf-8") as nfile:
+            nfile.write(self.header)
+            nfile.write(str(self.args))
+            nfile.write("\n")
+            self._write_ninja_rules(nfile)
+            for rule in self.rules.values():
+                if rule.target in skipped and rule.target not in self.kinds:
+                    continue
+                self._write_build_statement(nfile, rule, skipped)
+            nfile.write("default build\n")
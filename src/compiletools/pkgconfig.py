@@ -0,0 +1,256 @@
+"""Cached pkg-config queries shared by apptools (--pkg-config) and
+magicflags (//#PKG-CONFIG=).
+
+Every package is queried at most once per process.  When a cache directory
+is configured (see compiletools.dirnamer.user_cache_dir) the results are also
+kept on disk, keyed on the package, the pkg-config environment variables and
+the pkg-config binary, and validated against the modification times of the
+package's .pc file and of every .pc file it Requires, so a warm run does not
+fork pkg-config at all.
+"""
+
+import os
+import re
+import json
+import shutil
+import subprocess
+import concurrent.futures
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import compiletools.caches
+import compiletools.dirnamer
+
+_ENVIRONMENT_VARIABLES = ("PKG_CONFIG_PATH", "PKG_CONFIG_LIBDIR", "PKG_CONFIG_SYSROOT_DIR")
+
+_CACHE_FILENAME = "pkgconfig.json"
+
+# At most this many packages are queried at once, each with a --cflags and
+# a --libs process running together
+_MAX_CONCURRENT_QUERIES = os.cpu_count() or 1
+
+_REQUIRES_PATTERN = re.compile(r"^\s*Requires(?:\.private)?\s*:(.*)$", re.MULTILINE)
+
+# A package name is any token in a Requires line that is not a version or comparison
+_REQUIRED_PACKAGE_PATTERN = re.compile(r"[A-Za-z_][\w.+-]*")
+
+
+@dataclass(frozen=True)
+class PkgConfigFlags:
+    """The output of pkg-config --cflags and --libs for one package.
+    Include paths in cflags are given as -isystem rather than -I.  This
+    helps the CppHeaderDeps avoid searching packages.
+    """
+
+    cflags: str
+    libs: str
+
+
+# (package, environment, pkg-config executable) -> PkgConfigFlags
+_results: Dict[tuple, PkgConfigFlags] = compiletools.caches.LRUDict()
+
+# The on-disk cache, loaded at most once per process
+_persistent: Optional[dict] = None
+
+
+def _environment():
+    return tuple(os.environ.get(name, "") for name in _ENVIRONMENT_VARIABLES)
+
+
+@compiletools.caches.cached()
+def _executable(path):
+    """The pkg-config binary that the given PATH finds"""
+    return shutil.which("pkg-config", path=path)
+
+
+def _persistent_key(package, environment, executable):
+    """The on-disk cache key.  The binary's mtime is included so that
+    upgrading pkg-config does not reuse the old answers.
+    """
+    mtime = _mtime(executable) if executable else None
+    return "package:" + json.dumps([package, list(environment), executable, mtime])
+
+
+def _cachefile():
+    cachedir = compiletools.dirnamer.user_cache_dir(appname="ct")
+    if cachedir == "None":
+        return None
+    return os.path.join(cachedir, _CACHE_FILENAME)
+
+
+def _load_persistent():
+    global _persistent
+    if _persistent is None:
+        _persistent = {}
+        cachefile = _cachefile()
+        if cachefile:
+            try:
+                with open(cachefile, encoding="utf-8") as ff:
+                    _persistent = json.load(ff)
+            except (OSError, ValueError):
+                pass
+    return _persistent
+
+
+def _save_persistent():
+    cachefile = _cachefile()
+    if not cachefile:
+        return
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        tmpfile = f"{cachefile}.{os.getpid()}"
+        with open(tmpfile, "w", encoding="utf-8") as ff:
+            json.dump(_persistent, ff)
+        os.replace(tmpfile, cachefile)
+    except OSError:
+        pass
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+@compiletools.caches.cached()
+def _default_search_path(executable, mtime):
+    """The directories pkg-config searches when PKG_CONFIG_LIBDIR is not set.
+    Keyed on the pkg-config binary so that the answer can be persisted.
+    """
+    persistent = _load_persistent()
+    key = f"pc_path:{executable}:{mtime}"
+    if key in persistent:
+        return persistent[key]
+    output = subprocess.run(
+        [executable, "--variable", "pc_path", "pkg-config"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout.strip()
+    persistent[key] = output
+    _save_persistent()
+    return output
+
+
+def _search_path(executable):
+    directories = os.environ.get("PKG_CONFIG_PATH", "").split(os.pathsep)
+    libdir = os.environ.get("PKG_CONFIG_LIBDIR")
+    if libdir is None:
+        if executable:
+            libdir = _default_search_path(executable, _mtime(executable))
+    if libdir:
+        directories.extend(libdir.split(os.pathsep))
+    return [directory for directory in directories if directory]
+
+
+def _find_pc_file(package, search_path):
+    for directory in search_path:
+        candidate = os.path.join(directory, package + ".pc")
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def _pc_file_stamps(package, search_path):
+    """Return [[path, mtime], ...] for the .pc file of package and, recursively,
+    the .pc files of the packages it requires.  None if any cannot be found,
+    in which case the result is not persisted.
+    """
+    stamps = []
+    seen = set()
+    pending = [package]
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        pcfile = _find_pc_file(name, search_path)
+        if pcfile is None:
+            return None
+        stamps.append([pcfile, _mtime(pcfile)])
+        try:
+            with open(pcfile, encoding="utf-8", errors="ignore") as ff:
+                contents = ff.read()
+        except OSError:
+            return None
+        for requires in _REQUIRES_PATTERN.findall(contents):
+            pending.extend(_REQUIRED_PACKAGE_PATTERN.findall(requires))
+    return stamps
+
+
+def _query(executable, package):
+    """Run pkg-config --cflags and --libs for package.  Both are started
+    before waiting for either.
+    """
+    processes = [
+        subprocess.Popen(
+            [executable or "pkg-config", option, package],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        for option in ("--cflags", "--libs")
+    ]
+    cflags, libs = (process.communicate()[0].rstrip() for process in processes)
+    return PkgConfigFlags(cflags.replace("-I", "-isystem "), libs)
+
+
+def resolve(packages, verbose=0) -> Dict[str, PkgConfigFlags]:
+    """Return {package: PkgConfigFlags} for the given packages, in order.
+    Packages that are not already cached are queried concurrently, at most
+    _MAX_CONCURRENT_QUERIES packages (so twice as many pkg-config processes)
+    at a time.
+    """
+    environment = _environment()
+    executable = _executable(os.environ.get("PATH"))
+    resolved = {}
+    stamps = {}
+    pending = []
+    search_path = None
+    persistent = None
+    for package in packages:
+        if package in resolved or package in pending:
+            continue
+        result = _results.get((package, environment, executable))
+        if result is None:
+            if search_path is None:
+                search_path = _search_path(executable)
+                persistent = _load_persistent()
+            stamps[package] = _pc_file_stamps(package, search_path)
+            entry = persistent.get(_persistent_key(package, environment, executable))
+            if stamps[package] is not None and entry is not None and entry["stamps"] == stamps[package]:
+                result = PkgConfigFlags(entry["cflags"], entry["libs"])
+                _results[(package, environment, executable)] = result
+        if result is None:
+            pending.append(package)
+        else:
+            resolved[package] = result
+
+    if pending:
+        workers = min(len(pending), _MAX_CONCURRENT_QUERIES)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(lambda package: _query(executable, package), pending)
+            for package, result in zip(pending, results):
+                _results[(package, environment, executable)] = result
+                resolved[package] = result
+                if verbose >= 6:
+                    print(f"pkg-config {package}: cflags={result.cflags} libs={result.libs}")
+                if stamps[package] is not None:
+                    persistent[_persistent_key(package, environment, executable)] = {
+                        "stamps": stamps[package],
+                        "cflags": result.cflags,
+                        "libs": result.libs,
+                    }
+        _save_persistent()
+
+    return {package: resolved[package] for package in packages}
+
+
+def clear_cache():
+    global _persistent
+    _results.clear()
+    _persistent = None
+    _default_search_path.cache_clear()
+    _executable.cache_clear()
+
+
+compiletools.caches.register("pkgconfig._results", _results, clear=clear_cache)
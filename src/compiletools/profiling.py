@@ -0,0 +1,219 @@
+""" Profile a whole run of a ct-* tool (--profile).
+
+    --profile runs the tool under cProfile and writes a .pstats file.
+    --profile --profile-mode=sampling samples the stacks of every
+    thread instead and writes them in the collapsed stack format that
+    flamegraph.pl, speedscope and inferno read.  Either way the file goes
+    into the profiles directory of the cache directory (the current
+    directory if CTCACHE=None) and the top hotspots are printed when the
+    tool exits.
+
+    Like the variant, --profile is picked out of the command line before
+    the arguments are parsed so that the argument parsing is profiled too.
+"""
+import os
+import sys
+import time
+import atexit
+import threading
+from collections import Counter
+
+import compiletools.dirnamer
+
+_MODES = ("cprofile", "sampling")
+
+# Seconds between the samples of --profile-mode=sampling
+_SAMPLE_INTERVAL = 0.001
+
+# How many hotspots to print
+_TOP = 20
+
+_profiler = None
+_argv = None
+_registered = False
+
+
+def add_arguments(cap):
+    cap.add(
+        "--profile",
+        action="store_true",
+        default=False,
+        env_var="CT_PROFILE",
+        help="Profile this run and print the hotspots.  See --profile-mode.",
+    )
+    cap.add(
+        "--profile-mode",
+        default=_MODES[0],
+        choices=_MODES,
+        env_var="CT_PROFILE_MODE",
+        help="How --profile profiles.  cprofile writes a .pstats file and only profiles the main thread.  sampling samples every thread and writes a collapsed stack file for flame graphs.",
+    )
+
+
+def mode(args):
+    """ The profiling mode the parsed args ask for, or None """
+    if not getattr(args, "profile", False):
+        return None
+    return getattr(args, "profile_mode", _MODES[0])
+
+
+def mode_from_argv(argv=None):
+    """ The profiling mode given on the command line, or None """
+    if argv is None:
+        argv = sys.argv[1:]
+    profile = False
+    mode = _MODES[0]
+    for index, arg in enumerate(argv):
+        if arg == "--profile":
+            profile = True
+        elif arg == "--profile-mode" and index + 1 < len(argv):
+            mode = argv[index + 1]
+        elif arg.startswith("--profile-mode="):
+            mode = arg.split("=", 1)[1]
+    return mode if profile and mode in _MODES else None
+
+
+class _SamplingProfiler:
+    """ Periodically record the stack of every thread (other than its own) """
+
+    suffix = ".folded"
+
+    def __init__(self, interval=_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="ct profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    @staticmethod
+    def _frame_name(code):
+        return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, filename):
+        with open(filename, "w", encoding="utf-8") as ff:
+            for stack, count in sorted(self.stacks.items()):
+                ff.write("{} {}\n".format(stack, count))
+
+    def report(self, file, top=_TOP):
+        total = sum(self.stacks.values())
+        if not total:
+            print("No samples were taken", file=file)
+            return
+        selfcounts = Counter()
+        totalcounts = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            if frames:
+                selfcounts[frames[-1]] += count
+            for frame in set(frames):
+                totalcounts[frame] += count
+        print("{} samples.  Top hotspots:".format(total), file=file)
+        print("  {:>6} {:>6}  {}".format("self%", "total%", "function"), file=file)
+        for frame, count in selfcounts.most_common(top):
+            print(
+                "  {:>6.1f} {:>6.1f}  {}".format(100.0 * count / total, 100.0 * totalcounts[frame] / total, frame),
+                file=file,
+            )
+
+
+class _CProfiler:
+    suffix = ".pstats"
+
+    def __init__(self):
+        import cProfile
+
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def write(self, filename):
+        self._profile.dump_stats(filename)
+
+    def report(self, file, top=_TOP):
+        import pstats
+
+        stats = pstats.Stats(self._profile, stream=file)
+        stats.sort_stats("tottime").print_stats(top)
+
+
+def profile_dir(argv=None):
+    """ Where the profiles are written """
+    cachedir = compiletools.dirnamer.user_cache_dir(appname="ct", argv=argv)
+    if cachedir == "None":
+        return os.getcwd()
+    return os.path.join(cachedir, "profiles")
+
+
+def running():
+    """ Is a profiler running? """
+    return _profiler is not None
+
+
+def start(mode, argv=None):
+    """ Start profiling (unless mode is None or a profiler is already
+        running).  The profile is written when stop() is called or,
+        failing that, when the process exits.
+    """
+    global _profiler, _argv, _registered
+    if mode is None or _profiler is not None:
+        return
+    _profiler = _SamplingProfiler() if mode == "sampling" else _CProfiler()
+    _argv = argv
+    _profiler.start()
+    if not _registered:
+        atexit.register(stop)
+        _registered = True
+
+
+def stop(file=None):
+    """ Stop profiling, write the profile and print the hotspots.
+        Returns the profile's filename (None if nothing was being profiled).
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return None
+    profiler.stop()
+    if file is None:
+        file = sys.stderr
+
+    directory = profile_dir(_argv)
+    tool = os.path.basename(sys.argv[0]) or "ct"
+    filename = os.path.join(
+        directory, "{}-{}-{}{}".format(tool, time.strftime("%Y%m%d-%H%M%S"), os.getpid(), profiler.suffix)
+    )
+    try:
+        os.makedirs(directory, exist_ok=True)
+        profiler.write(filename)
+    except OSError as err:
+        print("Failed to write the profile: {}".format(err), file=file)
+        filename = None
+
+    profiler.report(file)
+    if filename:
+        print("Wrote the profile to {}".format(filename), file=file)
+    return filename
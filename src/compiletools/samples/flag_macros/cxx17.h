@@ -0,0 +1,2 @@
+#pragma once
+inline int standard() { return 0; }
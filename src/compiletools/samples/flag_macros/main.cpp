@@ -0,0 +1,20 @@
+// Which headers are used depends on the macros that the compiler
+// predefines for the -std and -O flags in CXXFLAGS
+#if __cplusplus >= 202002L
+#include "cxx20.h"
+#else
+#include "cxx17.h"
+#endif
+
+#ifdef __OPTIMIZE__
+#include "optimized.h"
+#endif
+
+#ifndef CT_HAVE_OPTIMIZED
+inline int optimized() { return 0; }
+#endif
+
+int main()
+{
+    return standard() + optimized();
+}
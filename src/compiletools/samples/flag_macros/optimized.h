@@ -0,0 +1,3 @@
+#pragma once
+#define CT_HAVE_OPTIMIZED
+inline int optimized() { return 0; }
@@ -0,0 +1,16 @@
+#ifndef FEATURE_SELECT_H
+#define FEATURE_SELECT_H
+
+#if CT_VERSION_AT_LEAST(2, 5)
+#include "modern.h"
+#else
+#include "legacy.h"
+#endif
+
+#if CT_HAVE(THREADS) && !CT_VERSION_AT_LEAST(4, 0)
+#include "threads.h"
+#else
+#include "nothreads.h"
+#endif
+
+#endif
@@ -0,0 +1,4 @@
+#ifndef LEGACY_H
+#define LEGACY_H
+inline int feature_value() { return 1; }
+#endif
@@ -0,0 +1,6 @@
+#include "version_check.h"
+#include "feature_select.h"
+
+int main() {
+    return feature_value() + thread_count();
+}
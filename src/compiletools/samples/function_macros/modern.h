@@ -0,0 +1,4 @@
+#ifndef MODERN_H
+#define MODERN_H
+inline int feature_value() { return 0; }
+#endif
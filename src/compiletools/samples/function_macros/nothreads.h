@@ -0,0 +1,4 @@
+#ifndef NOTHREADS_H
+#define NOTHREADS_H
+inline int thread_count() { return 1; }
+#endif
@@ -0,0 +1,4 @@
+#ifndef THREADS_H
+#define THREADS_H
+inline int thread_count() { return 0; }
+#endif
@@ -0,0 +1,15 @@
+#ifndef VERSION_CHECK_H
+#define VERSION_CHECK_H
+
+#define CT_LIB_MAJOR 3
+#define CT_LIB_MINOR 1
+
+// Function-like version check in the style of GCC_VERSION_AT_LEAST
+#define CT_VERSION_AT_LEAST(major, minor) \
+    ((CT_LIB_MAJOR > (major)) || (CT_LIB_MAJOR == (major) && CT_LIB_MINOR >= (minor)))
+
+// Token pasting feature check in the style of abseil config headers
+#define CT_HAVE(feature) CT_HAVE_##feature
+#define CT_HAVE_THREADS 1
+
+#endif
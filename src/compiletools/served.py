@@ -0,0 +1,308 @@
+""" ct-served: a long lived ct-cake that keeps its caches warm between builds.
+
+    ``ct-cake --server ...`` sends its argv, working directory, environment
+    and stdin/stdout/stderr over a Unix socket.  The server runs the build
+    as if it were that process and replies with the return code.
+
+    The expensive caches (file analysis, preprocessing passes, magic flags,
+    include lookups, compiler macro probes, pkg-config) survive between
+    builds.  Before each build the entries of the files that inotify
+    reported as changed are dropped (see cake.forget_changed_files) and the
+    compiler probes are forgotten if a compiler binary has changed.
+    Anything a build sets up for itself (--profile, --memory-report, signal
+    handlers) is finished or undone when that build ends.
+"""
+import os
+import sys
+import json
+import socket
+import struct
+import signal
+import selectors
+import tempfile
+import traceback
+
+import compiletools.apptools
+import compiletools.memory
+import compiletools.cake
+import compiletools.compiler_macros
+import compiletools.inotify
+import compiletools.profiling
+import compiletools.wrappedos
+
+
+def default_socket_path():
+    """ $CTSERVED_SOCKET, else $XDG_RUNTIME_DIR/ct-served.sock, else a per user file in the temp dir """
+    socketpath = os.environ.get("CTSERVED_SOCKET")
+    if socketpath:
+        return socketpath
+    runtimedir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtimedir and os.path.isdir(runtimedir):
+        return os.path.join(runtimedir, "ct-served.sock")
+    return os.path.join(tempfile.gettempdir(), "ct-served-{}.sock".format(os.getuid()))
+
+
+def _recvall(sock, data=b""):
+    chunks = [data]
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def request(argv, socketpath=None):
+    """ Ask ct-served to run ct-cake with the given argv on behalf of this
+        process.  Returns the build's return code, or None if no server is
+        listening on socketpath.
+    """
+    if socketpath is None:
+        socketpath = default_socket_path()
+    message = json.dumps({"argv": argv, "cwd": os.getcwd(), "environ": dict(os.environ)}).encode()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socketpath)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+
+        # The server writes straight to our stdout/stderr so flush ours first
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sent = socket.send_fds(sock, [message], [0, 1, 2])
+        sock.sendall(message[sent:])
+        sock.shutdown(socket.SHUT_WR)
+        reply = _recvall(sock)
+
+    if not reply:
+        print("ct-served closed the connection without replying", file=sys.stderr)
+        return 1
+    return json.loads(reply)["returncode"]
+
+
+class Server(object):
+
+    """ Listen on socketpath and run one build at a time.  Builds change
+        process wide state (cwd, environment, file descriptors) so they
+        are never run concurrently.
+    """
+
+    def __init__(self, socketpath, verbose=0):
+        self.socketpath = socketpath
+        self.verbose = verbose
+        self.builds = 0
+        self._listener = None
+        self._watcher = None
+        # (path, mask) changes since the last build, None if anything may have changed
+        self._changes = []
+
+        if compiletools.inotify.available():
+            try:
+                self._watcher = compiletools.inotify.Inotify()
+            except OSError as err:
+                if verbose >= 1:
+                    print("ct-served: inotify unavailable ({}). Caches will be revalidated on every build.".format(err))
+
+    def _log(self, message, level=1):
+        if self.verbose >= level:
+            print("ct-served: " + message, file=sys.stderr, flush=True)
+
+    def _bind(self):
+        if os.path.exists(self.socketpath):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(self.socketpath)
+                    raise RuntimeError("ct-served is already listening on " + self.socketpath)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Left over from a server that didn't shut down cleanly
+                    os.unlink(self.socketpath)
+
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.socketpath)
+        # Only this user may ask for builds
+        os.chmod(self.socketpath, 0o600)
+        self._listener.listen()
+
+    def _note_changes(self, changes):
+        for path, mask in changes:
+            self._log("changed {}".format(path), level=5)
+            if path is None:
+                self._changes = None
+            elif self._changes is not None:
+                self._changes.append((path, mask))
+
+    def _invalidate(self):
+        if self._watcher is not None:
+            # Pick up anything written since the select woke us
+            self._note_changes(self._watcher.read(timeout=0))
+            changes = self._changes
+        else:
+            changes = None
+        self._changes = []
+        if changes is None:
+            self._log("revalidating file system caches", level=3)
+        elif changes:
+            self._log("forgetting {} changed files".format(len({path for path, _ in changes})), level=3)
+        compiletools.cake.forget_changed_files(changes)
+        compiletools.compiler_macros.revalidate(self.verbose)
+
+    def _watch(self, cake):
+        """ Watch every directory that the build looked in """
+        if self._watcher is None or cake is None or cake.hunter is None:
+            return
+        args = cake.args
+        directories = {os.getcwd(), compiletools.wrappedos.dirname(os.path.realpath(args.makefilename))}
+        directories.add(cake.namer.executable_dir())
+        directories.add(compiletools.wrappedos.realpath(args.objdir))
+        directories.update(getattr(cake.headerdeps, "includes", []))
+
+        roots = []
+        for sources in (args.filename, args.tests, args.static, args.dynamic):
+            roots.extend(sources or [])
+        for root in roots:
+            for filename in cake.hunter.required_files(root):
+                directories.add(compiletools.wrappedos.dirname(filename))
+
+        for directory in directories - self._watcher.watching():
+            if self._watcher.watch(directory):
+                self._log("watching " + directory, level=6)
+
+    def _build(self, message, fds):
+        """ Run ct-cake as the client would have.  Returns the return code """
+        saved_cwd = os.getcwd()
+        saved_environ = dict(os.environ)
+        saved_argv = sys.argv
+        saved_fds = [os.dup(fd) for fd in (0, 1, 2)]
+        saved_handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGPIPE)}
+        # Unless ct-served itself is being profiled or traced, a build's
+        # --profile and --memory-report belong to that build
+        ownprofile = not compiletools.profiling.running()
+        ownmemory = not compiletools.memory.running()
+        cake = None
+        try:
+            os.chdir(message["cwd"])
+            os.environ.clear()
+            os.environ.update(message["environ"])
+            sys.argv = ["ct-cake"] + message["argv"]
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, clientfd in zip((0, 1, 2), fds):
+                os.dup2(clientfd, fd)
+
+            self._invalidate()
+            compiletools.apptools.resetparsers()
+            compiletools.apptools.resetcallbacks()
+            try:
+                returncode, cake = compiletools.cake.build(message["argv"], keep_cache=True)
+                self._watch(cake)
+            except SystemExit as err:
+                returncode = err.code if isinstance(err.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+        finally:
+            # Report to the client, whose stderr is still in place
+            if ownprofile:
+                compiletools.profiling.stop()
+            if ownmemory:
+                compiletools.memory.finish()
+            for signum, handler in saved_handlers.items():
+                signal.signal(signum, handler)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, savedfd in zip((0, 1, 2), saved_fds):
+                os.dup2(savedfd, fd)
+                os.close(savedfd)
+            for clientfd in fds:
+                os.close(clientfd)
+            sys.argv = saved_argv
+            os.environ.clear()
+            os.environ.update(saved_environ)
+            os.chdir(saved_cwd)
+            compiletools.memory.checkpoint()
+            compiletools.cake.clear_instance_caches()
+        self.builds += 1
+        return returncode
+
+    def _handle(self, conn):
+        with conn:
+            uid = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))[1]
+            if uid != os.getuid():
+                self._log("refusing connection from uid {}".format(uid))
+                return
+            data, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+            message = json.loads(_recvall(conn, data))
+            if len(fds) != 3:
+                for fd in fds:
+                    os.close(fd)
+                conn.sendall(json.dumps({"returncode": 1}).encode())
+                return
+            self._log("building {} in {}".format(" ".join(message["argv"]), message["cwd"]), level=2)
+            returncode = self._build(message, fds)
+            try:
+                conn.sendall(json.dumps({"returncode": returncode}).encode())
+            except OSError:
+                # The client went away
+                pass
+
+    def serve_forever(self, max_builds=None):
+        self._bind()
+        self._log("listening on " + self.socketpath)
+        selector = selectors.DefaultSelector()
+        selector.register(self._listener, selectors.EVENT_READ)
+        if self._watcher is not None:
+            selector.register(self._watcher, selectors.EVENT_READ)
+        try:
+            while max_builds is None or self.builds < max_builds:
+                for key, _ in selector.select():
+                    if key.fileobj is self._watcher:
+                        self._note_changes(self._watcher.read(timeout=0))
+                    else:
+                        conn, _ = self._listener.accept()
+                        self._handle(conn)
+        finally:
+            selector.close()
+            self.close()
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+            try:
+                os.unlink(self.socketpath)
+            except OSError:
+                pass
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+
+def add_arguments(cap):
+    cap.add(
+        "--socket",
+        help="Unix socket to listen on.  Defaults to $CTSERVED_SOCKET, then $XDG_RUNTIME_DIR/ct-served.sock, then ct-served-<uid>.sock in the temp dir.",
+    )
+    cap.add(
+        "--max-builds",
+        type=int,
+        help="Exit after serving this many builds.  Mostly useful for testing.",
+    )
+
+
+def main(argv=None):
+    cap = compiletools.apptools.create_parser(
+        "Keep ct-cake's caches warm between builds. Use ct-cake --server to send it builds.",
+        argv=argv,
+        include_config=False,
+    )
+    add_arguments(cap)
+    args = cap.parse_args(args=argv)
+    server = Server(args.socket or default_socket_path(), verbose=args.verbose)
+    try:
+        server.serve_forever(max_builds=args.max_builds)
+    except RuntimeError as err:
+        print(err, file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
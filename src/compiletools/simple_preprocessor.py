@@ -1,7 +1,85 @@
 """Simple C preprocessor for handling conditional compilation directives."""
 
 import sys
+import re
+from dataclasses import dataclass
+from typing import FrozenSet, Tuple
+import compiletools.caches
 import compiletools.compiler_macros
+import compiletools.wrappedos
+from compiletools.file_analyzer import create_file_analyzer
+from compiletools.macro_state import MacroEnvironment, MacroSnapshot, as_snapshot
+
+
+@dataclass(frozen=True)
+class FunctionMacro:
+    """The value stored for a function-like macro, #define NAME(params) body.
+
+    For variadic macros the last parameter is the name the variable arguments
+    are bound to (__VA_ARGS__ for a bare "...").
+    """
+    name: str
+    params: Tuple[str, ...]
+    body: str
+    variadic: bool = False
+
+
+# Name, optional parameter list (only when "(" immediately follows the name) and body
+_DEFINE_PATTERN = re.compile(r"([A-Za-z_][A-Za-z0-9_]*)(?:\(([^)]*)\))?\s*(.*)", re.DOTALL)
+
+# Numbers (including suffixes like UL and hex digits) are matched so that they pass through untouched
+_TOKEN_PATTERN = re.compile(r"[0-9][A-Za-z0-9_.]*|[A-Za-z_][A-Za-z0-9_]*")
+
+_DEFINED_OPERAND_PATTERN = re.compile(r"\s*(?:\(\s*([A-Za-z_][A-Za-z0-9_]*)\s*\)|([A-Za-z_][A-Za-z0-9_]*))")
+
+_BODY_TOKEN_PATTERN = re.compile(r"(##)|#\s*([A-Za-z_][A-Za-z0-9_]*)|([A-Za-z_][A-Za-z0-9_]*)")
+
+_RESERVED_WORDS = frozenset(("and", "or", "not"))
+
+
+def _parse_macro_parameters(paramtext):
+    """Return (params, variadic) for the text between the parentheses of a #define"""
+    params = [param.strip() for param in paramtext.split(",")] if paramtext.strip() else []
+    variadic = False
+    if params and params[-1].endswith("..."):
+        variadic = True
+        params[-1] = params[-1][:-3].strip() or "__VA_ARGS__"
+    return tuple(params), variadic
+
+
+@compiletools.caches.cached()
+def _substitute_arguments(macro, raw_args, expanded_args):
+    """Replace the parameters in the body of a function-like macro.
+
+    This is a pure function of the macro and its arguments so the result is
+    memoized and shared by every file that invokes, say, GCC_VERSION_AT_LEAST(9,1).
+    As in C, operands of # and ## use the raw argument, everything else the
+    macro expanded argument.
+    """
+    fixed = macro.params[:-1] if macro.variadic else macro.params
+    raw = dict(zip(fixed, raw_args))
+    expanded = dict(zip(fixed, expanded_args))
+    if macro.variadic:
+        raw[macro.params[-1]] = ", ".join(raw_args[len(fixed):])
+        expanded[macro.params[-1]] = ", ".join(expanded_args[len(fixed):])
+
+    body = macro.body
+
+    def replace(match):
+        paste, stringified, identifier = match.groups()
+        if paste:
+            return paste
+        if stringified is not None:
+            if stringified in raw:
+                return '"' + raw[stringified].replace('"', '\\"') + '"'
+            return match.group(0)
+        if identifier not in raw:
+            return identifier
+        pasted = body[:match.start()].rstrip().endswith("##") or body[match.end():].lstrip().startswith("##")
+        return raw[identifier] if pasted else expanded[identifier]
+
+    body = _BODY_TOKEN_PATTERN.sub(replace, body)
+    return re.sub(r"\s*##\s*", "", body)
 
 
 class SimplePreprocessor:
@@ -14,21 +92,29 @@ class SimplePreprocessor:
     - Evaluates logical (&&, ||, ! and and/or/not), comparison, bitwise (&, |, ^, ~) and shift (<<, >>) operators
     - Strips // and /* ... */ comments from expressions in directives
     - Respects inactive branches (directives only alter state when active)
+    - Defines and expands function-like macros, e.g. GCC_VERSION_AT_LEAST(9,1),
+      including variadic parameters, # stringification and ## pasting
     - Provides recursive macro expansion helper for advanced use
+    - Keeps macros in a copy-on-write MacroEnvironment so that snapshot()
+      yields a cheap, hashable MacroSnapshot of the resulting state
     """
     
     def __init__(self, defined_macros, verbose=0):
-        # Use a dict to store macro values, not just existence
-        self.macros = {}
-        # Initialize with existing defined macros
-        if isinstance(defined_macros, dict):
-            # defined_macros is already a dict of name->value
-            self.macros.update(defined_macros)
-        else:
-            # Legacy compatibility: defined_macros is a set of names
-            for macro in defined_macros:
-                self.macros[macro] = "1"  # Default value for macros without explicit values
+        # Macro values live in a copy-on-write environment layered over an
+        # immutable snapshot.  Passing a MacroSnapshot makes construction O(1);
+        # a dict (or the legacy set of names) is frozen into a new snapshot first.
+        self.macros = MacroEnvironment(as_snapshot(defined_macros))
         self.verbose = verbose
+        # Fully expanded function-like macro invocations keyed on (name, args).
+        # Only valid while the macros are unchanged so #define/#undef clear it.
+        self._expansion_cache = {}
+        # Every macro name that an evaluated conditional looked at, including
+        # the names reached while expanding other macros
+        self.referenced_macros = set()
+
+    def snapshot(self):
+        """Return an immutable MacroSnapshot of the current macro state"""
+        return self.macros.snapshot()
         
     
     def _strip_comments(self, expr):
@@ -173,18 +259,20 @@ class SimplePreprocessor:
         if not condition_stack[-1][0]:
             return  # Not in active context
             
-        parts = args.split(None, 1)
-        if not parts:
+        match = _DEFINE_PATTERN.match(args.strip())
+        if not match:
             return
-            
-        macro_name = parts[0]
-        macro_value = parts[1] if len(parts) > 1 else "1"
-        
-        # Handle function-like macros by extracting just the name part
-        if '(' in macro_name:
-            macro_name = macro_name.split('(')[0]
-            
+
+        macro_name, paramtext, body = match.groups()
+        body = self._strip_comments(body.strip())
+        if paramtext is None:
+            macro_value = body if body else "1"
+        else:
+            params, variadic = _parse_macro_parameters(paramtext)
+            macro_value = FunctionMacro(macro_name, params, body, variadic)
+
         self.macros[macro_name] = macro_value
+        self._expansion_cache.clear()
         if self.verbose >= 9:
             print(f"SimplePreprocessor: defined macro {macro_name} = {macro_value}")
     
@@ -196,12 +284,14 @@ class SimplePreprocessor:
         macro_name = args.strip()
         if macro_name in self.macros:
             del self.macros[macro_name]
+            self._expansion_cache.clear()
             if self.verbose >= 9:
                 print(f"SimplePreprocessor: undefined macro {macro_name}")
     
     def _handle_ifdef(self, args, condition_stack):
         """Handle #ifdef directive"""
         macro_name = args.strip()
+        self.referenced_macros.add(macro_name)
         is_defined = macro_name in self.macros
         is_active = is_defined and condition_stack[-1][0]
         condition_stack.append((is_active, False, is_active))
@@ -211,6 +301,7 @@ class SimplePreprocessor:
     def _handle_ifndef(self, args, condition_stack):
         """Handle #ifndef directive"""
         macro_name = args.strip()
+        self.referenced_macros.add(macro_name)
         is_defined = macro_name in self.macros
         is_active = (not is_defined) and condition_stack[-1][0]
         condition_stack.append((is_active, False, is_active))
@@ -303,6 +394,7 @@ class SimplePreprocessor:
         # Handle defined(MACRO)
         def replace_defined_paren(match):
             macro_name = match.group(1)
+            self.referenced_macros.add(macro_name)
             return "1" if macro_name in self.macros else "0"
         
         expr = re.sub(r'defined\s*\(\s*([A-Za-z_][A-Za-z0-9_]*)\s*\)', replace_defined_paren, expr)
@@ -310,6 +402,7 @@ class SimplePreprocessor:
         # Handle defined MACRO (without parentheses)
         def replace_defined_space(match):
             macro_name = match.group(1)
+            self.referenced_macros.add(macro_name)
             return "1" if macro_name in self.macros else "0"
         
         expr = re.sub(r'defined\s+([A-Za-z_][A-Za-z0-9_]*)', replace_defined_space, expr)
@@ -319,34 +412,115 @@ class SimplePreprocessor:
     def _expand_macros(self, expr):
         """Replace macro names with their values.
 
+        Object-like macros are expanded recursively and function-like macros
+        are invoked with their arguments.  As in a real #if, identifiers
+        that remain after expansion evaluate to 0.
+
         Avoid replacing logical word operators 'and', 'or', 'not' so our later
         operator translation still works even if users type them explicitly.
         """
-        import re
+        expr = self._expand_macro_invocations(expr, frozenset())
 
-        reserved = {"and", "or", "not"}
+        def replace_remaining(match):
+            token = match.group(0)
+            if token[0].isdigit() or token in _RESERVED_WORDS:
+                return token
+            # Undefined macro defaults to 0
+            return "0"
 
-        def replace_macro(match):
-            macro_name = match.group(0)
-            if macro_name in reserved:
-                return macro_name
-            if macro_name in self.macros:
-                value = self.macros[macro_name]
-                # Try to convert to int if possible
-                try:
-                    return str(int(value))
-                except ValueError:
-                    return value
+        return _TOKEN_PATTERN.sub(replace_remaining, expr)
+
+    def _expand_macro_invocations(self, expr, hidden):
+        """Expand the macros in expr, leaving unknown identifiers in place.
+        Names in hidden are currently being expanded and are not expanded
+        again, which stops self-referential macros from looping.
+        """
+        result = []
+        pos = 0
+        while True:
+            match = _TOKEN_PATTERN.search(expr, pos)
+            if not match:
+                result.append(expr[pos:])
+                break
+            result.append(expr[pos:match.start()])
+            token = match.group(0)
+            pos = match.end()
+
+            if token == "defined":
+                operand = _DEFINED_OPERAND_PATTERN.match(expr, pos)
+                if operand:
+                    macro_name = operand.group(1) or operand.group(2)
+                    self.referenced_macros.add(macro_name)
+                    result.append("1" if macro_name in self.macros else "0")
+                    pos = operand.end()
+                    continue
+
+            value = None
+            if not token[0].isdigit() and token not in hidden:
+                self.referenced_macros.add(token)
+                value = self.macros.get(token)
+
+            if value is None:
+                result.append(token)
+            elif isinstance(value, FunctionMacro):
+                invocation = self._parse_macro_arguments(expr, pos, value)
+                if invocation is None:
+                    # A function-like macro name without arguments is not expanded
+                    result.append(token)
+                    continue
+                call_args, pos = invocation
+                result.append(self._expand_function_macro(value, call_args, hidden))
             else:
-                # Undefined macro defaults to 0
-                return "0"
+                result.append(self._expand_macro_invocations(value, hidden | {token}))
 
-        # Replace macro names (identifiers) with their values
-        # Use word boundaries to avoid replacing parts of numbers or other tokens
-        expr = re.sub(r'(?<![0-9])\b[A-Za-z_][A-Za-z0-9_]*\b(?![0-9])', replace_macro, expr)
+        return "".join(result)
+
+    @staticmethod
+    def _parse_macro_arguments(expr, pos, macro):
+        """Parse the parenthesised arguments that start at or after pos.
+        Returns (tuple of argument strings, position after the closing paren)
+        or None if there is no well formed argument list.
+        """
+        while pos < len(expr) and expr[pos].isspace():
+            pos += 1
+        if pos >= len(expr) or expr[pos] != "(":
+            return None
+
+        call_args = []
+        depth = 0
+        start = pos + 1
+        for index in range(pos, len(expr)):
+            char = expr[index]
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+                if depth == 0:
+                    call_args.append(expr[start:index].strip())
+                    if call_args == [""] and not macro.params:
+                        call_args = []
+                    return tuple(call_args), index + 1
+            elif char == "," and depth == 1:
+                call_args.append(expr[start:index].strip())
+                start = index + 1
+        return None
+
+    def _expand_function_macro(self, macro, call_args, hidden):
+        """Expand a single invocation of a function-like macro"""
+        key = (macro.name, call_args, hidden)
+        try:
+            return self._expansion_cache[key]
+        except KeyError:
+            pass
+
+        expanded_args = tuple(self._expand_macro_invocations(arg, hidden) for arg in call_args)
+        body = _substitute_arguments(macro, call_args, expanded_args)
+        expansion = self._expand_macro_invocations(body, hidden | {macro.name})
+        self._expansion_cache[key] = expansion
+        if self.verbose >= 9:
+            print(f"SimplePreprocessor: expanded {macro.name}({', '.join(call_args)}) -> {expansion}")
+        return expansion
 
-        return expr
-    
     def _recursive_expand_macros(self, expr, max_iterations=10):
         """Recursively expand macros until no more changes occur or max iterations reached"""
         import re
@@ -355,6 +529,8 @@ class SimplePreprocessor:
             macro_name = match.group(0)
             if macro_name in self.macros:
                 value = self.macros[macro_name]
+                if isinstance(value, FunctionMacro):
+                    return macro_name
                 # Try to convert to int if possible
                 try:
                     return str(int(value))
@@ -462,4 +638,74 @@ class SimplePreprocessor:
         expr = re.sub(r'\b0[bB][01]+\b', repl_bin, expr)
         # Replace octal: leading 0 followed by one or more octal digits, not 0x/0b already handled
         expr = re.sub(r'\b0[0-7]+\b', repl_oct, expr)
-        return expr
\ No newline at end of file
+        return expr
+
+
+@dataclass(frozen=True)
+class PreprocessedFile:
+    """The result of one conditional compilation pass over a file.
+
+    text is the active source and macros is the MacroSnapshot in effect at
+    the end of the file, i.e., the state that the next file starts from.
+    entry_macros is the state the pass started from.  defined holds the names
+    the file #defined or #undefined and referenced the names its conditionals
+    depended on.  has_magic is False when the FileAnalyzer found no //#KEY=
+    lines anywhere in the file, so magic flag extraction can skip it.
+    cachekey identifies the pass, (realpath, mtime, entry_macros.key,
+    max_read_size), for caches of results derived from it.
+    """
+    realpath: str
+    text: str
+    macros: MacroSnapshot
+    entry_macros: MacroSnapshot
+    defined: FrozenSet[str]
+    referenced: FrozenSet[str]
+    has_magic: bool = True
+    cachekey: tuple = ()
+
+
+# (realpath, mtime, macros.key, max_read_size) -> PreprocessedFile
+_preprocessed_files = compiletools.caches.LRUDict()
+compiletools.caches.register("simple_preprocessor._preprocessed_files", _preprocessed_files, path=lambda key: key[0])
+
+
+def preprocess_file(realpath, macros, max_read_size=0, verbose=0):
+    """Run SimplePreprocessor over the given file starting from macros.
+
+    The result only depends on the file contents and the incoming macro
+    state so it is shared between everything that walks the include graph.
+    DirectHeaderDeps and DirectMagicFlags both get here, and whichever runs
+    second finds the pass already done.
+    """
+    macros = as_snapshot(macros)
+    try:
+        mtime = compiletools.wrappedos.getmtime(realpath)
+    except OSError:
+        mtime = None
+    cachekey = (realpath, mtime, macros.key, max_read_size)
+    try:
+        return _preprocessed_files[cachekey]
+    except KeyError:
+        pass
+
+    analysis = create_file_analyzer(realpath, max_read_size, verbose).analyze()
+    preprocessor = SimplePreprocessor(macros, verbose)
+    processed_text = preprocessor.process(analysis.text)
+    defined = frozenset(preprocessor.macros.changed)
+    result = PreprocessedFile(
+        realpath,
+        processed_text,
+        preprocessor.snapshot(),
+        macros,
+        defined,
+        frozenset(preprocessor.referenced_macros),
+        bool(analysis.magic_positions),
+        cachekey,
+    )
+    _preprocessed_files[cachekey] = result
+    return result
+
+
+def clear_cache():
+    _preprocessed_files.clear()
+    _substitute_arguments.cache_clear()
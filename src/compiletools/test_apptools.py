@@ -4,6 +4,7 @@ import compiletools.uth_reload as uthr
 import os
 import argparse  # Used for the parse_args test
 import configargparse
+from unittest.mock import call, patch
 
 from importlib import reload
 
@@ -45,6 +46,28 @@ class TestFuncs:
         assert args.append_CXXFLAGS == ["-DNEWPROTOCOL -DV172"]
 
 
+    def test_prefetch_compiler_macros_only_for_direct(self):
+        args = argparse.Namespace(
+            headerdeps="cpp",
+            magic="cpp",
+            CXX="g++",
+            CC="gcc",
+            CPPFLAGS="-DFOO",
+            CXXFLAGS="-std=c++17 -O2",
+            CFLAGS="-std=c11",
+            verbose=0,
+        )
+        with patch("compiletools.compiler_macros.prefetch_compiler_macros") as mock_prefetch:
+            compiletools.apptools._prefetch_compiler_macros(args)
+            mock_prefetch.assert_not_called()
+
+            args.magic = "direct"
+            compiletools.apptools._prefetch_compiler_macros(args)
+            assert mock_prefetch.call_args_list == [
+                call("g++", 0, ("-std=c++17", "-O2"), "c++"),
+                call("gcc", 0, ("-std=c11",), "c"),
+            ]
+
 class TestConfig:
     def setup_method(self):
         uth.reset()
@@ -0,0 +1,123 @@
+import os
+
+import compiletools.buildtimes
+import compiletools.cake
+import compiletools.makefile
+import compiletools.testhelper as uth
+from compiletools.makefile import Rule
+
+
+class TestBuildTimes:
+    def test_record_and_expected(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            filename = os.path.join(tmpdir, "cache", "buildtimes.json")
+            buildtimes = compiletools.buildtimes.BuildTimes(filename)
+            assert not buildtimes
+            assert buildtimes.expected("a.o") is None
+            assert buildtimes.default() == 1.0
+
+            for seconds in range(1, 30):
+                buildtimes.record("a.o", seconds)
+            buildtimes.record("b.o", 2.0)
+            # The average of the three most recent
+            assert buildtimes.expected("a.o") == 28.0
+            assert len(buildtimes.samples("a.o")) == compiletools.buildtimes._HISTORY
+            assert buildtimes.default() == 15.0
+
+            buildtimes.save()
+            assert compiletools.buildtimes.BuildTimes(filename).expected(os.path.abspath("a.o")) == 28.0
+
+    def test_save_merges_with_other_builds(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            filename = os.path.join(tmpdir, "buildtimes.json")
+            first = compiletools.buildtimes.BuildTimes(filename)
+            second = compiletools.buildtimes.BuildTimes(filename)
+            first.record("a.o", 1.0)
+            first.record_run({"total_build_time": 2.0}, cwd=tmpdir)
+            first.save()
+            second.record("b.o", 3.0)
+            second.save()
+
+            merged = compiletools.buildtimes.BuildTimes(filename)
+            assert merged.expected("a.o") == 1.0
+            assert merged.expected("b.o") == 3.0
+            assert merged.runs[0]["phases"] == {"total_build_time": 2.0}
+            assert merged.runs[0]["cwd"] == tmpdir
+
+    def test_record_log(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            logfile = os.path.join(tmpdir, ".ninja_log")
+            with open(logfile, "w") as ff:
+                ff.write("# ninja log v5\n0\t1500\t0\tobj/a.o\tabc\n")
+            offset = os.path.getsize(logfile)
+            with open(logfile, "a") as ff:
+                ff.write("10\t2010\t0\tobj/b.o\tdef\n20\t520\t0\tobj/c.o\tghi\n30\t330\t0\tobj/c.o\tghi\n")
+
+            buildtimes = compiletools.buildtimes.BuildTimes(os.path.join(tmpdir, "buildtimes.json"))
+            assert buildtimes.record_log(logfile, offset) == 2
+            assert buildtimes.expected("obj/a.o") is None
+            assert buildtimes.expected("obj/b.o") == 2.0
+            assert buildtimes.expected("obj/c.o") == 0.3
+
+            # A recompacted log is read from the start
+            assert buildtimes.record_log(logfile, offset=10 ** 6) == 3
+            assert buildtimes.record_log(os.path.join(tmpdir, "missing")) == 0
+
+
+def test_prerequisites_are_ordered_by_longest_chain():
+    with uth.TempDirContextNoChange() as tmpdir:
+        buildtimes = compiletools.buildtimes.BuildTimes(os.path.join(tmpdir, "buildtimes.json"))
+        buildtimes.record("fast.o", 1.0)
+        buildtimes.record("slow.o", 40.0)
+        buildtimes.record("fast", 1.0)
+        buildtimes.record("slow", 1.0)
+
+        creator = compiletools.makefile.MakefileCreator.__new__(compiletools.makefile.MakefileCreator)
+        creator.buildtimes = buildtimes
+        creator.objects = {"fast.o", "slow.o", "new.o"}
+        creator.rules = {}
+        for rule in (
+            Rule(target="build", prerequisites="fast slow", phony=True),
+            Rule(target="fast", prerequisites="fast.o", recipe="ld fast.o"),
+            Rule(target="slow", prerequisites="fast.o new.o slow.o", recipe="ld fast.o slow.o"),
+            Rule(target="fast.o", prerequisites="fast.cpp a.hpp", recipe="cc fast.cpp"),
+            Rule(target="new.o", prerequisites="new.cpp", recipe="cc new.cpp"),
+            Rule(target="slow.o", prerequisites="slow.cpp a.hpp", recipe="cc slow.cpp"),
+        ):
+            creator.rules[rule.target] = rule
+
+        creator._order_by_build_times()
+        assert creator.rules["build"].prerequisites == "slow fast"
+        # new.o has never been built so is assumed to take the average time
+        assert creator.rules["slow"].prerequisites == "slow.o new.o fast.o"
+        assert creator.rules["slow.o"].prerequisites == "slow.cpp a.hpp"
+
+
+def test_make_backend_records_times_with_time():
+    with uth.TempDirContextWithChange() as tmpdir:
+        tmpdir = os.path.realpath(tmpdir)
+        with open(os.path.join(tmpdir, "good.cpp"), "w") as ff:
+            ff.write("int main() { return 0; }\n")
+        config = uth.create_temp_config(tmpdir)
+        uth.create_temp_ct_conf(tempdir=tmpdir, defaultvariant=os.path.basename(config)[:-5])
+        cachedir = os.path.join(tmpdir, "cache")
+        argv = ["--exemarkers=main", "--testmarkers=unittest.hpp", "--config=" + config, "--time"]
+        with uth.EnvironmentContext({"CTCACHE": cachedir}):
+            uth.reset()
+            try:
+                assert compiletools.cake.main(argv + ["good.cpp"]) == 0
+
+                # The timing wrapper must not hide a failed compile
+                with open(os.path.join(tmpdir, "bad.cpp"), "w") as ff:
+                    ff.write("int main() { return undeclared; }\n")
+                uth.reset()
+                assert compiletools.cake.main(argv + ["bad.cpp"]) == 1
+            finally:
+                uth.reset()
+
+        buildtimes = compiletools.buildtimes.BuildTimes(os.path.join(cachedir, "buildtimes.json"))
+        targets = [os.path.basename(target) for target in buildtimes.targets]
+        assert any(target.endswith("good.o") for target in targets)
+        assert "good" in targets
+        assert not any(target.endswith("bad.o") for target in targets)
+        assert "total_build_time" in buildtimes.runs[0]["phases"]
@@ -0,0 +1,178 @@
+
+import pytest
+import configargparse
+
+import compiletools.apptools
+import compiletools.caches
+import compiletools.wrappedos
+import compiletools.headerdeps
+
+
+@compiletools.caches.cached()
+def _double(value):
+    return 2 * value
+
+
+class _Owner:
+    @staticmethod
+    @compiletools.caches.cached()
+    def triple(value):
+        return 3 * value
+
+    @compiletools.caches.cached()
+    def quadruple(self, value):
+        return 4 * value
+
+
+_seen = {}
+compiletools.caches.register("test_caches._seen", _seen)
+
+_bounded = compiletools.caches.LRUDict()
+compiletools.caches.register("test_caches._bounded", _bounded)
+
+
+@pytest.fixture(autouse=True)
+def pristine():
+    compiletools.caches.configure(["test_caches.*=None"])
+    compiletools.caches.clear_all()
+    yield
+    compiletools.caches.configure(["test_caches.*=None"])
+    compiletools.caches.clear_all()
+
+
+def test_modules_register_their_caches():
+    names = [name for name, _ in compiletools.caches.registered()]
+    assert "wrappedos.realpath" in names
+    assert "headerdeps.DirectHeaderDeps._find_include_in" in names
+    assert "test_caches._double" in names
+    assert "test_caches._Owner.triple" in names
+    assert "test_caches._seen" in names
+    assert len(names) == len(set(names))
+
+
+def test_stats_counts_hits_and_misses():
+    _double(1)
+    _double(1)
+    _double(2)
+    _seen["key"] = 1
+
+    stats = compiletools.caches.stats()
+    assert stats["test_caches._double"] == (1, 2, None, 2)
+    assert stats["test_caches._seen"].currsize == 1
+    assert stats["test_caches._seen"].hits is None
+
+
+def test_clear_all():
+    _double(1)
+    _Owner().quadruple(1)
+    _seen["key"] = 1
+
+    compiletools.caches.clear_all(methods_only=True)
+    stats = compiletools.caches.stats()
+    assert stats["test_caches._Owner.quadruple"].currsize == 0
+    assert stats["test_caches._double"].currsize == 1
+    assert stats["test_caches._seen"].currsize == 1
+
+    compiletools.caches.clear_all()
+    stats = compiletools.caches.stats()
+    assert stats["test_caches._double"].currsize == 0
+    assert not _seen
+
+
+def test_configure_resizes_functions_and_methods():
+    compiletools.caches.configure(["test_caches._double=2", "test_caches._Owner.*=3"])
+    stats = compiletools.caches.stats()
+    assert stats["test_caches._double"].maxsize == 2
+    assert stats["test_caches._Owner.triple"].maxsize == 3
+    assert stats["test_caches._Owner.quadruple"].maxsize == 3
+
+    # The resized caches are the ones that get called
+    for value in range(5):
+        assert _double(value) == 2 * value
+        assert _Owner.triple(value) == 3 * value
+        assert _Owner().triple(value) == 3 * value
+    stats = compiletools.caches.stats()
+    assert stats["test_caches._double"].currsize == 2
+    assert stats["test_caches._Owner.triple"].currsize == 3
+
+    # Later specs win and None is unbounded again
+    compiletools.caches.configure(["test_caches._double=10", "test_caches._Owner.*=10", "test_caches._double=None"])
+    stats = compiletools.caches.stats()
+    assert stats["test_caches._double"].maxsize is None
+    assert stats["test_caches._Owner.triple"].maxsize == 10
+
+
+def test_configure_bounds_lru_dicts():
+    for value in range(5):
+        _bounded[value] = value
+    compiletools.caches.configure(["test_caches._bounded=3"])
+    assert compiletools.caches.stats()["test_caches._bounded"] == (None, None, 3, 3)
+    assert list(_bounded) == [2, 3, 4]
+
+    # Reading an entry makes it the most recently used
+    assert _bounded[2] == 2
+    assert _bounded.get(3) == 3
+    _bounded[5] = 5
+    assert list(_bounded) == [2, 3, 5]
+
+    compiletools.caches.configure(["test_caches._bounded=None"])
+    for value in range(10):
+        _bounded[value] = value
+    assert len(_bounded) == 10
+
+
+def test_configure_rejects_unbounded_caches():
+    with pytest.raises(ValueError, match="test_caches._seen"):
+        compiletools.caches.configure(["test_caches.*=10"])
+    # Unbounded is what they already are
+    compiletools.caches.configure(["test_caches.*=None"])
+
+
+def test_configure_leaves_references_alone():
+    # What "from compiletools.test_caches import _double" leaves behind
+    imported = _double
+    staticmethod_ = _Owner.triple
+    compiletools.caches.configure(["test_caches._double=2", "test_caches._Owner.triple=2"])
+    # Nothing was replaced but the old references use the resized caches
+    assert imported is _double and staticmethod_ is _Owner.triple
+    for value in range(5):
+        assert imported(value) == 2 * value
+        assert staticmethod_(value) == 3 * value
+    assert imported.cache_info() == (0, 5, 2, 2)
+    assert staticmethod_.cache_info().currsize == 2
+
+
+def test_configure_rejects_bad_specs():
+    with pytest.raises(ValueError):
+        compiletools.caches.configure(["test_caches._double"])
+    with pytest.raises(ValueError):
+        compiletools.caches.configure(["test_caches._double=lots"])
+    with pytest.raises(ValueError, match="matches no cache"):
+        compiletools.caches.configure(["nosuch=3"])
+
+
+def test_configure_sees_caches_of_modules_not_yet_imported():
+    # A tool that never imported namer can still be given a namer.* spec
+    compiletools.caches.configure(["namer.*=None"])
+    assert any(name.startswith("namer.") for name, _ in compiletools.caches.registered())
+
+
+@pytest.mark.parametrize("spec", ["bogus", "nosuch=3", "test_caches._double=lots"])
+def test_bad_cache_maxsize_is_an_argument_error(spec, capsys):
+    cap = configargparse.ArgumentParser()
+    compiletools.apptools.add_common_arguments(cap)
+    with pytest.raises(SystemExit) as excinfo:
+        compiletools.apptools.parseargs(cap, ["--cache-maxsize=" + spec])
+    assert excinfo.value.code == 2
+    assert "--cache-maxsize" in capsys.readouterr().err
+
+
+def test_cache_maxsize_argument():
+    cap = configargparse.ArgumentParser()
+    compiletools.caches.add_arguments(cap)
+    args = cap.parse_args(["--cache-maxsize", "test_caches._double=5", "--cache-maxsize=test_caches._Owner.*=6"])
+    compiletools.caches.configure(args.cache_maxsize)
+    stats = compiletools.caches.stats()
+    assert stats["test_caches._double"].maxsize == 5
+    assert stats["test_caches._Owner.quadruple"].maxsize == 6
+    assert stats["wrappedos.realpath"].maxsize is None
@@ -1,9 +1,11 @@
 import os
 import os.path
+import json
 import time
 import shutil
 import tempfile
 import configargparse
+import pytest
 
 # import pdb
 
@@ -17,6 +19,9 @@ import compiletools.namer
 
 
 class TestCake:
+    # Extra arguments that select how ct-cake runs the build
+    backendargv = []
+
     def setup_method(self):
         self._tmpdir = None
         self._config_name = None
@@ -29,7 +34,7 @@ class TestCake:
             "--auto",
             "--config=" + self._config_name,
             "--CTCACHE=" + cache_home,
-        ]
+        ] + self.backendargv
 
     def _call_ct_cake(self, extraargv=[], cache_home="None"):
         assert cache_home is not None  # Note object None is not string 'None'
@@ -269,7 +274,32 @@ class TestCake:
             deeper_is_included=True,
         )
 
+    def test_time_trace(self):
+        with uth.TempDirContext():
+            self._tmpdir = os.getcwd()
+            shutil.copy2(os.path.join(uth.samplesdir(), "simple/helloworld_cpp.cpp"), self._tmpdir)
+            self._config_name = uth.create_temp_config(self._tmpdir)
+            uth.create_temp_ct_conf(
+                tempdir=self._tmpdir,
+                defaultvariant=os.path.basename(self._config_name)[:-5],
+            )
+            tracefile = os.path.join(self._tmpdir, "trace.json")
+            self._call_ct_cake(["--time-trace=" + tracefile])
+
+            with open(tracefile) as ff:
+                events = json.load(ff)["traceEvents"]
+            spans = {event["name"] for event in events if event["ph"] == "X"}
+            assert {"argument_parsing", "total_build_time", "header_dependency_analysis"} <= spans
+            assert any(event["name"] == "thread_name" for event in events)
+
     def teardown_method(self):
         uth.reset()
 
 
+class TestCakeNativeBackend(TestCake):
+    backendargv = ["--backend=native"]
+
+
+@pytest.mark.skipif(shutil.which("ninja") is None, reason="ninja is not installed")
+class TestCakeNinjaBackend(TestCake):
+    backendargv = ["--backend=ninja"]
@@ -1,9 +1,29 @@
 """Tests for the compiler_macros module."""
 
+import os
+import stat
 import pytest
 import subprocess
+import time
 from unittest.mock import patch, MagicMock
 import compiletools.compiler_macros as cm
+import compiletools.testhelper as uth
+
+
+@pytest.fixture(autouse=True)
+def _no_disk_cache(monkeypatch):
+    """Most tests count compiler invocations so keep the disk cache out of the way"""
+    monkeypatch.setenv("CTCACHE", "None")
+
+
+def _write_fake_compiler(directory, macros):
+    path = os.path.join(directory, "fakecc")
+    with open(path, "w") as ff:
+        ff.write("#!/bin/sh\n")
+        for name, value in macros.items():
+            ff.write(f"echo '#define {name} {value}'\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
 
 
 class TestCompilerMacros:
@@ -158,4 +178,166 @@ class TestCompilerMacros:
             # GCC should always define __GNUC__
             assert '__GNUC__' in macros
             # Should have many macros
-            assert len(macros) > 50  # GCC typically defines 100+ macros
\ No newline at end of file
+            assert len(macros) > 50  # GCC typically defines 100+ macros
+
+
+class TestCompilerMacroFlags:
+    """Test probing the compiler with the flags that affect its macros."""
+
+    def setup_method(self):
+        cm.clear_cache()
+
+    def test_macro_relevant_flags(self):
+        flags = cm.macro_relevant_flags(
+            "-I/usr/include/foo -DNDEBUG -std=c++20 -Wall -g",
+            ["-O3 -march=native", "-fopenmp -Werror"],
+            None,
+        )
+        assert flags == ("-std=c++20", "-O3", "-march=native", "-fopenmp")
+
+    def test_flags_are_passed_to_the_compiler(self):
+        with patch("subprocess.run") as mock_run:
+            mock_run.return_value.returncode = 0
+            mock_run.return_value.stdout = "#define __cplusplus 202002L"
+            macros = cm.get_compiler_macros("g++", 0, ("-std=c++20", "-mavx2"))
+        command = mock_run.call_args[0][0]
+        assert command == ["g++", "-x", "c++", "-std=c++20", "-mavx2", "-dM", "-E", "-"]
+        assert macros == {"__cplusplus": "202002L"}
+
+    def test_language_is_always_given(self):
+        with patch("subprocess.run") as mock_run:
+            mock_run.return_value.returncode = 0
+            mock_run.return_value.stdout = ""
+            cm.get_compiler_macros("g++", 0, ("-O2",))
+            assert mock_run.call_args[0][0] == ["g++", "-x", "c++", "-O2", "-dM", "-E", "-"]
+            cm.get_compiler_macros("gcc", 0, ("-O2",), "c")
+            assert mock_run.call_args[0][0] == ["gcc", "-x", "c", "-O2", "-dM", "-E", "-"]
+
+    def test_failed_flagged_probe_falls_back_to_plain_probe(self):
+        def mock_run(command, **kwargs):
+            result = MagicMock()
+            result.returncode = 1 if "-fbogus" in command else 0
+            result.stdout = "#define __PLAIN__ 1"
+            return result
+
+        with patch("subprocess.run", side_effect=mock_run):
+            assert cm.get_compiler_macros("gcc", 0, ("-fbogus",)) == {"__PLAIN__": "1"}
+
+    def test_real_gcc_std_and_optimisation_flags(self):
+        try:
+            subprocess.run(["g++", "--version"], capture_output=True, check=True, timeout=1)
+        except (subprocess.CalledProcessError, FileNotFoundError, subprocess.TimeoutExpired):
+            pytest.skip("g++ is not available")
+
+        plain = cm.get_compiler_macros("g++")
+        flagged = cm.get_compiler_macros("g++", 0, ("-std=c++20", "-O2"))
+        assert "__OPTIMIZE__" not in plain
+        assert flagged["__OPTIMIZE__"] == "1"
+        assert flagged["__cplusplus"] == "202002L"
+
+        # Without a -std the probe is still C++ (stdin alone would be C)
+        assert "__cplusplus" in plain
+        assert "__cplusplus" not in cm.get_compiler_macros("g++", 0, (), "c")
+
+
+class TestCompilerMacrosPrefetch:
+    """Test starting compiler probes in the background."""
+
+    def setup_method(self):
+        cm.clear_cache()
+
+    def teardown_method(self):
+        cm.clear_cache()
+
+    def test_prefetched_probe_is_reused(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            compiler = _write_fake_compiler(tmpdir, {"__FAKE__": "7"})
+            cm.prefetch_compiler_macros(compiler, 0, ("-O2",))
+            cm.prefetch_compiler_macros(compiler, 0, ("-O2",))
+            cm.prefetch_compiler_macros(compiler, 0, ("-O3",))
+            assert len(cm._prefetched) == 2
+
+            for future in cm._prefetched.values():
+                future.result()
+            with patch("subprocess.run") as mock_run:
+                assert cm.get_compiler_macros(compiler, 0, ("-O2",)) == {"__FAKE__": "7"}
+                assert cm.get_compiler_macros(compiler, 0, ("-O3",)) == {"__FAKE__": "7"}
+            mock_run.assert_not_called()
+            # Consumed probes are left to the lru cache
+            assert cm._prefetched == {}
+
+    def test_probe_spans_forget_older_runs(self):
+        with patch("subprocess.run") as mock_run:
+            mock_run.return_value.returncode = 0
+            mock_run.return_value.stdout = ""
+            cm.get_compiler_macros("g++", 0, ("-O1",))
+            middle = time.perf_counter()
+            cm.get_compiler_macros("g++", 0, ("-O2",))
+        assert len(cm.probe_spans()) == 2
+        spans = cm.probe_spans(middle)
+        assert [span[2] for span in spans] == ["g++ -x c++ -O2"]
+        assert cm.probe_spans() == spans
+        cm.clear_cache()
+        assert cm.probe_spans() == []
+
+    def test_prefetch_without_compiler(self):
+        cm.prefetch_compiler_macros("")
+        assert cm._prefetched == {}
+
+
+class TestCompilerMacrosDiskCache:
+    """Test the on-disk cache of compiler macros."""
+
+    def setup_method(self):
+        cm.clear_cache()
+
+    def teardown_method(self):
+        cm.clear_cache()
+
+    def test_build_id_of_non_elf_file(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            compiler = _write_fake_compiler(tmpdir, {})
+            assert cm._build_id(compiler) == ""
+
+    def test_warm_cache_does_not_run_compiler(self, monkeypatch):
+        with uth.TempDirContextNoChange() as tmpdir:
+            monkeypatch.setenv("CTCACHE", os.path.join(tmpdir, "cache"))
+            compiler = _write_fake_compiler(tmpdir, {"__FAKE__": "7"})
+            assert cm.get_compiler_macros(compiler) == {"__FAKE__": "7"}
+
+            cm.clear_cache()
+            with patch("subprocess.run") as mock_run:
+                assert cm.get_compiler_macros(compiler) == {"__FAKE__": "7"}
+            mock_run.assert_not_called()
+
+    def test_changed_compiler_invalidates_cache(self, monkeypatch):
+        with uth.TempDirContextNoChange() as tmpdir:
+            monkeypatch.setenv("CTCACHE", os.path.join(tmpdir, "cache"))
+            compiler = _write_fake_compiler(tmpdir, {"__FAKE__": "7"})
+            assert cm.get_compiler_macros(compiler) == {"__FAKE__": "7"}
+
+            cm.clear_cache()
+            _write_fake_compiler(tmpdir, {"__FAKE__": "8", "__NEW__": "1"})
+            assert cm.get_compiler_macros(compiler) == {"__FAKE__": "8", "__NEW__": "1"}
+
+    def test_revalidate_forgets_replaced_compilers(self, monkeypatch):
+        with uth.TempDirContextNoChange() as tmpdir:
+            monkeypatch.setenv("CTCACHE", "None")
+            compiler = _write_fake_compiler(tmpdir, {"__FAKE__": "7"})
+            assert cm.get_compiler_macros(compiler) == {"__FAKE__": "7"}
+            assert not cm.revalidate()
+            assert cm.get_compiler_macros(compiler) == {"__FAKE__": "7"}
+
+            _write_fake_compiler(tmpdir, {"__FAKE__": "8", "__NEW__": "1"})
+            assert cm.revalidate()
+            assert cm.get_compiler_macros(compiler) == {"__FAKE__": "8", "__NEW__": "1"}
+
+    def test_failures_are_not_cached(self, monkeypatch):
+        with uth.TempDirContextNoChange() as tmpdir:
+            monkeypatch.setenv("CTCACHE", os.path.join(tmpdir, "cache"))
+            compiler = _write_fake_compiler(tmpdir, {"__FAKE__": "7"})
+            with patch("subprocess.run", side_effect=subprocess.TimeoutExpired("cmd", 5)):
+                assert cm.get_compiler_macros(compiler) == {}
+
+            cm.clear_cache()
+            assert cm.get_compiler_macros(compiler) == {"__FAKE__": "7"}
@@ -0,0 +1,188 @@
+import os
+import glob
+import shutil
+import argparse
+import subprocess
+
+import pytest
+
+import compiletools.buildtimes
+import compiletools.cake
+import compiletools.executor
+import compiletools.testhelper as uth
+from compiletools.makefile import Rule
+
+
+def _args(parallel=1, verbose=0):
+    return argparse.Namespace(parallel=parallel, verbose=verbose, time=False)
+
+
+def _touch_rule(target, prerequisites="", log=None, order_only=None):
+    recipe = "@touch " + target
+    if log:
+        recipe = "@echo " + os.path.basename(target) + " >> " + log + " && touch " + target
+    return Rule(target=target, prerequisites=prerequisites, order_only_prerequisites=order_only, recipe=recipe)
+
+
+def _ran(log):
+    if not os.path.exists(log):
+        return []
+    with open(log) as ff:
+        return ff.read().split()
+
+
+def _set_mtime(filename, offset):
+    mtime = os.path.getmtime(filename) + offset
+    os.utime(filename, (mtime, mtime))
+
+
+class TestNativeExecutor:
+    def test_job_defaults(self):
+        job = compiletools.executor.Job(Rule(target="exe", prerequisites="a.o"))
+        assert job.prerequisites == ["a.o"]
+        assert job.ignore_errors is False
+
+    def _chain_rules(self, tmpdir, log):
+        """ exe <- a.o <- a.cpp, exe <- b.o <- b.cpp """
+        paths = {name: os.path.join(tmpdir, name) for name in ("a.cpp", "b.cpp", "a.o", "b.o", "exe")}
+        for source in ("a.cpp", "b.cpp"):
+            open(paths[source], "w").close()
+            _set_mtime(paths[source], -100)
+        rules = {}
+        for rule in (
+            Rule(target="build", prerequisites=paths["exe"], phony=True),
+            _touch_rule(paths["exe"], " ".join([paths["a.o"], paths["b.o"]]), log),
+            _touch_rule(paths["a.o"], paths["a.cpp"], log),
+            _touch_rule(paths["b.o"], paths["b.cpp"], log),
+        ):
+            rules[rule.target] = rule
+        return rules, paths
+
+    def test_only_out_of_date_targets_are_remade(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            log = os.path.join(tmpdir, "log")
+            rules, paths = self._chain_rules(tmpdir, log)
+
+            compiletools.executor.NativeExecutor(_args(), rules).build("build")
+            assert sorted(_ran(log)) == ["a.o", "b.o", "exe"]
+            assert _ran(log)[-1] == "exe"
+
+            os.unlink(log)
+            compiletools.executor.NativeExecutor(_args(), rules).build("build")
+            assert _ran(log) == []
+
+            # File timestamps are coarse so age the outputs, otherwise the
+            # remade b.o can have the same mtime as exe
+            for output in ("a.o", "b.o", "exe"):
+                _set_mtime(paths[output], -50)
+            _set_mtime(paths["b.cpp"], 200)
+            compiletools.executor.NativeExecutor(_args(), rules).build("build")
+            assert _ran(log) == ["b.o", "exe"]
+
+    def test_critical_path_starts_first(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            log = os.path.join(tmpdir, "log")
+            short = os.path.join(tmpdir, "short")
+            deep = [os.path.join(tmpdir, "deep{}".format(ii)) for ii in range(3)]
+            rules = {}
+            rules["build"] = Rule(target="build", prerequisites=" ".join([short, deep[-1]]), phony=True)
+            rules[short] = _touch_rule(short, log=log)
+            rules[deep[0]] = _touch_rule(deep[0], log=log)
+            rules[deep[1]] = _touch_rule(deep[1], deep[0], log=log)
+            rules[deep[2]] = _touch_rule(deep[2], deep[1], log=log)
+
+            compiletools.executor.NativeExecutor(_args(parallel=1), rules).build("build")
+            assert _ran(log)[0] == "deep0"
+
+    def test_previous_build_times_define_the_critical_path(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            log = os.path.join(tmpdir, "log")
+            slow = os.path.join(tmpdir, "slow")
+            deep = [os.path.join(tmpdir, "deep{}".format(ii)) for ii in range(3)]
+            rules = {}
+            rules["build"] = Rule(target="build", prerequisites=" ".join([deep[-1], slow]), phony=True)
+            rules[slow] = _touch_rule(slow, log=log)
+            rules[deep[0]] = _touch_rule(deep[0], log=log)
+            rules[deep[1]] = _touch_rule(deep[1], deep[0], log=log)
+            rules[deep[2]] = _touch_rule(deep[2], deep[1], log=log)
+            buildtimes = compiletools.buildtimes.BuildTimes(os.path.join(tmpdir, "buildtimes.json"))
+            buildtimes.record(slow, 40.0)
+            for target in deep:
+                buildtimes.record(target, 1.0)
+
+            compiletools.executor.NativeExecutor(_args(parallel=1), rules, buildtimes).build("build")
+            assert _ran(log)[0] == "slow"
+
+    def test_order_only_prerequisites_do_not_cause_a_remake(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            log = os.path.join(tmpdir, "log")
+            objdir = os.path.join(tmpdir, "obj")
+            target = os.path.join(objdir, "a.o")
+            rules = {
+                objdir: Rule(target=objdir, prerequisites="", recipe="mkdir -p " + objdir),
+                target: _touch_rule(target, log=log, order_only=objdir),
+            }
+            compiletools.executor.NativeExecutor(_args(), rules).build(target)
+            _set_mtime(target, -100)
+            compiletools.executor.NativeExecutor(_args(), rules).build(target)
+            assert _ran(log) == ["a.o"]
+
+    def test_failure_stops_dependents(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            log = os.path.join(tmpdir, "log")
+            rules, paths = self._chain_rules(tmpdir, log)
+            rules[paths["a.o"]].recipe = "@false"
+            with pytest.raises(subprocess.CalledProcessError):
+                compiletools.executor.NativeExecutor(_args(parallel=4), rules).build("build")
+            assert "exe" not in _ran(log)
+
+    def test_missing_prerequisite(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            target = os.path.join(tmpdir, "a.o")
+            rules = {target: _touch_rule(target, os.path.join(tmpdir, "missing.cpp"))}
+            with pytest.raises(RuntimeError, match="No rule to make target"):
+                compiletools.executor.NativeExecutor(_args(), rules).build(target)
+
+    def test_make_recipe_syntax(self):
+        assert compiletools.executor._shell_command("+@echo ... a ; g++ a.cpp") == ("echo ... a ; g++ a.cpp", True, False)
+        assert compiletools.executor._shell_command("-rm x") == ("rm x", False, True)
+        assert compiletools.executor._shell_command("@S=$$(date)") == ("S=$(date)", True, False)
+
+
+class TestBackendsAgree:
+    def _build(self, tmpdir, backend):
+        shutil.copytree(os.path.join(uth.samplesdir(), "numbers"), os.path.join(tmpdir, "numbers"))
+        with uth.DirectoryContext(tmpdir):
+            config = uth.create_temp_config(tmpdir)
+            uth.create_temp_ct_conf(tempdir=tmpdir, defaultvariant=os.path.basename(config)[:-5])
+            uth.reset()
+            try:
+                returncode = compiletools.cake.main(
+                    [
+                        "--config=" + config,
+                        "--CTCACHE=None",
+                        "--backend=" + backend,
+                        "--tests",
+                        "numbers/test_direct_include.cpp",
+                    ]
+                )
+            finally:
+                uth.reset()
+        # The variant directory is named after the temporary config and
+        # object names contain the source path, so neither can be compared
+        products = set()
+        for variantdir in glob.glob(os.path.join(tmpdir, "bin", "*")):
+            for root, _, files in os.walk(variantdir):
+                for ff in files:
+                    product = os.path.relpath(os.path.join(root, ff), variantdir)
+                    products.add(product.replace(os.path.basename(tmpdir), "TMPDIR"))
+        return returncode, products
+
+    def test_make_and_native_produce_the_same_files(self):
+        with uth.TempDirContextNoChange() as makedir, uth.TempDirContextNoChange() as nativedir:
+            makeresult, makeproducts = self._build(makedir, "make")
+            nativeresult, nativeproducts = self._build(nativedir, "native")
+            assert makeresult == nativeresult == 0
+            # The native backend doesn't need a Makefile
+            assert {product for product in makeproducts if not product.endswith("Makefile")} == nativeproducts
+            assert any(product.endswith(".result") for product in nativeproducts)
@@ -13,6 +13,7 @@ from unittest.mock import patch, MagicMock
 import compiletools.test_base as tb
 import compiletools.headerdeps
 import compiletools.magicflags
+import compiletools.simple_preprocessor
 import compiletools.testhelper as uth
 
 
@@ -150,6 +151,25 @@ int main() { return 0; }'''
             assert "local.h" in includes
 
 
+    def test_header_deps_macro_state_resets_between_calls(self):
+        """Test that the include guards seen by one process() call do not hide headers from the next."""
+        self.create_test_file("inner.h", "void inner();")
+        self.create_test_file("guarded.h", dedent('''
+            #ifndef GUARDED_H
+            #define GUARDED_H
+            #include "inner.h"
+            #endif
+        ''').strip())
+        main_path = self.create_test_file("main.c", '#include "guarded.h"\nint main() { return 0; }')
+
+        headerdeps = self.create_headerdeps_instance()
+        first = headerdeps.process(main_path)
+        second = headerdeps.process(main_path)
+
+        assert any(path.endswith("inner.h") for path in first)
+        assert first == second
+
+
 class TestMagicFlagsIntegration(tb.BaseCompileToolsTestCase):
     """Test DirectMagicFlags integration with FileAnalyzer."""
     
@@ -311,6 +331,78 @@ int main() { return 0; }'''
         assert "//#LIBS=feature_lib" in result
 
 
+    def test_magic_flags_elif_and_undef(self):
+        """Test that magic flags honour #elif and #undef like the header dependencies do."""
+        main_content = dedent('''
+            #define USE_FAST 1
+            #undef USE_FAST
+            #if defined(USE_FAST)
+            //#LIBS=fast_lib
+            #elif 1
+            //#LIBS=portable_lib
+            #endif
+            int main() { return 0; }
+        ''').strip()
+
+        main_path = self.create_test_file("main.c", main_content)
+
+        magicflags = self.create_magicflags_instance()
+        result = magicflags.readfile(main_path)
+
+        assert "//#LIBS=portable_lib" in result
+        assert "//#LIBS=fast_lib" not in result
+
+    def test_magic_flags_reuse_header_deps_passes(self):
+        """Test that readfile reuses the conditional compilation passes made by the header dependencies."""
+        self.create_test_file("test.h", "//#LIBS=header_lib\nvoid header_func();")
+        main_path = self.create_test_file("main.c", '#include "test.h"\n//#LIBS=main_lib\nint main() { return 0; }')
+
+        magicflags = self.create_magicflags_instance()
+        magicflags._headerdeps.process(main_path)
+
+        with patch('compiletools.simple_preprocessor.create_file_analyzer') as mock_create:
+            result = magicflags.readfile(main_path)
+
+        mock_create.assert_not_called()
+        assert "//#LIBS=header_lib" in result
+        assert "//#LIBS=main_lib" in result
+
+    def test_magic_flags_guarded_headers_keep_their_flags(self):
+        """Test that an include guard does not hide a header's magic flags."""
+        self.create_test_file("guarded.h", dedent('''
+            #ifndef GUARDED_H
+            #define GUARDED_H
+            //#LDFLAGS=-lguarded
+            #endif
+        ''').strip())
+        main_path = self.create_test_file("main.c", '#include "guarded.h"\nint main() { return 0; }')
+
+        magicflags = self.create_magicflags_instance()
+        assert magicflags.parse(main_path)["LDFLAGS"] == ["-lguarded"]
+
+    def test_magic_flags_only_reevaluate_affected_files(self):
+        """Test that a late macro definition only re-runs the files that test it."""
+        self.create_test_file("defs.h", "#define ENABLE_FEATURE 1")
+        self.create_test_file("other.h", "//#LIBS=other_lib")
+        main_path = self.create_test_file("main.c", dedent('''
+            #include "other.h"
+            #include "defs.h"
+            #ifdef ENABLE_FEATURE
+            //#LIBS=feature_lib
+            #endif
+        ''').strip())
+
+        magicflags = self.create_magicflags_instance()
+        magicflags._headerdeps.process(main_path)
+
+        with patch('compiletools.simple_preprocessor.create_file_analyzer',
+                   wraps=compiletools.simple_preprocessor.create_file_analyzer) as mock_create:
+            result = magicflags.readfile(main_path)
+
+        assert [call.args[0] for call in mock_create.call_args_list] == [main_path]
+        assert "//#LIBS=feature_lib" in result
+        assert "//#LIBS=other_lib" in result
+
 class TestFileAnalyzerConfigurationIntegration:
     """Test integration with configuration system."""
     
@@ -342,4 +434,4 @@ class TestFileAnalyzerConfigurationIntegration:
         
         # Test custom value  
         args = cap.parse_args(['--magic=direct', '--max-file-read-size=2048'])
-        assert args.max_file_read_size == 2048
\ No newline at end of file
+        assert args.max_file_read_size == 2048
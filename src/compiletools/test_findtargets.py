@@ -22,6 +22,8 @@ class TestFindTargetsModule:
             "cppflags_macros/nested_macros_test.cpp",
             "dottypaths/dottypaths.cpp",
             "feature_headers/main.cpp",
+            "function_macros/main.cpp",
+            "flag_macros/main.cpp",
             "ldflags/conditional_ldflags_test.cpp",
             "ldflags/version_dependent_ldflags.cpp",
             "library/main.cpp",
@@ -0,0 +1,123 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import compiletools.git_utils
+import compiletools.testhelper as uth
+
+
+def _mkdirs(*paths):
+    path = os.path.join(*paths)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class TestFindGitRoot:
+    def setup_method(self):
+        compiletools.git_utils.clear_cache()
+
+    def teardown_method(self):
+        compiletools.git_utils.clear_cache()
+
+    def test_matches_git_rev_parse(self):
+        directory = os.path.dirname(os.path.realpath(__file__))
+        try:
+            expected = subprocess.check_output(
+                ["git", "rev-parse", "--show-toplevel"],
+                cwd=directory,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+            ).strip("\n")
+        except (subprocess.CalledProcessError, OSError):
+            return
+        assert compiletools.git_utils.find_git_root(__file__) == expected
+
+    def test_git_directory_does_not_fork(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            _mkdirs(tmpdir, ".git")
+            open(os.path.join(tmpdir, ".git", "HEAD"), "w").close()
+            deep = _mkdirs(tmpdir, "a", "b", "c")
+            with patch("subprocess.check_output") as mock_check_output:
+                assert compiletools.git_utils._find_git_root(deep) == tmpdir
+                assert compiletools.git_utils._find_git_root(_mkdirs(tmpdir, "a", "d")) == tmpdir
+            mock_check_output.assert_not_called()
+
+    def test_sibling_directories_share_the_walk(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            _mkdirs(tmpdir, ".git")
+            open(os.path.join(tmpdir, ".git", "HEAD"), "w").close()
+            compiletools.git_utils._find_git_root(_mkdirs(tmpdir, "src", "one"))
+            stats = compiletools.git_utils._dotgit_kind.cache_info().misses
+            compiletools.git_utils._find_git_root(_mkdirs(tmpdir, "src", "two"))
+            # Only the new directory itself needs to be looked at
+            assert compiletools.git_utils._dotgit_kind.cache_info().misses == stats + 1
+
+    def test_worktree_git_file(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            gitdir = _mkdirs(tmpdir, "main", ".git", "worktrees", "feature")
+            worktree = _mkdirs(tmpdir, "feature")
+            with open(os.path.join(worktree, ".git"), "w") as ff:
+                ff.write("gitdir: " + gitdir + "\n")
+            with patch("subprocess.check_output") as mock_check_output:
+                assert compiletools.git_utils._find_git_root(_mkdirs(worktree, "src")) == worktree
+            mock_check_output.assert_not_called()
+
+    def test_relative_gitdir_in_git_file(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            _mkdirs(tmpdir, ".git", "modules", "sub")
+            submodule = _mkdirs(tmpdir, "sub")
+            with open(os.path.join(submodule, ".git"), "w") as ff:
+                ff.write("gitdir: ../.git/modules/sub\n")
+            open(os.path.join(tmpdir, ".git", "HEAD"), "w").close()
+            assert compiletools.git_utils._find_git_root(submodule) == submodule
+
+    def test_dummy_git_file_falls_back_to_git(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            open(os.path.join(tmpdir, ".git"), "w").close()
+            deep = _mkdirs(tmpdir, "a")
+            with patch(
+                "subprocess.check_output", side_effect=subprocess.CalledProcessError(128, "git")
+            ) as mock_check_output:
+                assert compiletools.git_utils._find_git_root(deep) == tmpdir
+            mock_check_output.assert_called_once()
+
+    def test_not_in_a_repository_is_cwd(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            if compiletools.git_utils._discover_git_root(tmpdir)[0] is not None:
+                return
+            with patch("subprocess.check_output") as mock_check_output:
+                assert compiletools.git_utils._find_git_root(tmpdir) == os.getcwd()
+            mock_check_output.assert_not_called()
+
+    def test_git_fallback_does_not_change_directory(self):
+        directory = os.path.dirname(os.path.realpath(__file__))
+        expected = compiletools.git_utils._find_git_root(directory)
+        compiletools.git_utils.clear_cache()
+        cwd = os.getcwd()
+        with uth.EnvironmentContext({"GIT_CEILING_DIRECTORIES": ""}), patch("os.chdir") as mock_chdir:
+            assert compiletools.git_utils._find_git_root(directory) == expected
+        mock_chdir.assert_not_called()
+        assert os.getcwd() == cwd
+
+    def test_concurrent_lookups_from_threads(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            repos = []
+            for name in ("one", "two", "three", "four"):
+                repo = _mkdirs(tmpdir, name)
+                open(os.path.join(repo, ".git"), "w").close()
+                repos.append(repo)
+            directories = [_mkdirs(repo, "src", str(ii)) for repo in repos for ii in range(8)]
+            cwd = os.getcwd()
+            # The dummy .git files make every lookup ask git itself
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                roots = list(executor.map(compiletools.git_utils._find_git_root, directories))
+            assert roots == [os.path.dirname(os.path.dirname(directory)) for directory in directories]
+            assert os.getcwd() == cwd
@@ -162,6 +162,39 @@ class TestHeaderDepsModule(tb.BaseCompileToolsTestCase):
         filename = self._get_sample_path("conditional_includes/main.cpp")
         tb.compare_direct_cpp_headers(self, filename)
 
+    def test_function_like_macros(self):
+        """Test that DirectHeaderDeps evaluates function-like macros in #if guards"""
+        filename = self._get_sample_path("function_macros/main.cpp")
+        tb.compare_direct_cpp_headers(self, filename)
+        result_set = uth.headerdeps_result(filename, "direct")
+        assert self._get_sample_path("function_macros/modern.h") in result_set
+        assert self._get_sample_path("function_macros/threads.h") in result_set
+        assert self._get_sample_path("function_macros/legacy.h") not in result_set
+        assert self._get_sample_path("function_macros/nothreads.h") not in result_set
+
+    def _direct_headers(self, filename, extraargs):
+        with uth.TempConfigContext() as temp_config_name:
+            cap = configargparse.getArgumentParser()
+            args = compiletools.apptools.parseargs(
+                cap, ["--config=" + temp_config_name, "--headerdeps=direct"] + extraargs
+            )
+            return compiletools.headerdeps.create(args).process(filename)
+
+    def test_compiler_flags_change_predefined_macros(self):
+        """Test that DirectHeaderDeps probes the compiler with the -std and -O flags"""
+        filename = self._get_sample_path("flag_macros/main.cpp")
+        cxx17 = self._get_sample_path("flag_macros/cxx17.h")
+        cxx20 = self._get_sample_path("flag_macros/cxx20.h")
+        optimized = self._get_sample_path("flag_macros/optimized.h")
+
+        # The test config sets CPPFLAGS=-std=c++20
+        tb.compare_direct_cpp_headers(self, filename)
+        tb.compare_direct_cpp_headers(self, filename, ["--append-CPPFLAGS=-O2"])
+        assert self._direct_headers(filename, []) == {cxx20}
+
+        # CppHeaderDeps only passes CPPFLAGS but the compile also uses CXXFLAGS
+        assert self._direct_headers(filename, ["--append-CXXFLAGS=-O2 -std=c++17"]) == {cxx17, optimized}
+
     def test_user_defined_feature_headers(self):
         """Test that DirectHeaderDeps correctly handles user-defined feature macros"""
         filename = self._get_sample_path("feature_headers/main.cpp")
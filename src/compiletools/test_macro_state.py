@@ -0,0 +1,99 @@
+import gc
+import weakref
+
+from compiletools.macro_state import MacroSnapshot, MacroEnvironment, UNDEFINED, as_snapshot
+from compiletools.simple_preprocessor import SimplePreprocessor
+
+
+def test_snapshot_lookup_through_layers():
+    root = MacroSnapshot({"A": "1", "B": "2"})
+    child = root.derive({"B": "3", "C": "4"})
+    assert child["A"] == "1"
+    assert child["B"] == "3"
+    assert child["C"] == "4"
+    assert root["B"] == "2"
+    assert "C" not in root
+    assert dict(child) == {"A": "1", "B": "3", "C": "4"}
+
+
+def test_snapshot_undefine():
+    root = MacroSnapshot({"A": "1", "B": "2"})
+    child = root.derive({"A": UNDEFINED})
+    assert "A" not in child
+    assert child.get("A") is None
+    assert len(child) == 1
+    assert "A" in root
+
+
+def test_derive_without_changes_returns_same_snapshot():
+    root = MacroSnapshot({"A": "1"})
+    assert root.derive({}) is root
+    assert MacroEnvironment(root).snapshot() is root
+
+
+def test_keys_identify_equal_derivations():
+    root = MacroSnapshot({"A": "1"})
+    assert root.derive({"X": "1"}).key == root.derive({"X": "1"}).key
+    assert root.derive({"X": "1"}).key != root.derive({"X": "2"}).key
+    assert root.derive({"X": "1"}).key != root.key
+    hash(root.key)
+
+
+def test_keys_compare_by_content():
+    builtins = {"A": "1", "B": "2"}
+    first = MacroSnapshot(builtins).derive({"X": "1"})
+    second = MacroSnapshot(dict(builtins)).derive({"X": "1"})
+    assert first.key == second.key
+    assert hash(first.key) == hash(second.key)
+    assert MacroSnapshot({"A": "1"}).derive({"X": "1"}).key != first.key
+
+
+def test_keys_are_freed_with_their_snapshots():
+    key = weakref.ref(MacroSnapshot({"A": "1"}).derive({"X": "1"}).key)
+    gc.collect()
+    assert key() is None
+
+
+def test_deep_chains_collapse_above_the_root():
+    root = MacroSnapshot({"BUILTIN": "1"})
+    snap = root
+    for index in range(MacroSnapshot.MAX_DEPTH * 3):
+        snap = snap.derive({f"GUARD_{index}": "1"})
+    assert snap._depth <= MacroSnapshot.MAX_DEPTH
+    assert snap["GUARD_0"] == "1"
+    assert snap["BUILTIN"] == "1"
+    assert len(snap) == MacroSnapshot.MAX_DEPTH * 3 + 1
+
+    # The root is shared, never copied
+    node = snap
+    while node._parent is not None:
+        node = node._parent
+    assert node is root
+
+
+def test_environment_is_copy_on_write():
+    root = MacroSnapshot({"A": "1"})
+    env = MacroEnvironment(root)
+    env["B"] = "2"
+    del env["A"]
+    assert "A" not in env and env["B"] == "2"
+    assert dict(root) == {"A": "1"}
+    assert env.changed == {"A", "B"}
+
+    snap = env.snapshot()
+    assert dict(snap) == {"B": "2"}
+    assert env.changed == set()
+
+
+def test_as_snapshot_legacy_inputs():
+    assert dict(as_snapshot({"A": "2"})) == {"A": "2"}
+    assert dict(as_snapshot({"A", "B"})) == {"A": "1", "B": "1"}
+
+
+def test_preprocessor_does_not_mutate_its_input():
+    root = MacroSnapshot({"FEATURE": "1"})
+    processor = SimplePreprocessor(root)
+    processor.process("#define GUARD_H\n#undef FEATURE\n")
+    result = processor.snapshot()
+    assert "GUARD_H" in result and "FEATURE" not in result
+    assert dict(root) == {"FEATURE": "1"}
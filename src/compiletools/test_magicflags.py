@@ -1,5 +1,10 @@
 import os
+from types import SimpleNamespace
+from unittest.mock import patch
 
+import compiletools.headerdeps
+import compiletools.magicflags
+from compiletools.macro_state import MacroSnapshot
 import compiletools.testhelper as uth
 import compiletools.test_base as tb
 
@@ -90,6 +95,67 @@ class TestMagicFlagsModule(tb.BaseCompileToolsTestCase):
         }
         assert result == expected
 
+    def test_direct_magic_flags_stream_per_file(self):
+        """Test that direct magic yields each flag with the file it came from"""
+        parser = tb.create_magic_parser(["--magic", "direct"], tempdir=self._tmpdir)
+        header = self._get_sample_path("magicsourceinheader/include_dir/sub_dir/another_header.hpp")
+        flags = list(parser._magic_flags(self._get_sample_path("magicsourceinheader/main.cpp")))
+        assert flags == [
+            (header, "LDFLAGS", "-lm"),
+            (header, "SOURCE", self._get_sample_path("magicsourceinheader/include_dir/sub_dir/the_code_lin.cpp")),
+        ]
+
+    def test_direct_magic_flags_cached_per_file(self):
+        """Test that a header shared by two sources is only searched once"""
+        parser = tb.create_magic_parser(["--magic", "direct"], tempdir=self._tmpdir)
+        parser.clear_cache()
+        pattern = parser.magicpattern
+        with patch.object(parser, "magicpattern") as mock_pattern:
+            mock_pattern.finditer.side_effect = lambda text: pattern.finditer(text)
+            first = parser.parse(self._get_sample_path("factory/a_widget.cpp"))
+            second = parser.parse(self._get_sample_path("factory/z_widget.cpp"))
+        searched = [call.args[0] for call in mock_pattern.finditer.call_args_list]
+        assert sum("//#CXXFLAGS=-std=c++11" in text for text in searched) == 1
+        assert first["CXXFLAGS"] == second["CXXFLAGS"] == ["-std=c++11"]
+
+        # Keyed on the file, its mtime and macro context, never its text
+        for realpath, mtime, macros_key, max_read_size in compiletools.magicflags._file_magic_flags:
+            assert os.path.isabs(realpath)
+            assert mtime == os.path.getmtime(realpath)
+
+    def test_direct_magic_reuses_cpp_headerdeps(self):
+        """Test that direct magic uses the headers that --headerdeps=cpp found
+        rather than walking the includes a second time"""
+        source = self._get_sample_path("magicsourceinheader/main.cpp")
+        parser = tb.create_magic_parser(["--magic", "direct", "--headerdeps", "cpp"], tempdir=self._tmpdir)
+        assert isinstance(parser._headerdeps, compiletools.headerdeps.CppHeaderDeps)
+        with patch.object(compiletools.headerdeps.DirectHeaderDeps, "_process_impl_recursive") as walk, \
+             patch.object(parser._headerdeps, "process", wraps=parser._headerdeps.process) as process:
+            result = parser.parse(source)
+        walk.assert_not_called()
+        process.assert_called_once_with(source)
+        assert result == self._parse_with_magic("direct", "magicsourceinheader/main.cpp")
+
+    def test_definers_skip_the_pass_itself(self):
+        """Test that a pass is re-run with the last other file's define, never its own"""
+        def fake(realpath, defined, referenced=()):
+            return SimpleNamespace(
+                realpath=realpath,
+                defined=frozenset(defined),
+                referenced=frozenset(referenced),
+                macros=MacroSnapshot({name: realpath for name in defined}),
+                entry_macros=MacroSnapshot(),
+            )
+
+        first, second, third = fake("/a.h", {"X", "Y"}), fake("/b.h", {"X"}, {"X", "Y"}), fake("/c.h", {"Y"})
+        definers = compiletools.magicflags.DirectMagicFlags._definers([first, second, third])
+        assert definers["X"] == (second, first)
+        assert definers["Y"] == (third, first)
+
+        # second's own X doesn't count, so X comes from first and Y from third
+        macros = compiletools.magicflags.DirectMagicFlags._reevaluation_macros(definers, second)
+        assert dict(macros) == {"X": "/a.h", "Y": "/c.h"}
+
     def test_direct_and_cpp_magic_generate_same_results(self):
         """Test that DirectMagicFlags and CppMagicFlags produce identical results on conditional compilation samples"""
         # Test key conditional compilation samples
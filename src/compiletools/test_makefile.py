@@ -1,6 +1,7 @@
 import os
 import shutil
 import subprocess
+import argparse
 import tempfile
 import filecmp
 import configargparse
@@ -67,6 +68,31 @@ class TestMakefile:
                 # print(comparator.diff_files)
                 assert len(comparator.diff_files) == 0
 
+    def test_build_only_changed_files(self):
+        with uth.TempDirContextNoChange() as tempdir:
+            spaced = os.path.join(tempdir, "my header.hpp")
+            with open(spaced, "w") as ff:
+                ff.write("\n")
+            assert compiletools.makefile.MakefileCreator._build_only_changed_files(
+                [spaced, "/src/a.cpp /src/b.hpp\n/src/c.hpp"]
+            ) == {spaced, "/src/a.cpp", "/src/b.hpp", "/src/c.hpp"}
+
+    def test_timed_recipe_quotes_paths(self):
+        with uth.TempDirContextNoChange() as tempdir:
+            bindir = os.path.join(tempdir, "bin $HOME; dir")
+            os.mkdir(bindir)
+            namer = argparse.Namespace(executable_dir=lambda: bindir)
+            args = argparse.Namespace(time=True, backend="make", verbose=2)
+            target = os.path.join(tempdir, "my $(obj); 'x'.o")
+            recipe = compiletools.makefile._timed_recipe(args, namer, "true", target, target)
+            makefile = os.path.join(tempdir, "Makefile")
+            with open(makefile, "w") as ff:
+                ff.write("all:\n\t" + recipe + "\n")
+            output = subprocess.check_output(["make", "-f", makefile], universal_newlines=True)
+            assert output.startswith("... " + target + " (")
+            with open(compiletools.makefile.timing_log(namer)) as ff:
+                assert ff.read().split("\t")[3] == target
+
     def test_static_library(self):
         _test_library("--static")
 
@@ -0,0 +1,71 @@
+import functools
+from io import StringIO
+
+import pytest
+
+import compiletools.caches
+import compiletools.headerdeps
+import compiletools.memory
+import compiletools.memoize
+import compiletools.wrappedos
+
+
+@pytest.fixture(autouse=True)
+def memory_report():
+    compiletools.memory.start()
+    yield
+    compiletools.memory.stop()
+    compiletools.wrappedos.clear_cache()
+
+
+def test_cache_usage_counts_entries_and_contents():
+    @functools.lru_cache(maxsize=None)
+    def paths(index):
+        return ("/some/long/path/" + str(index),) * 3
+
+    for index in range(100):
+        paths(index)
+    entries, size = compiletools.memory.cache_usage(paths)
+    assert entries == 100
+    # At least the 100 distinct strings
+    assert size > 100 * len("/some/long/path/00")
+
+    @compiletools.memoize.memoize_false
+    def never(value):
+        return False
+
+    never(1)
+    never(2)
+    registered = dict(compiletools.caches.registered())
+    assert compiletools.memory.cache_usage(registered[compiletools.caches.cache_name(never)])[0] == 2
+
+
+def test_caches_are_found():
+    names = [name for name, _ in compiletools.memory.caches()]
+    assert "wrappedos.realpath" in names
+    assert "headerdeps.DirectHeaderDeps._find_include_in" in names
+    assert "simple_preprocessor._preprocessed_files" in names
+    assert len(names) == len(set(names))
+
+
+def test_report_shows_caches_at_their_largest():
+    compiletools.wrappedos.clear_cache()
+    for index in range(10):
+        compiletools.wrappedos.realpath("/nonexistent/{}".format(index))
+    compiletools.memory.checkpoint()
+    compiletools.wrappedos.clear_cache()
+
+    output = StringIO()
+    compiletools.memory.report(file=output)
+    text = output.getvalue()
+    assert "Peak RSS:" in text
+    assert "wrappedos.realpath" in text
+    line = next(line for line in text.splitlines() if line.endswith(" wrappedos.realpath"))
+    assert int(line.split()[0]) >= 10
+    assert "Top allocators by module" in text
+
+
+def test_format_size():
+    assert compiletools.memory.format_size(12) == "12B"
+    assert compiletools.memory.format_size(2048) == "2.0KiB"
+    assert compiletools.memory.format_size(3 * 1024 ** 3) == "3.0GiB"
@@ -0,0 +1,94 @@
+import os
+import glob
+import shutil
+import subprocess
+from textwrap import dedent
+
+import pytest
+
+import compiletools.cake
+import compiletools.ninjafile
+import compiletools.testhelper as uth
+
+
+pytestmark = pytest.mark.skipif(shutil.which("ninja") is None, reason="ninja is not installed")
+
+
+def _write(filename, text):
+    with open(filename, "w") as ff:
+        ff.write(dedent(text))
+
+
+def test_ninja_command():
+    assert compiletools.ninjafile._ninja_command("+@echo ... /a/b ; g++ -o b b.o") == "g++ -o b b.o"
+    assert compiletools.ninjafile._ninja_command("@START=$$(date +%s%N); g++") == "START=$$(date +%s%N); g++"
+    assert compiletools.ninjafile._escape_path("/a b/c:d") == "/a$ b/c$:d"
+
+
+class TestNinjaCreator:
+    def _cake(self, config, *extraargv):
+        uth.reset()
+        try:
+            argv = ["--exemarkers=main", "--testmarkers=unittest.hpp", "--auto", "--config=" + config, "--CTCACHE=None"]
+            return compiletools.cake.main(argv + ["--backend=ninja"] + list(extraargv))
+        finally:
+            uth.reset()
+
+    def _ninja_dry_run(self, ninjafile):
+        return subprocess.run(
+            ["ninja", "-n", "-f", ninjafile, "build"], stdout=subprocess.PIPE, universal_newlines=True, check=True
+        ).stdout
+
+    def test_headers_come_from_the_depfiles(self):
+        with uth.TempDirContextWithChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            _write(os.path.join(tmpdir, "value.hpp"), "constexpr int value = 3;\n")
+            _write(
+                os.path.join(tmpdir, "main.cpp"),
+                """\
+                #include "value.hpp"
+                int main() { return value; }
+                """,
+            )
+            config = uth.create_temp_config(tmpdir)
+            uth.create_temp_ct_conf(tempdir=tmpdir, defaultvariant=os.path.basename(config)[:-5])
+            assert self._cake(config) == 0
+
+            ninjafile = glob.glob(os.path.join(tmpdir, "bin", "**", "build.ninja"), recursive=True)[0]
+            with open(ninjafile) as ff:
+                contents = ff.read()
+            assert contents.startswith(compiletools.ninjafile.NinjaCreator.header)
+            assert "deps = gcc" in contents
+            assert "pool = link_pool" in contents
+            assert "restat = 1" in contents
+            assert "value.hpp" not in contents
+            assert subprocess.run([os.path.join(tmpdir, "bin", "main")]).returncode == 3
+
+            # Nothing to do until the header changes.  Only ninja's deps log
+            # knows that main.o depends on it.
+            assert "no work to do" in self._ninja_dry_run(ninjafile)
+            mtime = os.path.getmtime(ninjafile) + 10
+            os.utime(os.path.join(tmpdir, "value.hpp"), (mtime, mtime))
+            assert "main.cpp" in self._ninja_dry_run(ninjafile)
+
+    def test_serialised_tests_share_a_pool(self):
+        with uth.TempDirContextWithChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            _write(os.path.join(tmpdir, "unittest.hpp"), "\n")
+            for name in ("test_a", "test_b"):
+                _write(
+                    os.path.join(tmpdir, name + ".cpp"),
+                    """\
+                    #include "unittest.hpp"
+                    int main() { return 0; }
+                    """,
+                )
+            config = uth.create_temp_config(tmpdir)
+            uth.create_temp_ct_conf(tempdir=tmpdir, defaultvariant=os.path.basename(config)[:-5])
+            assert self._cake(config, "--serialise-tests") == 0
+
+            ninjafile = glob.glob(os.path.join(tmpdir, "bin", "**", "build.ninja"), recursive=True)[0]
+            with open(ninjafile) as ff:
+                contents = ff.read()
+            assert "pool = test_pool" in contents
+            assert len(glob.glob(os.path.join(tmpdir, "bin", "**", "*.result"), recursive=True)) == 2
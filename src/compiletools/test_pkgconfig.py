@@ -0,0 +1,169 @@
+"""Tests for the pkgconfig module."""
+
+import os
+import shutil
+import subprocess
+import threading
+import time
+from textwrap import dedent
+from unittest.mock import patch
+
+import pytest
+
+import compiletools.pkgconfig as pc
+import compiletools.testhelper as uth
+
+
+pytestmark = pytest.mark.skipif(shutil.which("pkg-config") is None, reason="pkg-config is not installed")
+
+
+def _write_pc(directory, name, cflags, libs, requires=""):
+    path = os.path.join(directory, name + ".pc")
+    with open(path, "w") as ff:
+        ff.write(dedent(f"""\
+            Name: {name}
+            Description: test package
+            Version: 1.0
+            Requires: {requires}
+            Cflags: {cflags}
+            Libs: {libs}
+            """))
+    return path
+
+
+class TestPkgConfig:
+    """Test the cached pkg-config resolver."""
+
+    def setup_method(self):
+        pc.clear_cache()
+
+    def teardown_method(self):
+        pc.clear_cache()
+
+    def test_resolve_matches_pkg_config(self):
+        with uth.TempDirContextNoChange() as pcdir, uth.TempDirContextNoChange() as cachedir:
+            _write_pc(pcdir, "ctfoo", "-I/opt/foo/include -DFOO", "-L/opt/foo/lib -lfoo")
+            with uth.EnvironmentContext({"PKG_CONFIG_PATH": pcdir, "CTCACHE": cachedir}):
+                result = pc.resolve(["ctfoo"])["ctfoo"]
+                assert result.cflags == "-isystem /opt/foo/include -DFOO"
+                assert result.libs == subprocess.run(
+                    ["pkg-config", "--libs", "ctfoo"], stdout=subprocess.PIPE, universal_newlines=True
+                ).stdout.rstrip()
+
+    def test_resolve_is_cached_in_memory(self):
+        with uth.TempDirContextNoChange() as pcdir:
+            _write_pc(pcdir, "ctfoo", "-DFOO", "-lfoo")
+            with uth.EnvironmentContext({"PKG_CONFIG_PATH": pcdir, "CTCACHE": "None"}):
+                first = pc.resolve(["ctfoo"])
+                with patch("subprocess.Popen") as mock_popen:
+                    second = pc.resolve(["ctfoo"])
+                mock_popen.assert_not_called()
+                assert first == second
+
+    def test_persistent_cache_avoids_pkg_config(self):
+        with uth.TempDirContextNoChange() as pcdir, uth.TempDirContextNoChange() as cachedir:
+            _write_pc(pcdir, "ctbar", "-DBAR", "-lbar")
+            _write_pc(pcdir, "ctfoo", "-DFOO", "-lfoo", requires="ctbar >= 1.0")
+            with uth.EnvironmentContext({"PKG_CONFIG_PATH": pcdir, "CTCACHE": cachedir}):
+                first = pc.resolve(["ctfoo"])
+                assert first["ctfoo"].cflags == "-DFOO -DBAR"
+
+                # A new process only has the on-disk cache
+                pc.clear_cache()
+                with patch("subprocess.Popen") as mock_popen:
+                    assert pc.resolve(["ctfoo"]) == first
+                mock_popen.assert_not_called()
+
+    def test_persistent_cache_invalidated_by_required_pc_file(self):
+        with uth.TempDirContextNoChange() as pcdir, uth.TempDirContextNoChange() as cachedir:
+            barpc = _write_pc(pcdir, "ctbar", "-DBAR", "-lbar")
+            _write_pc(pcdir, "ctfoo", "-DFOO", "-lfoo", requires="ctbar")
+            with uth.EnvironmentContext({"PKG_CONFIG_PATH": pcdir, "CTCACHE": cachedir}):
+                pc.resolve(["ctfoo"])
+                pc.clear_cache()
+
+                _write_pc(pcdir, "ctbar", "-DBAR2", "-lbar")
+                mtime = os.path.getmtime(barpc) + 10
+                os.utime(barpc, (mtime, mtime))
+                assert pc.resolve(["ctfoo"])["ctfoo"].cflags == "-DFOO -DBAR2"
+
+    def test_resolve_preserves_order(self):
+        with uth.TempDirContextNoChange() as pcdir:
+            for name in ("cta", "ctb", "ctc"):
+                _write_pc(pcdir, name, "-D" + name.upper(), "-l" + name)
+            with uth.EnvironmentContext({"PKG_CONFIG_PATH": pcdir, "CTCACHE": "None"}):
+                pc.resolve(["ctb"])
+                result = pc.resolve(["ctc", "ctb", "cta"])
+                assert list(result) == ["ctc", "ctb", "cta"]
+                assert [flags.libs for flags in result.values()] == ["-lctc", "-lctb", "-lcta"]
+
+    def test_persistent_cache_keyed_on_environment(self):
+        with uth.TempDirContextNoChange() as pcdir1, uth.TempDirContextNoChange() as pcdir2, \
+                uth.TempDirContextNoChange() as cachedir:
+            _write_pc(pcdir1, "ctfoo", "-DFOO1", "-lfoo")
+            _write_pc(pcdir2, "ctfoo", "-DFOO2", "-lfoo")
+            with uth.EnvironmentContext({"PKG_CONFIG_PATH": pcdir1, "CTCACHE": cachedir}):
+                assert pc.resolve(["ctfoo"])["ctfoo"].cflags == "-DFOO1"
+            with uth.EnvironmentContext({"PKG_CONFIG_PATH": pcdir2, "CTCACHE": cachedir}):
+                assert pc.resolve(["ctfoo"])["ctfoo"].cflags == "-DFOO2"
+
+            # Neither build overwrote the other's entry
+            pc.clear_cache()
+            with patch("subprocess.Popen") as mock_popen:
+                with uth.EnvironmentContext({"PKG_CONFIG_PATH": pcdir1, "CTCACHE": cachedir}):
+                    assert pc.resolve(["ctfoo"])["ctfoo"].cflags == "-DFOO1"
+                with uth.EnvironmentContext({"PKG_CONFIG_PATH": pcdir2, "CTCACHE": cachedir}):
+                    assert pc.resolve(["ctfoo"])["ctfoo"].cflags == "-DFOO2"
+            mock_popen.assert_not_called()
+
+    def test_concurrent_queries_are_bounded(self):
+        names = ["ct" + letter for letter in "abcdef"]
+        with uth.TempDirContextNoChange() as pcdir:
+            for name in names:
+                _write_pc(pcdir, name, "-D" + name.upper(), "-l" + name)
+            lock = threading.Lock()
+            running = []
+            peak = []
+            query = pc._query
+
+            def counting_query(executable, package):
+                with lock:
+                    running.append(package)
+                    peak.append(len(running))
+                time.sleep(0.05)
+                try:
+                    return query(executable, package)
+                finally:
+                    with lock:
+                        running.remove(package)
+
+            with uth.EnvironmentContext({"PKG_CONFIG_PATH": pcdir, "CTCACHE": "None"}), \
+                    patch.object(pc, "_MAX_CONCURRENT_QUERIES", 2), \
+                    patch.object(pc, "_query", side_effect=counting_query):
+                result = pc.resolve(names)
+            assert [flags.libs for flags in result.values()] == ["-l" + name for name in names]
+            assert max(peak) == 2
+
+    def test_cflags_and_libs_run_together(self):
+        with uth.TempDirContextNoChange() as pcdir:
+            _write_pc(pcdir, "ctfoo", "-DFOO", "-lfoo")
+            events = []
+            popen = subprocess.Popen
+
+            def recording_popen(command, **kwargs):
+                events.append("start " + command[1])
+                process = popen(command, **kwargs)
+                communicate = process.communicate
+
+                def recording_communicate(*args, **kwargs):
+                    events.append("wait " + command[1])
+                    return communicate(*args, **kwargs)
+
+                process.communicate = recording_communicate
+                return process
+
+            # PKG_CONFIG_LIBDIR saves asking pkg-config for its search path
+            environment = {"PKG_CONFIG_PATH": pcdir, "PKG_CONFIG_LIBDIR": pcdir, "CTCACHE": "None"}
+            with uth.EnvironmentContext(environment), patch("subprocess.Popen", side_effect=recording_popen):
+                assert pc.resolve(["ctfoo"])["ctfoo"].libs == "-lfoo"
+            assert events == ["start --cflags", "start --libs", "wait --cflags", "wait --libs"]
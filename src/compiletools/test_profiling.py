@@ -0,0 +1,84 @@
+import os
+import time
+import pstats
+from io import StringIO
+
+import pytest
+import configargparse
+
+import compiletools.profiling
+import compiletools.testhelper as uth
+
+
+@pytest.fixture(autouse=True)
+def no_profiler():
+    yield
+    # Never leave a profiler running for the rest of the tests
+    compiletools.profiling.stop(file=StringIO())
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+
+def test_mode_from_argv():
+    assert compiletools.profiling.mode_from_argv(["foo.cpp"]) is None
+    assert compiletools.profiling.mode_from_argv(["--profile", "foo.cpp"]) == "cprofile"
+    assert compiletools.profiling.mode_from_argv(["--profile", "--profile-mode", "sampling"]) == "sampling"
+    assert compiletools.profiling.mode_from_argv(["--profile-mode=sampling", "--profile", "foo.cpp"]) == "sampling"
+    assert compiletools.profiling.mode_from_argv(["--profile-mode=sampling", "foo.cpp"]) is None
+    assert compiletools.profiling.mode_from_argv(["--profile", "--profile-mode=bogus"]) is None
+
+
+def test_cprofile_writes_pstats():
+    with uth.TempDirContextNoChange() as tmpdir:
+        compiletools.profiling.start("cprofile", ["--CTCACHE=" + tmpdir])
+        _busy(0.01)
+        output = StringIO()
+        filename = compiletools.profiling.stop(file=output)
+
+        assert filename.startswith(os.path.join(tmpdir, "profiles"))
+        assert filename.endswith(".pstats")
+        assert any("_busy" in function for _, _, function in pstats.Stats(filename).stats)
+        assert "_busy" in output.getvalue()
+        # Stopping twice is harmless
+        assert compiletools.profiling.stop(file=output) is None
+
+
+def test_sampling_writes_collapsed_stacks():
+    with uth.TempDirContextNoChange() as tmpdir:
+        compiletools.profiling.start("sampling", ["--CTCACHE=" + tmpdir])
+        _busy(0.2)
+        output = StringIO()
+        filename = compiletools.profiling.stop(file=output)
+
+        assert filename.endswith(".folded")
+        with open(filename) as ff:
+            lines = ff.read().splitlines()
+        assert lines
+        stack, count = lines[0].rsplit(" ", 1)
+        assert int(count) >= 1
+        assert any("_busy (test_profiling.py:" in line and line.startswith("MainThread;") for line in lines)
+        assert "Top hotspots" in output.getvalue()
+
+
+def test_profile_argument():
+    cap = configargparse.ArgumentParser()
+    compiletools.profiling.add_arguments(cap)
+    assert compiletools.profiling.mode(cap.parse_args(["--profile"])) == "cprofile"
+    assert compiletools.profiling.mode(cap.parse_args(["--profile", "--profile-mode=sampling"])) == "sampling"
+    assert compiletools.profiling.mode(cap.parse_args(["--profile-mode=sampling"])) is None
+    assert compiletools.profiling.mode(cap.parse_args([])) is None
+
+
+def test_profile_before_positional_file():
+    argv = ["--profile", "foo.cpp"]
+    cap = configargparse.ArgumentParser()
+    cap.add("filename", nargs="*")
+    compiletools.profiling.add_arguments(cap)
+    args = cap.parse_args(argv)
+    assert args.filename == ["foo.cpp"]
+    assert compiletools.profiling.mode(args) == "cprofile"
+    assert compiletools.profiling.mode_from_argv(argv) == "cprofile"
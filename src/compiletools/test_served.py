@@ -0,0 +1,152 @@
+import os
+import sys
+import glob
+import time
+import subprocess
+from textwrap import dedent
+
+import pytest
+
+import compiletools.cake
+import compiletools.headerdeps
+import compiletools.inotify
+import compiletools.served
+import compiletools.simple_preprocessor
+import compiletools.testhelper as uth
+
+
+def _write(filename, text):
+    with open(filename, "w") as ff:
+        ff.write(dedent(text))
+
+
+def _touch_later(filename):
+    """ Make sure that the mtime changes even on coarse grained file systems """
+    mtime = os.path.getmtime(filename) + 2
+    os.utime(filename, (mtime, mtime))
+
+
+@pytest.mark.skipif(not compiletools.inotify.available(), reason="inotify is not available")
+class TestInotify:
+    def test_reports_writes_and_creates(self):
+        with uth.TempDirContextNoChange() as tmpdir, compiletools.inotify.Inotify() as watcher:
+            existing = os.path.join(tmpdir, "existing.hpp")
+            _write(existing, "int a;\n")
+            assert watcher.watch(tmpdir)
+            assert not watcher.watch(os.path.join(tmpdir, "missing"))
+
+            _write(existing, "int b;\n")
+            _write(os.path.join(tmpdir, "new.hpp"), "int c;\n")
+            changes = watcher.read(timeout=5)
+            paths = {path for path, _ in changes}
+            assert existing in paths
+            assert os.path.join(tmpdir, "new.hpp") in paths
+            assert any(
+                mask & compiletools.inotify.IN_CREATE
+                for path, mask in changes
+                if path == os.path.join(tmpdir, "new.hpp")
+            )
+
+    def test_read_times_out(self):
+        with uth.TempDirContextNoChange() as tmpdir, compiletools.inotify.Inotify() as watcher:
+            watcher.watch(tmpdir)
+            assert watcher.read(timeout=0) == []
+
+
+class TestForgetChangedFiles:
+    def test_only_the_changed_files_are_forgotten(self):
+        # Start from an empty include cache whatever earlier tests left in it
+        compiletools.headerdeps.DirectHeaderDeps.clear_cache()
+        with uth.TempDirContextNoChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            ahpp = os.path.join(tmpdir, "a.hpp")
+            bhpp = os.path.join(tmpdir, "b.hpp")
+            for filename in (ahpp, bhpp):
+                _write(filename, "#define X 1\n")
+                compiletools.simple_preprocessor.preprocess_file(filename, {})
+            find = compiletools.headerdeps.DirectHeaderDeps._find_include_in
+            assert find((), "a.hpp", tmpdir) == ahpp
+
+            def cached():
+                return {key[0] for key in compiletools.simple_preprocessor._preprocessed_files}
+
+            try:
+                compiletools.cake.forget_changed_files([(ahpp, compiletools.inotify.IN_CLOSE_WRITE)])
+                assert ahpp not in cached()
+                assert bhpp in cached()
+                # Modifying a file doesn't change where includes are found
+                assert find.cache_info().currsize == 1
+
+                compiletools.cake.forget_changed_files([(os.path.join(tmpdir, "c.hpp"), compiletools.inotify.IN_CREATE)])
+                assert bhpp in cached()
+                assert find.cache_info().currsize == 0
+            finally:
+                compiletools.headerdeps.DirectHeaderDeps.clear_cache()
+
+
+class TestServed:
+    def _start_server(self, socketpath, max_builds):
+        environ = dict(os.environ)
+        environ["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(uth.ctdir())] + [path for path in environ.get("PYTHONPATH", "").split(os.pathsep) if path]
+        )
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import sys, compiletools.served; sys.exit(compiletools.served.main(sys.argv[1:]))",
+                "--socket",
+                socketpath,
+                "--max-builds",
+                str(max_builds),
+            ],
+            env=environ,
+        )
+        deadline = time.time() + 30
+        while not os.path.exists(socketpath):
+            assert process.poll() is None, "ct-served exited early"
+            assert time.time() < deadline, "ct-served did not start"
+            time.sleep(0.05)
+        return process
+
+    def test_request_without_server(self):
+        with uth.TempDirContextNoChange() as tmpdir:
+            assert compiletools.served.request(["--auto"], os.path.join(tmpdir, "nobody.sock")) is None
+
+    def test_builds_and_rebuilds_through_server(self):
+        with uth.TempDirContextWithChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            _write(os.path.join(tmpdir, "value.hpp"), "constexpr int value = 3;\n")
+            _write(
+                os.path.join(tmpdir, "main.cpp"),
+                """\
+                #include "value.hpp"
+                int main() { return value; }
+                """,
+            )
+            config = uth.create_temp_config(tmpdir)
+            uth.create_temp_ct_conf(tempdir=tmpdir, defaultvariant=os.path.basename(config)[:-5])
+            argv = ["--exemarkers=main", "--testmarkers=unittest.hpp", "--auto", "--config=" + config, "--CTCACHE=None"]
+
+            socketpath = os.path.join(tmpdir, "ct-served.sock")
+            server = self._start_server(socketpath, max_builds=2)
+            try:
+                assert compiletools.served.request(argv + ["--profile"], socketpath) == 0
+                assert subprocess.run([os.path.join(tmpdir, "bin", "main")]).returncode == 3
+                # The profile belongs to the build, not to the server's lifetime
+                assert glob.glob(os.path.join(tmpdir, "*.pstats"))
+
+                valuehpp = os.path.join(tmpdir, "value.hpp")
+                # Only picked up if the server notices that value.hpp changed
+                _write(valuehpp, "//#CPPFLAGS=-DVALUE=5\nconstexpr int value = VALUE;\n")
+                _touch_later(valuehpp)
+                with uth.EnvironmentContext({"CTSERVED_SOCKET": socketpath}):
+                    uth.reset()
+                    assert compiletools.cake.main(["--server"] + argv) == 0
+                assert subprocess.run([os.path.join(tmpdir, "bin", "main")]).returncode == 5
+                assert server.wait(timeout=30) == 0
+            finally:
+                if server.poll() is None:
+                    server.kill()
+                    server.wait()
+                uth.reset()
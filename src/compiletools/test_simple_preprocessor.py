@@ -262,6 +262,72 @@ class TestSimplePreprocessor:
         # Should stop after max_iterations and return last value
         assert result in ['X', 'Y']  # Could be either depending on iteration count
 
+    def test_function_like_macro_version_check(self):
+        """Test #if guards that invoke a function-like version check macro"""
+        processor = SimplePreprocessor({'__GNUC__': '10', '__GNUC_MINOR__': '2'}, verbose=0)
+        text = '''
+#define GCC_VERSION_AT_LEAST(x, y) (__GNUC__ > (x) || (__GNUC__ == (x) && __GNUC_MINOR__ >= (y)))
+#if GCC_VERSION_AT_LEAST(9, 1)
+#include "new_gcc.h"
+#endif
+#if GCC_VERSION_AT_LEAST(11, 0)
+#include "newest_gcc.h"
+#endif
+'''
+        result = processor.process(text)
+        assert '#include "new_gcc.h"' in result
+        assert '#include "newest_gcc.h"' not in result
+
+    def test_function_like_macro_definition(self):
+        """Test that function-like macros are stored with their parameters"""
+        from compiletools.simple_preprocessor import FunctionMacro
+        processor = SimplePreprocessor({}, verbose=0)
+        processor.process('#define MAX(a, b) ((a) > (b) ? (a) : (b))\n#define LOG(fmt, ...) printf(fmt, __VA_ARGS__)\n')
+        assert processor.macros['MAX'] == FunctionMacro('MAX', ('a', 'b'), '((a) > (b) ? (a) : (b))')
+        assert processor.macros['LOG'].variadic
+        assert processor.macros['LOG'].params == ('fmt', '__VA_ARGS__')
+
+    def test_function_like_macro_expansion(self):
+        """Test nesting, token pasting, variadic arguments and self reference"""
+        processor = SimplePreprocessor({}, verbose=0)
+        processor.process('''
+#define HAVE(feature) HAVE_##feature
+#define HAVE_THREADS 1
+#define SECOND(...) PICK(__VA_ARGS__)
+#define PICK(a, b) b
+#define TWICE(x) ((x) * 2)
+#define SELF SELF
+#define ZERO() 0
+''')
+        assert processor._evaluate_expression('HAVE(THREADS)') == 1
+        assert processor._evaluate_expression('HAVE(FIBERS)') == 0
+        assert processor._evaluate_expression('SECOND(3, 4) == 4') == 1
+        assert processor._evaluate_expression('TWICE(TWICE(3)) == 12') == 1
+        assert processor._evaluate_expression('SELF') == 0
+        assert processor._evaluate_expression('ZERO() == 0') == 1
+        # A function-like macro name without arguments is not an invocation
+        assert processor._evaluate_expression('TWICE') == 0
+        assert processor._evaluate_expression('defined(TWICE)') == 1
+
+    def test_function_like_macro_expansion_cache(self):
+        """Test that redefining a macro invalidates cached expansions"""
+        processor = SimplePreprocessor({}, verbose=0)
+        text = '''
+#define LIMIT 1
+#define ABOVE(x) ((x) > LIMIT)
+#if ABOVE(2)
+first
+#endif
+#undef LIMIT
+#define LIMIT 5
+#if ABOVE(2)
+second
+#endif
+'''
+        result = processor.process(text)
+        assert 'first' in result
+        assert 'second' not in result
+
     def test_comment_stripping(self):
         """Test C++ style comment stripping from expressions"""
         # Test basic comment stripping
@@ -185,6 +185,170 @@ class TestTimer:
         assert "inner_operation_1" in self.timer.nested_timings["outer_operation"]
         assert "inner_operation_2" in self.timer.nested_timings["outer_operation"]
 
+    def test_repeated_operations_are_aggregated(self):
+        """Test that spans of the same operation add up rather than overwrite"""
+        for delay in (0.01, 0.02, 0.01):
+            with self.timer.time_operation("include_analysis", "/src/a.cpp"):
+                time.sleep(delay)
+
+        stats = self.timer.stats["include_analysis"]
+        assert stats.count == 3
+        assert stats.total >= 0.04
+        assert stats.min >= 0.01
+        assert stats.max >= 0.02
+        assert stats.min < stats.max
+        assert self.timer.get_elapsed("include_analysis") == stats.total
+        # The breakdown by file is off by default
+        assert self.timer.files == {}
+
+    def test_self_time_and_recursion(self):
+        """Test self time excludes nested spans and recursion isn't double counted"""
+        with self.timer.time_operation("outer"):
+            time.sleep(0.01)
+            with self.timer.time_operation("inner"):
+                time.sleep(0.02)
+                with self.timer.time_operation("inner"):
+                    time.sleep(0.01)
+
+        outer = self.timer.stats["outer"]
+        inner = self.timer.stats["inner"]
+        assert inner.count == 2
+        assert inner.total == pytest.approx(outer.total - outer.self_time, abs=0.001)
+        assert inner.self_time == pytest.approx(inner.total, abs=0.001)
+        assert 0.01 <= outer.self_time < inner.total
+        # Recursion isn't nesting
+        assert self.timer.nested_timings == {"outer": ["inner"]}
+
+    def test_stop_closes_spans_left_open(self):
+        """Test that a missing stop can't corrupt the other operations"""
+        self.timer.start("outer")
+        self.timer.start("forgotten")
+        time.sleep(0.01)
+        assert self.timer.stop("outer") >= 0.01
+        assert self.timer.stats["forgotten"].count == 1
+        assert self.timer.stop("forgotten") == 0.0
+        assert self.timer._stack() == []
+
+    def test_per_file_breakdown(self):
+        """Test the per file breakdown keeps files with the same basename apart"""
+        timer = compiletools.timing.Timer(enabled=True, per_file=True)
+        for filename in ("/a/util.hpp", "/b/util.hpp", "/a/util.hpp"):
+            with timer.time_operation("include_analysis", filename):
+                pass
+
+        files = timer.files["include_analysis"]
+        assert files["/a/util.hpp"].count == 2
+        assert files["/b/util.hpp"].count == 1
+        assert timer.stats["include_analysis"].count == 3
+
+        output = StringIO()
+        timer.report(verbose_level=1, file=output)
+        assert "include_analysis: " in output.getvalue()
+        assert "3 calls" in output.getvalue()
+        assert "[/b/util.hpp]:" in output.getvalue()
+
+    def test_threads_have_their_own_spans(self):
+        """Test that spans on different threads don't nest into each other"""
+        import threading
+
+        started = threading.Event()
+        finish = threading.Event()
+
+        def worker():
+            with self.timer.time_operation("worker"):
+                started.set()
+                finish.wait()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        started.wait()
+        with self.timer.time_operation("main"):
+            finish.set()
+            thread.join()
+
+        assert self.timer.stats["worker"].count == 1
+        assert self.timer.stats["main"].count == 1
+        assert self.timer.nested_timings == {}
+
+    def test_trace_events(self):
+        """Test that a trace has a complete event for every span on the thread that ran it"""
+        import threading
+
+        timer = compiletools.timing.Timer(enabled=True, trace=True)
+        with timer.time_operation("outer"):
+            with timer.time_operation("include_analysis", "/a/util.hpp"):
+                pass
+        thread = threading.Thread(target=lambda: timer.record_span("compiler_probe", 1.0, 1.5), name="prober")
+        thread.start()
+        thread.join()
+
+        events = timer.trace_events()
+        spans = {event["name"]: event for event in events if event["ph"] == "X"}
+        assert set(spans) == {"outer", "include_analysis", "compiler_probe"}
+        assert spans["include_analysis"]["args"] == {"detail": "/a/util.hpp"}
+        assert spans["outer"]["ts"] <= spans["include_analysis"]["ts"]
+        assert spans["outer"]["tid"] == spans["include_analysis"]["tid"] == threading.get_native_id()
+        assert spans["compiler_probe"]["tid"] != spans["outer"]["tid"]
+        assert spans["compiler_probe"]["dur"] == 500000
+        # Timestamps are microseconds since the epoch
+        assert abs(spans["outer"]["ts"] / 1e6 - time.time()) < 60
+        thread_names = {event["tid"]: event["args"]["name"] for event in events if event["name"] == "thread_name"}
+        assert thread_names[spans["compiler_probe"]["tid"]] == "prober"
+
+    def test_write_trace_merges_compiler_traces(self, tmp_path):
+        """Test that clang -ftime-trace files are moved onto the same timeline"""
+        import json
+
+        clangtrace = tmp_path / "foo.json"
+        clangtrace.write_text(
+            json.dumps(
+                {
+                    "beginningOfTime": 1_700_000_000_000_000,
+                    "traceEvents": [
+                        {"name": "Frontend", "ph": "X", "ts": 10, "dur": 5, "pid": 1, "tid": 1},
+                        {"name": "process_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": "clang"}},
+                    ],
+                }
+            )
+        )
+        timer = compiletools.timing.Timer(enabled=True, trace=True)
+        with timer.time_operation("make_build"):
+            pass
+        tracefile = tmp_path / "trace.json"
+        timer.write_trace(str(tracefile), [str(clangtrace), str(tmp_path / "missing.json")])
+
+        events = json.loads(tracefile.read_text())["traceEvents"]
+        frontend = [event for event in events if event["name"] == "Frontend"]
+        assert len(frontend) == 1
+        assert frontend[0]["ts"] == 1_700_000_000_000_010
+        assert frontend[0]["pid"] != next(event["pid"] for event in events if event["name"] == "make_build")
+        names = [event["args"]["name"] for event in events if event["name"] == "process_name"]
+        assert names == ["ct", "foo.json"]
+
+    def test_disabled_time_operation_is_a_shared_no_op(self):
+        """Test that the disabled path doesn't create anything per call"""
+        timer = compiletools.timing.Timer(enabled=False)
+        first = timer.time_operation("include_analysis", "/a/util.hpp")
+        assert first is timer.time_operation("other")
+        with first:
+            pass
+        assert timer.stats == {}
+
+        compiletools.timing.initialize_timer(enabled=False)
+        assert compiletools.timing.time_operation("op") is first
+
+    def test_time_operation_stops_on_exception(self):
+        with pytest.raises(ValueError):
+            with self.timer.time_operation("failing"):
+                raise ValueError("boom")
+        assert self.timer.stats["failing"].count == 1
+        assert self.timer._stack() == []
+
+    def test_untraced_timer_keeps_no_events(self):
+        with self.timer.time_operation("op"):
+            pass
+        assert self.timer.events == []
+
 
 class TestGlobalTimerFunctions:
     
@@ -0,0 +1,70 @@
+import os
+import argparse
+from io import StringIO
+
+import compiletools.buildtimes
+import compiletools.timing_report
+import compiletools.testhelper as uth
+
+
+def _args(**kwargs):
+    defaults = dict(top=10, threshold=1.25, minimum=0.1, all_projects=False)
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+def _buildtimes(tmpdir, history):
+    buildtimes = compiletools.buildtimes.BuildTimes(os.path.join(tmpdir, "buildtimes.json"))
+    for target, durations in history.items():
+        buildtimes.targets[target] = [[float(ii), seconds] for ii, seconds in enumerate(durations)]
+    return buildtimes
+
+
+def test_sparkline():
+    assert compiletools.timing_report.sparkline([]) == ""
+    assert compiletools.timing_report.sparkline([1, 1]) == "▁▁"
+    assert compiletools.timing_report.sparkline([0, 7, 3.5]) == "▁█▄"
+
+
+def test_slowest_and_regressions():
+    with uth.TempDirContextNoChange() as tmpdir:
+        buildtimes = _buildtimes(
+            tmpdir,
+            {
+                "/p/bin/obj/big.o": [10.0, 10.0, 20.0],
+                "/p/bin/obj/small.o": [1.0, 1.0, 1.01],
+                "/p/bin/obj/tiny.o": [0.01, 0.01, 0.05],
+                "/p/bin/main": [2.0],
+            },
+        )
+        slowest = compiletools.timing_report.slowest(buildtimes, compiletools.timing_report._iscompile, 2)
+        assert [target for target, _ in slowest] == ["/p/bin/obj/big.o", "/p/bin/obj/small.o"]
+        # tiny.o got 5x slower but only by 40ms
+        assert compiletools.timing_report.regressions(buildtimes, 1.25, 0.1) == [("/p/bin/obj/big.o", 10.0, 20.0)]
+
+
+def test_report_is_limited_to_the_current_project():
+    with uth.TempDirContextNoChange() as tmpdir:
+        project = os.path.join(tmpdir, "project")
+        buildtimes = _buildtimes(
+            tmpdir,
+            {
+                os.path.join(project, "bin", "obj", "a.o"): [1.0, 3.0],
+                os.path.join(project, "bin", "a"): [0.5, 0.5],
+                os.path.join(project, "bin", "test_a.result"): [0.2],
+                os.path.join(tmpdir, "other", "bin", "obj", "b.o"): [4.0],
+            },
+        )
+        buildtimes.record_run({"total_build_time": 5.0, "makefile_creation": 0.5}, cwd=project)
+        buildtimes.record_run({"total_build_time": 4.0}, cwd=os.path.join(tmpdir, "other"))
+
+        output = StringIO()
+        compiletools.timing_report.report(buildtimes, _args(), project, file=output)
+        text = output.getvalue()
+        assert "Slowest translation units:" in text
+        assert os.path.join("bin", "obj", "a.o") in text
+        assert "b.o" not in text
+        assert "Slowest tests:" in text
+        assert "(+200%)" in text
+        assert "makefile_creation" in text
+        assert "(1 runs" in text
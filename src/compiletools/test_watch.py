@@ -0,0 +1,116 @@
+import os
+import glob
+import time
+import threading
+import subprocess
+from textwrap import dedent
+
+import pytest
+
+import compiletools.inotify
+import compiletools.watch
+import compiletools.testhelper as uth
+
+
+pytestmark = pytest.mark.skipif(not compiletools.inotify.available(), reason="inotify is not available")
+
+
+def _write(filename, text):
+    with open(filename, "w") as ff:
+        ff.write(dedent(text))
+
+
+class TestWatcher:
+    def test_relevant_and_affected(self):
+        watcher = compiletools.watch.Watcher([])
+        try:
+            watcher.closures = {
+                "/src/a.cpp": {"/src/a.cpp", "/src/a.hpp", "/src/common.hpp"},
+                "/src/b.cpp": {"/src/b.cpp", "/src/common.hpp"},
+            }
+            changes = [
+                ("/src/a.hpp", compiletools.inotify.IN_CLOSE_WRITE),
+                ("/src/.a.hpp.swp", compiletools.inotify.IN_MODIFY),
+                ("/src/notes.txt", compiletools.inotify.IN_CREATE),
+                ("/src/new.hpp", compiletools.inotify.IN_CREATE),
+                ("/src/unrelated.hpp", compiletools.inotify.IN_MODIFY),
+            ]
+            assert watcher.relevant(changes) == {"/src/a.hpp", "/src/new.hpp"}
+            assert watcher.relevant([(None, compiletools.inotify.IN_Q_OVERFLOW)]) is None
+
+            assert watcher.affected({"/src/a.hpp"}) == ["/src/a.cpp"]
+            assert watcher.affected({"/src/common.hpp"}) == ["/src/a.cpp", "/src/b.cpp"]
+            assert watcher.affected({"/src/new.hpp"}) == []
+        finally:
+            watcher.close()
+
+    def test_rebuilds_only_affected_targets(self):
+        with uth.TempDirContextWithChange() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            for name, value in (("a", 3), ("b", 4)):
+                _write(os.path.join(tmpdir, name + ".hpp"), "constexpr int {} = {};\n".format(name, value))
+                _write(
+                    os.path.join(tmpdir, name + ".cpp"),
+                    """\
+                    #include "{0}.hpp"
+                    int main() {{ return {0}; }}
+                    """.format(name),
+                )
+            config = uth.create_temp_config(tmpdir)
+            uth.create_temp_ct_conf(tempdir=tmpdir, defaultvariant=os.path.basename(config)[:-5])
+            argv = ["--exemarkers=main", "--testmarkers=unittest.hpp", "--auto", "--config=" + config, "--CTCACHE=None"]
+
+            ahpp = os.path.join(tmpdir, "a.hpp")
+            abin = os.path.join(tmpdir, "bin", "a")
+            bbin = os.path.join(tmpdir, "bin", "b")
+            watcher = compiletools.watch.Watcher(argv)
+            bmtime = []
+
+            def edit():
+                # Keep editing until the watcher has noticed, so that an edit
+                # made before the watches were in place can't hang the test
+                deadline = time.time() + 60
+                while watcher.builds < 2 and time.time() < deadline:
+                    if tmpdir in watcher._inotify.watching():
+                        if not bmtime:
+                            bmtime.append(os.path.getmtime(bbin))
+                        _write(ahpp, "constexpr int a = 7;\n")
+                    time.sleep(0.5)
+
+            editor = threading.Thread(target=edit)
+            editor.start()
+            try:
+                uth.reset()
+                assert watcher.run(max_builds=2) == 0
+            finally:
+                editor.join()
+                watcher.close()
+                uth.reset()
+
+            assert subprocess.run([abin]).returncode == 7
+            assert subprocess.run([bbin]).returncode == 4
+            assert os.path.getmtime(bbin) == bmtime[0]
+
+            makefiles = glob.glob(os.path.join(tmpdir, "bin", "**", "Makefile"), recursive=True)
+            with open(makefiles[0]) as ff:
+                assert "build_only_changed=['{}']".format(ahpp) in ff.readline()
+
+    def test_changed_paths_are_separate_arguments(self):
+        watcher = compiletools.watch.Watcher([])
+        builds = []
+
+        def build(extraargv=()):
+            builds.append(list(extraargv))
+            watcher.builds += 1
+
+        try:
+            watcher.closures = {"/src/a b.cpp": {"/src/a b.cpp", "/src/my header.hpp", "/src/c.hpp"}}
+            watcher._build = build
+            watcher._wait_for_changes = lambda: [
+                ("/src/my header.hpp", compiletools.inotify.IN_CLOSE_WRITE),
+                ("/src/c.hpp", compiletools.inotify.IN_CLOSE_WRITE),
+            ]
+            watcher.run(max_builds=2)
+        finally:
+            watcher.close()
+        assert builds == [[], ["--build-only-changed=/src/c.hpp", "--build-only-changed=/src/my header.hpp"]]
@@ -1,70 +1,216 @@
+import os
+import json
 import time
 import sys
-from contextlib import contextmanager
-from collections import defaultdict, OrderedDict
+import threading
+from collections import OrderedDict
+
+
+class OperationStats:
+    """Aggregated timings of every span of one operation (or of one file
+    within an operation).  self_time excludes the time spent in nested
+    operations.
+    """
+
+    __slots__ = ("count", "total", "min", "max", "self_time")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.self_time = 0.0
+
+    def add(self, elapsed, self_elapsed, outermost=True):
+        self.count += 1
+        # A recursive span is already included in its outermost span
+        if outermost:
+            self.total += elapsed
+        self.self_time += self_elapsed
+        self.min = min(self.min, elapsed)
+        self.max = max(self.max, elapsed)
+
+    def __repr__(self):
+        return "OperationStats(count={}, total={}, min={}, max={}, self_time={})".format(
+            self.count, self.total, self.min, self.max, self.self_time
+        )
+
+
+class _Span:
+    __slots__ = ("name", "detail", "start", "child_time")
+
+    def __init__(self, name, detail, start):
+        self.name = name
+        self.detail = detail
+        self.start = start
+        self.child_time = 0.0
+
+
+class _NullOperation:
+    """What time_operation returns when timing is disabled.  A single shared
+    instance so that the instrumented hot paths cost one attribute check.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_OPERATION = _NullOperation()
+
+
+class _TimedOperation:
+    """Context manager for one span.  A class rather than a
+    contextlib.contextmanager generator, which costs much more to enter.
+    """
+
+    __slots__ = ("timer", "name", "detail")
+
+    def __init__(self, timer, name, detail):
+        self.timer = timer
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.timer.start(self.name, self.detail)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.stop(self.name)
+        return False
 
 
 class Timer:
     """Timer class for tracking elapsed time of operations in compiletools.
-    
-    Supports nested timing contexts and hierarchical reporting based on verbose levels.
+
+    Every start/stop pair is a span.  Spans of the same operation are
+    aggregated (count, total, min, max and self time) rather than
+    overwriting each other, so operation names should be categories like
+    "include_analysis".  The file (or other detail) that a span is about is
+    passed separately and is only kept, as a per file breakdown of each
+    operation, when per_file is True.
+
+    Each thread has its own stack of open spans.  Supports nested timing
+    contexts and hierarchical reporting based on verbose levels.  When
+    trace is True every span is also kept so that write_trace can export
+    them in the Chrome trace event format.
     """
-    
-    def __init__(self, enabled=False):
+
+    def __init__(self, enabled=False, per_file=False, trace=False):
         self.enabled = enabled
-        self.timings = OrderedDict()  # Operation name -> elapsed time
-        self.nested_timings = defaultdict(list)  # Parent -> list of child timings
-        self.start_times = {}  # Operation name -> start time
-        self.operation_stack = []  # Stack for nested operations
-        
-    def start(self, operation_name):
-        """Start timing an operation."""
+        self.per_file = per_file
+        self.trace = trace
+        self.events = []  # (name, detail, start, elapsed, thread id) of every span when tracing
+        self.thread_names = {}  # thread id -> thread name
+        # Add to a time.perf_counter() to get seconds since the epoch
+        self._epoch_offset = time.time() - time.perf_counter()
+        self.stats = OrderedDict()  # Operation name -> OperationStats
+        self.files = {}  # Operation name -> {detail -> OperationStats}
+        self.children = OrderedDict()  # Parent operation name -> {child operation name: None}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def start(self, operation_name, detail=None):
+        """Start timing an operation.  detail is usually the file that the
+        operation is working on."""
         if not self.enabled:
             return
-            
-        current_time = time.perf_counter()
-        self.start_times[operation_name] = current_time
-        
-        # Track nesting
-        if self.operation_stack:
-            parent = self.operation_stack[-1]
-            self.nested_timings[parent].append(operation_name)
-        
-        self.operation_stack.append(operation_name)
-    
+
+        stack = self._stack()
+        if stack and stack[-1].name != operation_name:
+            with self._lock:
+                self.children.setdefault(stack[-1].name, {})[operation_name] = None
+        stack.append(_Span(operation_name, detail, time.perf_counter()))
+
     def stop(self, operation_name):
-        """Stop timing an operation and record elapsed time."""
+        """Stop timing the innermost open span of the operation and return its elapsed time."""
         if not self.enabled:
             return 0.0
-            
+
         current_time = time.perf_counter()
-        
-        if operation_name not in self.start_times:
+        stack = self._stack()
+        for index in range(len(stack) - 1, -1, -1):
+            if stack[index].name == operation_name:
+                break
+        else:
             return 0.0
-            
-        elapsed = current_time - self.start_times[operation_name]
-        self.timings[operation_name] = elapsed
-        
-        # Remove from stack
-        if self.operation_stack and self.operation_stack[-1] == operation_name:
-            self.operation_stack.pop()
-        
-        del self.start_times[operation_name]
+
+        # Spans that were left open inside this one end with it
+        while len(stack) > index + 1:
+            self._close(stack, current_time)
+        return self._close(stack, current_time)
+
+    def _close(self, stack, current_time):
+        span = stack.pop()
+        elapsed = current_time - span.start
+        outermost = not any(other.name == span.name for other in stack)
+        self._record(span.name, span.detail, span.start, elapsed, elapsed - span.child_time, outermost)
+        if stack:
+            stack[-1].child_time += elapsed
         return elapsed
-    
-    @contextmanager
-    def time_operation(self, operation_name):
-        """Context manager for timing operations."""
-        self.start(operation_name)
-        try:
-            yield
-        finally:
-            self.stop(operation_name)
-    
+
+    def _record(self, name, detail, start, elapsed, self_elapsed, outermost, thread_id=None, thread_name=None):
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = OperationStats()
+            stats.add(elapsed, self_elapsed, outermost)
+            if self.per_file and detail is not None:
+                filestats = self.files.setdefault(name, {}).get(detail)
+                if filestats is None:
+                    filestats = self.files[name][detail] = OperationStats()
+                filestats.add(elapsed, self_elapsed, outermost)
+            if self.trace:
+                if thread_id is None:
+                    thread_id = threading.get_native_id()
+                    thread_name = threading.current_thread().name
+                if thread_id not in self.thread_names:
+                    self.thread_names[thread_id] = thread_name
+                self.events.append((name, detail, start, elapsed, thread_id))
+
+    def record_span(self, operation_name, start, end, detail=None, thread_id=None, thread_name=None):
+        """Record a span that has already finished, e.g., one that ran
+        before this timer existed.  start and end are time.perf_counter()
+        values.  The thread defaults to the current thread.
+        """
+        if not self.enabled:
+            return
+        self._record(operation_name, detail, start, end - start, end - start, True, thread_id, thread_name)
+
+    def time_operation(self, operation_name, detail=None):
+        """Context manager for timing operations.  Does nothing (cheaply)
+        when the timer is disabled.  Pass the file or other detail rather
+        than building it into operation_name.
+        """
+        if not self.enabled:
+            return _NULL_OPERATION
+        return _TimedOperation(self, operation_name, detail)
+
+    @property
+    def timings(self):
+        """Operation name -> total elapsed time"""
+        return OrderedDict((name, stats.total) for name, stats in self.stats.items())
+
+    @property
+    def nested_timings(self):
+        """Parent operation name -> names of the operations started inside it"""
+        return {parent: list(children) for parent, children in self.children.items()}
+
     def get_elapsed(self, operation_name):
-        """Get elapsed time for an operation."""
-        return self.timings.get(operation_name, 0.0)
-    
+        """Get the total elapsed time for an operation."""
+        stats = self.stats.get(operation_name)
+        return stats.total if stats is not None else 0.0
+
     def format_time(self, seconds):
         """Format time in microseconds for precision."""
         microseconds = seconds * 1_000_000
@@ -78,83 +224,155 @@ class Timer:
             minutes = int(seconds // 60)
             secs = seconds % 60
             return f"{minutes}m{secs:.1f}s"
-    
+
+    def _top_level(self):
+        all_nested = set()
+        for children in self.children.values():
+            all_nested.update(children)
+        return [name for name in self.stats if name not in all_nested]
+
     def report(self, verbose_level, file=None):
         """Generate timing report based on verbose level."""
-        if not self.enabled or not self.timings:
+        if not self.enabled or not self.stats:
             return
-        
+
         if file is None:
             file = sys.stderr
-        
+
         # Calculate total time from top-level operations only to avoid double-counting
-        all_nested = set()
-        for children in self.nested_timings.values():
-            all_nested.update(children)
-        
-        top_level_ops = [op for op in self.timings if op not in all_nested]
-        total_time = sum(self.timings[op] for op in top_level_ops) if top_level_ops else sum(self.timings.values())
-        
+        top_level_ops = self._top_level()
+        if top_level_ops:
+            total_time = sum(self.stats[op].total for op in top_level_ops)
+        else:
+            total_time = sum(stats.total for stats in self.stats.values())
+
         if verbose_level >= 0:
             print(f"Total build time: {self.format_time(total_time)}", file=file)
-        
+
         if verbose_level >= 1:
             print("\nDetailed timing breakdown:", file=file)
             # Each verbose level allows one more level of indentation
             max_depth = verbose_level
             self._report_detailed(file=file, max_depth=max_depth)
-    
+
     def _report_detailed(self, file=None, indent=0, shown_operations=None, max_depth=None):
         """Generate detailed hierarchical timing report."""
         if file is None:
             file = sys.stderr
-        
+
         if shown_operations is None:
             shown_operations = set()
-        
-        # Find top-level operations (not nested under others)
-        top_level = []
-        all_nested = set()
-        for parent, children in self.nested_timings.items():
-            all_nested.update(children)
-        
-        for op_name in self.timings:
-            if op_name not in all_nested:
-                top_level.append(op_name)
-        
+
         # Report top-level operations recursively
-        for op_name in top_level:
+        for op_name in self._top_level():
             if op_name not in shown_operations:
                 self._report_operation_recursive(op_name, file, indent, shown_operations, max_depth)
-    
+
+    def _format_stats(self, stats):
+        text = self.format_time(stats.total)
+        if stats.count > 1:
+            text += " ({} calls, self {}, min {}, max {})".format(
+                stats.count,
+                self.format_time(stats.self_time),
+                self.format_time(stats.min),
+                self.format_time(stats.max),
+            )
+        return text
+
     def _report_operation_recursive(self, op_name, file, indent, shown_operations, max_depth):
         """Recursively report an operation and all its nested operations."""
         if op_name in shown_operations:
             return
-        
+
         shown_operations.add(op_name)
-        elapsed = self.timings.get(op_name, 0.0)
-        print(f"{'  ' * indent}{op_name}: {self.format_time(elapsed)}", file=file)
-        
+        print(f"{'  ' * indent}{op_name}: {self._format_stats(self.stats[op_name])}", file=file)
+
+        # The slowest files of the operation
+        if op_name in self.files:
+            slowest = sorted(self.files[op_name].items(), key=lambda item: item[1].total, reverse=True)
+            for detail, stats in slowest[:10]:
+                print(f"{'  ' * (indent + 1)}[{detail}]: {self._format_stats(stats)}", file=file)
+            if len(slowest) > 10:
+                print(f"{'  ' * (indent + 1)}[... {len(slowest) - 10} more]", file=file)
+
         # Report nested operations recursively, respecting max_depth
-        if op_name in self.nested_timings and (max_depth is None or indent < max_depth):
-            for child_name in self.nested_timings[op_name]:
-                if child_name in self.timings:
+        if op_name in self.children and (max_depth is None or indent < max_depth):
+            for child_name in self.children[op_name]:
+                if child_name in self.stats:
                     self._report_operation_recursive(child_name, file, indent + 1, shown_operations, max_depth)
-    
+
+    def trace_events(self):
+        """The spans as Chrome trace events.  Timestamps are microseconds
+        since the epoch (like clang's -ftime-trace beginningOfTime) so
+        that they line up with the traces of other processes.
+        """
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "ct"}}]
+        for thread_id, thread_name in self.thread_names.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": thread_name}})
+        for name, detail, start, elapsed, thread_id in self.events:
+            event = {
+                "name": name,
+                "cat": "ct",
+                "ph": "X",
+                "ts": round((start + self._epoch_offset) * 1_000_000),
+                "dur": round(elapsed * 1_000_000),
+                "pid": pid,
+                "tid": thread_id,
+            }
+            if detail is not None:
+                event["args"] = {"detail": str(detail)}
+            events.append(event)
+        return events
+
+    def write_trace(self, filename, compiler_traces=()):
+        """Write the spans to filename in the Chrome trace event format
+        (which Perfetto and chrome://tracing read).  compiler_traces are
+        clang -ftime-trace files to merge in, each as its own process.
+        """
+        events = self.trace_events()
+        for index, tracefile in enumerate(compiler_traces, start=1):
+            events.extend(_compiler_trace_events(tracefile, pid=-index))
+        with open(filename, "w", encoding="utf-8") as ff:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, ff)
+
     def get_summary(self):
         """Get a summary dictionary of timing information."""
         if not self.enabled:
             return {}
-        
+
+        timings = self.timings
         return {
-            'total_time': sum(self.timings.values()),
-            'operation_count': len(self.timings),
-            'slowest_operation': max(self.timings.items(), key=lambda x: x[1]) if self.timings else None,
-            'operations': dict(self.timings)
+            'total_time': sum(timings.values()),
+            'operation_count': len(timings),
+            'slowest_operation': max(timings.items(), key=lambda x: x[1]) if timings else None,
+            'operations': dict(timings)
         }
 
 
+def _compiler_trace_events(tracefile, pid):
+    """The events of a clang -ftime-trace file, moved onto the same
+    timeline as Timer.trace_events and into their own process.
+    """
+    try:
+        with open(tracefile, encoding="utf-8") as ff:
+            data = json.load(ff)
+        beginning = data["beginningOfTime"]
+        events = data["traceEvents"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return []
+
+    result = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": os.path.basename(tracefile)}}]
+    for event in events:
+        if event.get("ph") == "M" and event.get("name") == "process_name":
+            continue
+        event = dict(event, pid=pid)
+        if "ts" in event:
+            event["ts"] = event["ts"] + beginning
+        result.append(event)
+    return result
+
+
 # Global timer instance for use throughout compiletools
 _global_timer = Timer()
 
@@ -164,20 +382,22 @@ def get_timer():
     return _global_timer
 
 
-def initialize_timer(enabled=False):
+def initialize_timer(enabled=False, per_file=False, trace=False):
     """Initialize the global timer."""
     global _global_timer
-    _global_timer = Timer(enabled)
+    _global_timer = Timer(enabled, per_file, trace)
 
 
-def time_operation(operation_name):
-    """Context manager decorator for timing operations."""
-    return _global_timer.time_operation(operation_name)
+def time_operation(operation_name, detail=None):
+    """Context manager for timing operations with the global timer."""
+    if not _global_timer.enabled:
+        return _NULL_OPERATION
+    return _TimedOperation(_global_timer, operation_name, detail)
 
 
-def start_timing(operation_name):
+def start_timing(operation_name, detail=None):
     """Start timing an operation using the global timer."""
-    _global_timer.start(operation_name)
+    _global_timer.start(operation_name, detail)
 
 
 def stop_timing(operation_name):
@@ -187,4 +407,4 @@ def stop_timing(operation_name):
 
 def report_timing(verbose_level, file=None):
     """Generate timing report using the global timer."""
-    _global_timer.report(verbose_level, file)
\ No newline at end of file
+    _global_timer.report(verbose_level, file)
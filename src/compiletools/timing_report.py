@@ -0,0 +1,162 @@
+""" Report on the build times that ct-cake recorded in the timing database
+    (see compiletools.buildtimes).
+"""
+import os
+import sys
+import time
+
+import compiletools.apptools
+import compiletools.buildtimes
+import compiletools.dirnamer
+import compiletools.timing
+
+_SPARKS = "▁▂▃▄▅▆▇█"
+
+
+def sparkline(values):
+    """ A one line chart of values, e.g. ▁▃█▂ """
+    if not values:
+        return ""
+    low = min(values)
+    spread = max(values) - low
+    if spread <= 0:
+        return _SPARKS[0] * len(values)
+    return "".join(_SPARKS[int((value - low) / spread * (len(_SPARKS) - 1))] for value in values)
+
+
+def _iscompile(target):
+    return target.endswith(".o")
+
+
+def _istest(target):
+    return target.endswith(".result")
+
+
+def _latest(samples):
+    return samples[-1][1]
+
+
+def slowest(buildtimes, predicate, count):
+    """ The count slowest targets (by their latest duration) that satisfy predicate """
+    targets = [(target, samples) for target, samples in buildtimes.targets.items() if samples and predicate(target)]
+    targets.sort(key=lambda item: _latest(item[1]), reverse=True)
+    return targets[:count]
+
+
+def regressions(buildtimes, threshold, minimum):
+    """ Targets whose latest duration is more than threshold times the
+        average of their earlier durations and at least minimum seconds
+        slower.  Returns (target, before, latest), worst first.
+    """
+    result = []
+    for target, samples in buildtimes.targets.items():
+        if len(samples) < 2:
+            continue
+        earlier = [seconds for _, seconds in samples[:-1]]
+        before = sum(earlier) / len(earlier)
+        latest = _latest(samples)
+        if latest > before * threshold and latest - before >= minimum:
+            result.append((target, before, latest))
+    result.sort(key=lambda item: item[2] - item[1], reverse=True)
+    return result
+
+
+def _name(target, relativeto):
+    relative = os.path.relpath(target, relativeto)
+    return target if relative.startswith("..") else relative
+
+
+def add_arguments(cap):
+    compiletools.dirnamer.add_arguments(cap)
+    cap.add(
+        "--top",
+        type=int,
+        default=10,
+        help="How many of the slowest translation units, links and tests to show",
+    )
+    cap.add(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="Report a target as a regression if its latest build took this many times longer than the average of its earlier builds",
+    )
+    cap.add(
+        "--minimum",
+        type=float,
+        default=0.1,
+        help="Ignore regressions smaller than this many seconds",
+    )
+    cap.add(
+        "--all-projects",
+        action="store_true",
+        help="Report on every target in the database rather than only those below the current directory",
+    )
+
+
+def report(buildtimes, args, relativeto, file=None):
+    if file is None:
+        file = sys.stdout
+    if not args.all_projects:
+        prefix = os.path.join(relativeto, "")
+        buildtimes.targets = {
+            target: samples for target, samples in buildtimes.targets.items() if target.startswith(prefix)
+        }
+        buildtimes.runs = [run for run in buildtimes.runs if run.get("cwd") == relativeto]
+
+    formattime = compiletools.timing.Timer().format_time
+    if not buildtimes.targets and not buildtimes.runs:
+        print("No build times have been recorded.  Build with ct-cake --time or --backend=ninja|native.", file=file)
+        return
+
+    for title, predicate in (
+        ("Slowest translation units", _iscompile),
+        ("Slowest links", lambda target: not _iscompile(target) and not _istest(target)),
+        ("Slowest tests", _istest),
+    ):
+        targets = slowest(buildtimes, predicate, args.top)
+        if not targets:
+            continue
+        print(title + ":", file=file)
+        for target, samples in targets:
+            trend = sparkline([seconds for _, seconds in samples])
+            print("  {:>8}  {:<20}  {}".format(formattime(_latest(samples)), trend, _name(target, relativeto)), file=file)
+        print(file=file)
+
+    found = regressions(buildtimes, args.threshold, args.minimum)
+    print("Regressions:" if found else "Regressions: none", file=file)
+    for target, before, latest in found[: args.top]:
+        print(
+            "  {:>8} -> {:>8}  (+{:.0f}%)  {}".format(
+                formattime(before), formattime(latest), 100.0 * (latest - before) / before if before else 100.0, _name(target, relativeto)
+            ),
+            file=file,
+        )
+    print(file=file)
+
+    if buildtimes.runs:
+        print("ct-cake --time runs:", file=file)
+        phases = {}
+        for run in buildtimes.runs:
+            for phase in run.get("phases", {}):
+                phases.setdefault(phase, None)
+        for phase in phases:
+            values = [run["phases"][phase] for run in buildtimes.runs if phase in run.get("phases", {})]
+            print("  {:<32} {:>8}  {}".format(phase, formattime(values[-1]), sparkline(values[-40:])), file=file)
+        latest = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(buildtimes.runs[-1]["time"]))
+        print("  ({} runs, latest at {})".format(len(buildtimes.runs), latest), file=file)
+
+
+def main(argv=None):
+    cap = compiletools.apptools.create_parser(
+        "Report the slowest targets, regressions and trends from the build times recorded by ct-cake",
+        argv=argv,
+        include_config=False,
+    )
+    add_arguments(cap)
+    args = cap.parse_args(args=argv)
+    buildtimes = compiletools.buildtimes.BuildTimes(compiletools.buildtimes.cachefile(argv))
+    if buildtimes.filename is None:
+        print("CTCACHE is None so ct-cake doesn't record build times.", file=sys.stderr)
+        return 1
+    report(buildtimes, args, os.getcwd())
+    return 0
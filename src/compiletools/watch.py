@@ -0,0 +1,151 @@
+""" ct-cake --watch: build, then rebuild whenever a file that the build
+    depends on changes.
+
+    The dependency graph from the previous build is kept in memory, as are
+    ct-cake's caches, and only the entries of the files that changed are
+    dropped (see cake.forget_changed_files), so a rebuild only reanalyses
+    the files that changed.  Bursts of changes (e.g., a branch checkout or an editor's
+    save dance) are debounced into a single rebuild, and only the targets
+    whose dependencies changed are rebuilt (see --build-only-changed).
+"""
+import os
+import sys
+import traceback
+
+import compiletools.apptools
+import compiletools.memory
+import compiletools.cake
+import compiletools.inotify
+import compiletools.utils
+import compiletools.wrappedos
+
+
+class Watcher(object):
+
+    """ Rebuild the targets given by argv whenever their dependencies change """
+
+    def __init__(self, argv, debounce=0.2):
+        self.argv = list(argv)
+        self.debounce = debounce
+        self.verbose = 0
+        self.builds = 0
+        self.returncode = 0
+        # root source file -> every source and header it requires
+        self.closures = {}
+        self._inotify = compiletools.inotify.Inotify()
+
+    def _log(self, message):
+        if self.verbose >= 1:
+            print("ct-cake --watch: " + message, file=sys.stderr, flush=True)
+
+    def _build(self, extraargv=()):
+        compiletools.apptools.resetparsers()
+        compiletools.apptools.resetcallbacks()
+        cake = None
+        try:
+            self.returncode, cake = compiletools.cake.build(self.argv + list(extraargv), keep_cache=True)
+        except Exception:
+            # A broken build shouldn't stop the watching
+            traceback.print_exc()
+            self.returncode = 1
+        self.builds += 1
+        if cake is not None and cake.hunter is not None:
+            self.verbose = cake.args.verbose
+            self._update_graph(cake)
+        compiletools.memory.checkpoint()
+        compiletools.cake.clear_instance_caches()
+
+    def _update_graph(self, cake):
+        """ Record what every target requires and watch any new directories """
+        args = cake.args
+        roots = []
+        for sources in (args.filename, args.tests, args.static, args.dynamic):
+            roots.extend(sources or [])
+        self.closures = {
+            root: set(cake.hunter.required_files(root)) for root in compiletools.utils.ordered_unique(roots)
+        }
+
+        # The current directory is where --auto finds new targets
+        directories = {os.getcwd()}
+        directories.update(getattr(cake.headerdeps, "includes", []))
+        for files in self.closures.values():
+            directories.update(compiletools.wrappedos.dirname(filename) for filename in files)
+        for directory in sorted(directories - self._inotify.watching()):
+            self._inotify.watch(directory)
+        self._log("watching {} files in {} directories".format(
+            len(set().union(*self.closures.values())), len(self._inotify.watching())
+        ))
+
+    def _wait_for_changes(self):
+        """ Block until something changes, then keep collecting until it has
+            been quiet for the debounce period
+        """
+        changes = self._inotify.read()
+        while True:
+            more = self._inotify.read(timeout=self.debounce)
+            if not more:
+                return changes
+            changes.extend(more)
+
+    def relevant(self, changes):
+        """ The set of changed paths that could affect the build, or None if
+            the kernel dropped events and anything may have changed
+        """
+        known = set().union(*self.closures.values())
+        relevant = set()
+        for path, mask in changes:
+            if path is None:
+                return None
+            if path in known:
+                relevant.add(path)
+            elif mask & compiletools.inotify.STRUCTURE_MASK and (
+                compiletools.utils.isheader(path) or compiletools.utils.issource(path)
+            ):
+                # A new file might be a new target or satisfy a missing include
+                relevant.add(path)
+        return relevant
+
+    def affected(self, changed):
+        """ The root source files whose closure contains any of changed """
+        return [root for root, files in self.closures.items() if files & changed]
+
+    def run(self, max_builds=None):
+        """ Build and then rebuild on changes until interrupted (or until
+            max_builds builds have run).  Returns the last build's return code.
+        """
+        self._build()
+        while max_builds is None or self.builds < max_builds:
+            changes = self._wait_for_changes()
+            changed = self.relevant(changes)
+            if changed is not None and not changed:
+                continue
+
+            compiletools.cake.forget_changed_files(None if changed is None else changes)
+
+            known = set().union(*self.closures.values())
+            if changed is not None and changed <= known:
+                affected = self.affected(changed)
+                self._log("{} changed. Rebuilding {}".format(" ".join(sorted(changed)), " ".join(affected)))
+                self._build(["--build-only-changed=" + path for path in sorted(changed)])
+            else:
+                # New or lost files could change which targets exist
+                self._log("files were added or removed. Rebuilding everything")
+                self._build()
+        return self.returncode
+
+    def close(self):
+        self._inotify.close()
+
+
+def main(argv):
+    """ Run ct-cake with argv whenever its inputs change """
+    if not compiletools.inotify.available():
+        print("ct-cake --watch requires inotify, which is not available on this system", file=sys.stderr)
+        return 1
+    watcher = Watcher(argv)
+    try:
+        return watcher.run()
+    except KeyboardInterrupt:
+        return watcher.returncode
+    finally:
+        watcher.close()
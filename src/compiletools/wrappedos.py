@@ -1,28 +1,28 @@
 """ Wrap and memoize a variety of os calls """
 import os
 import shutil
-import functools
+import compiletools.caches
 
 
-@functools.lru_cache(maxsize=None)
+@compiletools.caches.cached()
 def getmtime(realpath):
     """ Cached version of os.path.getmtime """
     return os.path.getmtime(realpath)
 
 
-@functools.lru_cache(maxsize=None)
+@compiletools.caches.cached()
 def isfile(trialpath):
     """ Cached version of os.path.isfile """
     return os.path.isfile(trialpath)
 
 
-@functools.lru_cache(maxsize=None)
+@compiletools.caches.cached()
 def isdir(trialpath):
     """ Cached version of os.path.isdir """
     return os.path.isdir(trialpath)
 
 
-@functools.lru_cache(maxsize=None)
+@compiletools.caches.cached()
 def realpath(trialpath):
     """ Cache os.path.realpath """
     # Note: We can't raise an exception on file non-existence
@@ -31,7 +31,7 @@ def realpath(trialpath):
     return rp
 
 
-@functools.lru_cache(maxsize=None)
+@compiletools.caches.cached()
 def dirname(trialpath):
     """ A cached verion of os.path.dirname """
     return os.path.dirname(trialpath)